@@ -0,0 +1,90 @@
+import os
+import time
+from datetime import datetime, timedelta
+from fastapi import Depends, HTTPException, Query
+from fastapi.security import OAuth2PasswordBearer
+from jose import JWTError, jwt
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.backend.database import get_db
+from src.backend.models import User
+from src.backend.schemas import UserResponse
+from src.backend.ttl_cache import TTLCache
+
+# JWT settings
+SECRET_KEY = os.getenv("SECRET_KEY")
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 120
+
+# Verified tokens are remembered for a short while so polling dashboards don't verify
+# the signature and look the user up on every request. Each process has its own cache,
+# so an update made through another process is seen after at most AUTH_CACHE_TTL_SECONDS.
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL_SECONDS = int(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
+
+token_cache = TTLCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL_SECONDS)
+_tokens_by_user: dict[int, set[str]] = {}
+
+
+# Function to create JWT token
+def create_access_token(data: dict, expires_delta=None):
+    to_encode = data.copy()
+    if expires_delta:
+        expire = datetime.utcnow() + expires_delta
+    else:
+        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+
+def invalidate_user(user_id: int):
+    for token in _tokens_by_user.pop(user_id, set()):
+        token_cache.pop(token)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_changed_user(mapper, connection, target):
+    invalidate_user(target.id)
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> UserResponse:
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
+
+    credentials_exception = HTTPException(status_code=401, detail="Could not validate credentials")
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        phone_number: str = payload.get("sub")
+        if phone_number is None:
+            raise credentials_exception
+    except JWTError:
+        raise credentials_exception
+    user = (await db.execute(select(User).where(User.phone_number == phone_number))).scalars().first()
+    if user is None:
+        raise credentials_exception
+
+    current_user = UserResponse.model_validate(user)
+    # Never keep a token in the cache past its expiry
+    ttl = min(AUTH_CACHE_TTL_SECONDS, payload.get("exp", 0) - time.time())
+    if ttl > 0:
+        token_cache.set(token, current_user, ttl=ttl)
+        # Drop tokens of this user that already left the cache
+        _tokens_by_user[user.id] = {cached_token for cached_token in _tokens_by_user.get(user.id, set()) if cached_token in token_cache}
+        _tokens_by_user[user.id].add(token)
+    return current_user
+
+
+async def get_current_user_or_query_token(
+    header_token: str | None = Depends(optional_oauth2_scheme),
+    token: str | None = Query(None, description="Access token, for <img> tags and other clients that can't send headers"),
+    db: AsyncSession = Depends(get_db),
+) -> UserResponse:
+    if not (header_token or token):
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    return await get_current_user(header_token or token, db)
@@ -0,0 +1,122 @@
+"""
+How many extractions bursts of WhatsApp messages cause with the debounced extract_orders jobs.
+
+Replays bursts of messages per client on a simulated clock against a throwaway SQLite
+queue: messages are enqueued the way the webhook does it, a simulated worker claims jobs
+and each extraction takes --extraction-seconds. Nothing sleeps, the clock is passed to
+the queue functions. Checks that no extraction starts later than the max delay after the
+first message it covers.
+
+    python benchmarks/debounce_simulation.py --clients 20 --bursts 5 --burst-size 8
+"""
+import os
+import sys
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/debounce.db")
+
+from src.backend.database import SessionLocal, create_tables, dispose_engine
+from src.backend.jobs import enqueue_job, enqueue_debounced_job, claim_next_job, mark_done, mark_cancelled, cancel_requested
+from src.backend.models import User, Client
+
+TICK = timedelta(milliseconds=100)
+
+
+def message_times(args, start: datetime) -> list[tuple[datetime, int]]:
+    # Bursts of short messages a few seconds apart, bursts of a client minutes apart
+    random.seed(args.seed)
+    events = []
+    for client_id in range(1, args.clients + 1):
+        at = start + timedelta(seconds=random.uniform(0, 60))
+        for _ in range(args.bursts):
+            for _ in range(args.burst_size):
+                events.append((at, client_id))
+                at += timedelta(seconds=random.uniform(0.3, args.max_gap))
+            at += timedelta(seconds=random.uniform(60, 300))
+    return sorted(events)
+
+
+async def simulate(args) -> dict:
+    start = datetime(2026, 1, 1)
+    events = message_times(args, start)
+    now = start
+    last_message_at = start
+    running = {}  # job id -> (job, finishes at)
+    stats = {"messages": len(events), "extractions": 0, "cancelled": 0, "start_delays": []}
+
+    async with SessionLocal() as db:
+        while True:
+            # Messages that arrived by now, stored the way the webhook stores them
+            while events and events[0][0] <= now:
+                last_message_at, client_id = events.pop(0)
+                if args.no_debounce:
+                    enqueue_job(db, "extract_orders", client_id=client_id, payload={"first_enqueued_at": now.isoformat()}, run_after=now)
+                else:
+                    await enqueue_debounced_job(db, "extract_orders", client_id, {}, args.quiet, args.max_delay, now=now)
+                await db.commit()
+
+            for job_id, (job, finishes_at) in list(running.items()):
+                if await cancel_requested(job_id):
+                    # The extraction stops at its next check
+                    await mark_cancelled(db, job, "simulation")
+                    stats["cancelled"] += 1
+                    del running[job_id]
+                elif finishes_at <= now:
+                    await mark_done(db, job, "simulation")
+                    stats["extractions"] += 1
+                    del running[job_id]
+
+            while len(running) < args.workers:
+                job = await claim_next_job(db, "simulation", now=now)
+                if job is None:
+                    break
+                stats["start_delays"].append((now - datetime.fromisoformat(job.payload["first_enqueued_at"])).total_seconds())
+                running[job.id] = (job, now + timedelta(seconds=args.extraction_seconds))
+
+            # Every debounced job has run once max_delay passed since the last message
+            idle = not running and now > last_message_at + timedelta(seconds=args.max_delay + 1)
+            if idle and not events:
+                break
+            # Skip the quiet time between bursts
+            now = events[0][0] if idle else now + TICK
+    return stats
+
+
+async def run(args):
+    await create_tables()
+    async with SessionLocal() as db:
+        db.add(User(id=1, phone_number="+34000000000", password=""))
+        db.add_all(Client(id=client_id, phone_number=f"+34{client_id:09d}", user_id=1) for client_id in range(1, args.clients + 1))
+        await db.commit()
+
+    stats = await simulate(args)
+    delays = stats["start_delays"]
+    print(f"messages          {stats['messages']}")
+    print(f"extractions       {stats['extractions']} ({stats['extractions'] / stats['messages']:.2f} per message)")
+    print(f"cancelled         {stats['cancelled']}")
+    print(f"start delay       p50={statistics.median(delays):.1f}s max={max(delays):.1f}s")
+    if not args.no_debounce:
+        # One tick of slack for the simulated worker's polling
+        assert max(delays) <= args.max_delay + TICK.total_seconds(), "an extraction started after the max delay"
+    await dispose_engine()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--bursts", type=int, default=5, help="bursts per client")
+    parser.add_argument("--burst-size", type=int, default=8, help="messages per burst")
+    parser.add_argument("--max-gap", type=float, default=2.5, help="max seconds between messages of a burst")
+    parser.add_argument("--quiet", type=float, default=3, help="EXTRACTION_QUIET_SECONDS")
+    parser.add_argument("--max-delay", type=float, default=15, help="EXTRACTION_MAX_DELAY_SECONDS")
+    parser.add_argument("--extraction-seconds", type=float, default=4, help="time an extraction takes")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--no-debounce", action="store_true", help="one extraction per message, as before")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,100 @@
+"""
+Fan-out of the /events streams (event_stream.py) with thousands of idle connections in one
+process.
+
+Opens --streams event streams spread over --users users directly on the broker (no HTTP),
+then commits --events events for random users the way the webhook does, and reports how long
+they took to reach every stream of their user, and the memory the idle streams take.
+
+    python benchmarks/event_streams.py --streams 5000 --users 500 --events 200
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/event_streams.db")
+os.environ.setdefault("EVENTS_HEARTBEAT_SECONDS", "3600")
+
+from src.backend.database import SessionLocal, create_tables, dispose_engine
+from src.backend.events import record_event
+from src.backend.models import User
+from event_stream import broker, event_stream
+
+
+async def read_stream(stream, received: dict, stop: asyncio.Event):
+    async for chunk in stream:
+        if chunk.startswith("id: "):
+            event_id = int(chunk.split("\n", 1)[0][4:])
+            received.setdefault(event_id, []).append(time.perf_counter())
+        if stop.is_set():
+            break
+
+
+def percentile(values: list[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run(args):
+    await create_tables()
+    async with SessionLocal() as db:
+        db.add_all(User(id=user_id, phone_number=f"+34{user_id:09d}", password="") for user_id in range(1, args.users + 1))
+        await db.commit()
+    await broker.start()
+
+    rng = random.Random(args.seed)
+    stop = asyncio.Event()
+    received = {}
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    users = [rng.randint(1, args.users) for _ in range(args.streams)]
+    readers = [asyncio.create_task(read_stream(event_stream(user_id, None), received, stop)) for user_id in users]
+    await asyncio.sleep(0.5)
+    idle_memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    sent = {}
+    for _ in range(args.events):
+        async with SessionLocal() as db:
+            event = record_event(db, rng.randint(1, args.users), "order.updated", {"order_id": 1, "status": "Esperando precio"})
+            await db.commit()
+        sent[event.id] = (event.user_id, time.perf_counter())
+        broker.notify()
+        await asyncio.sleep(args.interval)
+    await asyncio.sleep(1)
+
+    latencies, missing = [], 0
+    for event_id, (user_id, sent_at) in sent.items():
+        deliveries = received.get(event_id, [])
+        missing += users.count(user_id) - len(deliveries)
+        latencies += [delivered_at - sent_at for delivered_at in deliveries]
+
+    stop.set()
+    for reader in readers:
+        reader.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+    await broker.close()
+    await dispose_engine()
+
+    print(f"streams           {args.streams} over {args.users} users, {idle_memory / args.streams / 1024:.1f} KiB each while idle")
+    print(f"events            {len(sent)}, {len(latencies)} deliveries, {missing} missing")
+    if latencies:
+        ms = [latency * 1000 for latency in latencies]
+        print(f"delivery latency  p50={statistics.median(ms):.1f}ms p95={percentile(ms, 95):.1f}ms max={max(ms):.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between events")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
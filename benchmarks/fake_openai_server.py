@@ -0,0 +1,90 @@
+"""
+Local stand-in for the OpenAI API, to run reextract.py and load tests without spending tokens.
+
+Answers /v1/chat/completions with the orders of the plates it finds in the prompt and
+/v1/responses with one made-up reference per part, after --latency seconds. Token usage is
+estimated as characters / 4.
+
+    python benchmarks/fake_openai_server.py --port 8900 --latency 0.5
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=fake python reextract.py
+"""
+import re
+import json
+import time
+import asyncio
+import argparse
+from fastapi import FastAPI, Request
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+PLATE = re.compile(r"\b(\d{4})\s?-?([A-Z]{3})\b")
+LATENCY = 0.5
+
+app = FastAPI()
+
+
+def prompt_text(content) -> str:
+    if isinstance(content, str):
+        return content
+    return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+
+
+def usage(prompt: str, output: str) -> tuple[int, int]:
+    return len(prompt) // 4, len(output) // 4
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    await asyncio.sleep(LATENCY)
+    prompt = " ".join(prompt_text(message["content"]) for message in body["messages"])
+    plates = dict.fromkeys("".join(match) for match in PLATE.findall(prompt))
+    orders = [
+        {"car_plate": plate, "car_brand": "", "car_model": "", "car_frame": "", "order_requirements": ["pastillas de freno"], "reference_media_files": []}
+        for plate in plates
+    ]
+    output = json.dumps({"orders": orders, "summary": ""})
+    prompt_tokens, completion_tokens = usage(prompt, output)
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": output}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+@app.post("/v1/responses")
+async def responses(request: Request):
+    body = await request.json()
+    await asyncio.sleep(LATENCY)
+    prompt = " ".join(prompt_text(message["content"]) for message in body["input"])
+    output = json.dumps({"references": [{"part_reference": "FAKE000001", "reference_name": "pastillas de freno"}]})
+    input_tokens, output_tokens = usage(prompt, output)
+    return {
+        "id": "resp-fake",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": body["model"],
+        "status": "completed",
+        "output": [{
+            "id": "msg-fake",
+            "type": "message",
+            "role": "assistant",
+            "status": "completed",
+            "content": [{"type": "output_text", "text": output, "annotations": []}],
+        }],
+        "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before each answer")
+    args = parser.parse_args()
+    LATENCY = args.latency
+    config = Config()
+    config.bind = [f"127.0.0.1:{args.port}"]
+    asyncio.run(serve(app, config))
@@ -0,0 +1,125 @@
+"""
+Query time of the webhook and extraction lookups before and after the 0002 indexes.
+
+Seeds a synthetic dataset at migration 0001 (the schema create_all used to build), times
+the hot queries, upgrades to head and times them again. Uses a throwaway SQLite file
+unless DATABASE_URL is set, point it at an empty MySQL database to measure MySQL.
+
+    python benchmarks/index_benchmark.py --users 20 --clients 500 --orders 5 --messages 20
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/index_benchmark.db")
+
+from sqlalchemy import select, insert, func
+from src.backend.database import get_engine, create_tables, dispose_engine
+from src.backend.models import User, Client, Order, Message
+
+
+def plate(client_id: int, order_number: int) -> str:
+    return f"{client_id % 10000:04d}{chr(65 + order_number % 26)}{chr(65 + client_id // 10000 % 26)}C"
+
+
+async def seed(args):
+    batch = 5000
+    async with get_engine().begin() as conn:
+        await conn.execute(insert(User), [{"id": user_id, "phone_number": f"+34{user_id:09d}", "password": ""} for user_id in range(1, args.users + 1)])
+        clients = [
+            {"id": (user_id - 1) * args.clients + n, "phone_number": f"+34{6 * 10 ** 8 + n:09d}", "user_id": user_id}
+            for user_id in range(1, args.users + 1)
+            for n in range(1, args.clients + 1)
+        ]
+        for start in range(0, len(clients), batch):
+            await conn.execute(insert(Client), clients[start:start + batch])
+
+        rows = []
+        for client in clients:
+            rows.extend({"client_id": client["id"], "status": "Esperando precio", "car_plate": plate(client["id"], n), "order_requirements": [], "reference_media_files": []} for n in range(args.orders))
+            if len(rows) >= batch:
+                await conn.execute(insert(Order), rows)
+                rows = []
+        if rows:
+            await conn.execute(insert(Order), rows)
+
+        # Messages interleaved across clients, the way they arrive
+        rows = []
+        for _ in range(args.messages):
+            for client in clients:
+                rows.append({"client_id": client["id"], "content": "necesito pastillas de freno"})
+                if len(rows) >= batch:
+                    await conn.execute(insert(Message), rows)
+                    rows = []
+        if rows:
+            await conn.execute(insert(Message), rows)
+    return clients
+
+
+# The columns of migration 0001, selecting the models would also ask for the ones added later
+CLIENT_COLUMNS = (Client.id, Client.phone_number, Client.name, Client.user_id)
+ORDER_COLUMNS = (Order.id, Order.status, Order.car_plate, Order.car_frame, Order.car_brand, Order.car_model, Order.order_requirements, Order.reference_media_files, Order.client_id)
+MESSAGE_COLUMNS = (Message.id, Message.content, Message.media_urls, Message.client_id, Message.created_at)
+
+
+def hot_queries(client: dict, args) -> dict:
+    return {
+        # whatsapp_webhook: find the client of an incoming message
+        "client by phone": select(*CLIENT_COLUMNS).where(Client.phone_number == client["phone_number"], Client.user_id == client["user_id"]),
+        # upsert_orders: find the order of a plate
+        "order by plate": select(*ORDER_COLUMNS).where(Order.client_id == client["id"], Order.car_plate == plate(client["id"], args.orders // 2)),
+        # extract_orders_incremental: messages after the checkpoint, in order
+        "messages after id": select(*MESSAGE_COLUMNS).where(Message.client_id == client["id"], Message.id > 0).order_by(Message.id).limit(50),
+    }
+
+
+async def measure(clients: list[dict], args) -> dict[str, list[float]]:
+    timings = {}
+    random.seed(1)
+    async with get_engine().connect() as conn:
+        for _ in range(args.queries):
+            for name, query in hot_queries(random.choice(clients), args).items():
+                start = time.perf_counter()
+                (await conn.execute(query)).all()
+                timings.setdefault(name, []).append(time.perf_counter() - start)
+    return timings
+
+
+async def run(args):
+    await create_tables("0001")
+    async with get_engine().connect() as conn:
+        if await conn.scalar(select(func.count()).select_from(Client)):
+            sys.exit("The database already has clients, point DATABASE_URL at an empty database")
+
+    start = time.perf_counter()
+    clients = await seed(args)
+    print(f"seeded {len(clients)} clients, {len(clients) * args.orders} orders, {len(clients) * args.messages} messages in {time.perf_counter() - start:.1f}s")
+
+    before = await measure(clients, args)
+    start = time.perf_counter()
+    await create_tables("head")
+    print(f"migrated to head in {time.perf_counter() - start:.1f}s")
+    after = await measure(clients, args)
+
+    print(f"{'query':<20}{'before p50':>12}{'after p50':>12}{'speedup':>10}")
+    for name in before:
+        before_ms = statistics.median(before[name]) * 1000
+        after_ms = statistics.median(after[name]) * 1000
+        print(f"{name:<20}{before_ms:>10.3f}ms{after_ms:>10.3f}ms{before_ms / after_ms:>9.1f}x")
+    await dispose_engine()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--clients", type=int, default=500, help="clients per user")
+    parser.add_argument("--orders", type=int, default=5, help="orders per client")
+    parser.add_argument("--messages", type=int, default=20, help="messages per client")
+    parser.add_argument("--queries", type=int, default=200, help="times each query runs per phase")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,84 @@
+"""
+Webhook latency while many users log in at once.
+
+Runs the app in-process against a throwaway SQLite database and measures the latency of
+/whatsapp/{user_id} first on its own and then during a storm of concurrent logins. With
+password hashing off the event loop, p99 should stay roughly flat between the two phases.
+
+    python benchmarks/login_storm.py --logins 200 --concurrency 50
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/login_storm.db")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+import httpx
+import main
+from src.backend.database import create_tables
+
+
+def percentile(values: list[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(name: str, latencies: list[float]):
+    ms = [latency * 1000 for latency in latencies]
+    print(f"{name:<16} n={len(ms):<5} p50={statistics.median(ms):7.1f}ms p99={percentile(ms, 99):7.1f}ms max={max(ms):7.1f}ms")
+
+
+async def measure_webhook(client: httpx.AsyncClient, user_id: int, count: int, interval: float) -> list[float]:
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        response = await client.post(f"/whatsapp/{user_id}", data={"From": "whatsapp:+34600000000", "Body": f"mensaje {i}"})
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def login_storm(client: httpx.AsyncClient, logins: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    status_codes = {}
+
+    async def login():
+        async with semaphore:
+            response = await client.post("/token", data={"username": "+34000000000", "password": "benchmark"})
+            status_codes[response.status_code] = status_codes.get(response.status_code, 0) + 1
+
+    await asyncio.gather(*(login() for _ in range(logins)))
+    return status_codes
+
+
+async def run(args):
+    await create_tables()
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        response = await client.post("/register", json={"phone_number": "+34000000000", "password": "benchmark"})
+        user_id = response.json()["user_id"]
+
+        report("webhook alone", await measure_webhook(client, user_id, args.webhooks, args.interval))
+
+        storm = asyncio.create_task(login_storm(client, args.logins, args.concurrency))
+        latencies = await measure_webhook(client, user_id, args.webhooks, args.interval)
+        status_codes = await storm
+        report("during logins", latencies)
+        print(f"login responses: {status_codes}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--webhooks", type=int, default=100, help="webhook requests per phase")
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between webhook requests")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="logins in flight at once")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,73 @@
+"""
+Drives OpenAIBackend through OPENAI_BASE_URL against benchmarks/fake_openai_server.py, started
+in this process: one extraction, one reference search, then --calls extractions at once over
+the shared client. Exits with an error when an answer is not the one the stub gives.
+
+    python benchmarks/openai_client_check.py --calls 50 --latency 0.2
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run(args):
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+    import fake_openai_server
+
+    port = free_port()
+    fake_openai_server.LATENCY = args.latency
+    # Read by llm_client when it is imported
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+    from llm_backends import OpenAIBackend, token_usage
+    from language import Orders
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.accesslog = None
+    stop = asyncio.Event()
+    server = asyncio.create_task(serve(fake_openai_server.app, config, shutdown_trigger=stop.wait))
+    await asyncio.sleep(0.5)  # Let it bind
+
+    backend = OpenAIBackend()
+    backend.open()
+    try:
+        messages = [{"role": "user", "content": "Pastillas de freno para el 1234 ABC"}]
+        result = await backend.extract_orders("gpt-4o-mini", messages, Orders)
+        if [order.car_plate for order in result.orders] != ["1234ABC"]:
+            sys.exit(f"Unexpected extraction: {result}")
+        references = await backend.search_part_references("gpt-4o-mini", messages, {"type": "object"}, timeout=10)
+        if references["references"][0]["part_reference"] != "FAKE000001":
+            sys.exit(f"Unexpected references: {references}")
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(backend.extract_orders("gpt-4o-mini", messages, Orders) for _ in range(args.calls)))
+        elapsed = time.perf_counter() - start
+        if any(len(result.orders) != 1 for result in results):
+            sys.exit("Unexpected extraction in the concurrent calls")
+    finally:
+        await backend.close()
+        stop.set()
+        await server
+
+    print(f"{args.calls} concurrent extractions in {elapsed:.2f}s ({args.latency}s each on the stub)")
+    print(f"{token_usage['calls']} calls, {token_usage['input_tokens']} input and {token_usage['output_tokens']} output tokens")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20, help="extractions sent at the same time")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds the stub waits before each answer")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,150 @@
+"""
+Prompt tokens of the order extraction before and after prompt_compaction.py, on synthetic
+WhatsApp conversations.
+
+Every conversation is extracted after each burst of messages, the way the debounced jobs do
+it, in both extraction modes:
+  full         the whole conversation every time, orders of earlier bursts point to their photos
+  incremental  only the burst, with the orders (and summary) of the earlier ones
+
+"before" is the prompt as it was built until now: one "Mensaje del mecánico: ..." part per
+message with the stored paths of its attachments and every photo at high detail. Tokens are
+estimated the same way for both (characters / 4, OpenAI's tile formula for images), nothing
+is sent anywhere.
+
+    python benchmarks/prompt_tokens.py --conversations 200 --bursts 8 --budget 8000
+"""
+import os
+import sys
+import json
+import random
+import hashlib
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/prompt_tokens.db")
+
+from src.backend.models import Message, MediaFile
+from prompt_compaction import compact_prompt, messages_within_budget, estimate_text_tokens, estimate_image_tokens
+
+PARTS = ["pastillas de freno", "discos de freno", "filtro de aceite", "filtro de aire", "kit de distribución", "bomba de agua", "amortiguadores delanteros", "embrague", "alternador", "correa auxiliar"]
+BRANDS = [("SEAT", "Ibiza"), ("Renault", "Clio"), ("Volkswagen", "Golf"), ("Peugeot", "308"), ("Ford", "Focus")]
+FILLERS = ["buenas", "cuando lo tendrías?", "vale gracias", "mañana paso a recogerlo", "es urgente, el cliente espera", "te mando foto de la pieza", "ok"]
+SUMMARY = "El mecánico pide precio para varios coches del taller, quiere las piezas originales cuando las haya y suele recoger por la mañana. Pregunta si se puede enviar a domicilio."
+
+
+def plate(rng: random.Random) -> str:
+    return f"{rng.randint(1000, 9999)}{''.join(rng.choice('BCDFGHJKLMNPRSTVWXYZ') for _ in range(3))}"
+
+
+def photo(rng: random.Random, user_id: int, client_id: int) -> MediaFile:
+    sha256 = hashlib.sha256(rng.randbytes(16)).hexdigest()
+    return MediaFile(
+        path=f"media/{user_id}/{client_id}/{sha256}.jpg",
+        derived_path=f"media/{user_id}/{client_id}/.derived/{sha256}.jpg",
+        sha256=sha256,
+        mime_type="image/jpeg",
+        width=4032,  # Phone camera
+        height=3024,
+    )
+
+
+def conversation(rng: random.Random, client_id: int, args) -> list[list[Message]]:
+    """
+    Bursts of messages of one client, each about a car or two, a few with photos and a few
+    long ones that String(255) used to cut.
+    """
+    at = datetime(2026, 10, 1, 8) + timedelta(minutes=rng.randint(0, 600))
+    bursts, next_id = [], 1
+    for _ in range(args.bursts):
+        burst = []
+        for car in range(rng.randint(1, 2)):
+            brand, model = rng.choice(BRANDS)
+            texts = [f"{' y '.join(rng.sample(PARTS, rng.randint(1, 3)))} para el {brand} {model} matrícula {plate(rng)}"]
+            texts += [rng.choice(FILLERS) for _ in range(rng.randint(1, args.burst_size))]
+            if rng.random() < 0.2:
+                texts.append("te explico: " + ", ".join(f"{part} que hace ruido al frenar en frío" for part in rng.sample(PARTS, 5)))
+            for text in texts:
+                message = Message(id=next_id, client_id=client_id, content=text, created_at=at)
+                message.media_files = [photo(rng, 1, client_id)] if rng.random() < args.media_ratio else []
+                message.media_urls = ",".join(media_file.path for media_file in message.media_files) or None
+                burst.append(message)
+                next_id += 1
+                at += timedelta(seconds=rng.randint(5, 90))
+        bursts.append(burst)
+        at += timedelta(hours=rng.randint(2, 48))
+    return bursts
+
+
+def before_tokens(messages: list[Message], current_orders: list[dict] | None) -> int:
+    # language.message_content as it was: a part per message, paths inlined, every photo at high detail
+    tokens = 0
+    if current_orders is not None:
+        tokens += estimate_text_tokens(f"Pedidos ya extraídos: {json.dumps(current_orders, ensure_ascii=False, separators=(',', ':'))}")
+    for message in messages:
+        if message.media_urls is None:
+            tokens += estimate_text_tokens(f"Mensaje del mecánico: {message.content}")
+        else:
+            tokens += estimate_text_tokens(f"Mensaje del mecánico: {message.content} {message.media_urls} (archivo adjunto)")
+            tokens += sum(estimate_image_tokens(media_file.width, media_file.height, "high") for media_file in message.media_files)
+    return tokens
+
+
+def extracted_orders(messages: list[Message]) -> list[dict]:
+    # What the LLM would return for a burst: an order per car, pointing to the burst's photos
+    photos = [media_file.path for message in messages for media_file in message.media_files]
+    return [
+        {"car_plate": message.content.rsplit(" ", 1)[-1], "car_brand": "", "car_model": "", "car_frame": "", "order_requirements": message.content.split(" para el ")[0].split(" y "), "reference_media_files": photos}
+        for message in messages if "matrícula" in message.content
+    ]
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    results = {mode: {"before": [], "after": [], "dropped_messages": 0} for mode in ("full", "incremental")}
+
+    for client_id in range(1, args.conversations + 1):
+        history, orders = [], []
+        for burst in conversation(rng, client_id, args):
+            # Full: the whole conversation, the photos of earlier bursts are already in orders
+            history += burst
+            reflected_media = [path for order in orders for path in order["reference_media_files"]]
+            prompt = compact_prompt(history, reflected_media=reflected_media, detail="high", budget=args.budget)
+            results["full"]["before"].append(before_tokens(history, None))
+            results["full"]["after"].append(prompt["tokens"])
+            results["full"]["dropped_messages"] += prompt["dropped_messages"]
+
+            # Incremental: the burst in windows that fit the budget, with the orders and summary so far
+            summary = SUMMARY if orders else None
+            pending = burst
+            while pending:
+                window = pending[:messages_within_budget(pending, orders, summary, budget=args.budget)]
+                pending = pending[len(window):]
+                prompt = compact_prompt(window, orders, summary, detail="high", budget=args.budget)
+                results["incremental"]["before"].append(before_tokens(window, orders))
+                results["incremental"]["after"].append(prompt["tokens"])
+                results["incremental"]["dropped_messages"] += prompt["dropped_messages"]
+            orders = orders + extracted_orders(burst)
+
+    for mode, result in results.items():
+        before, after = result["before"], result["after"]
+        print(f"{mode}")
+        print(f"  prompts          {len(before)}")
+        print(f"  tokens before    total={sum(before)} mean={statistics.mean(before):.0f} max={max(before)}")
+        print(f"  tokens after     total={sum(after)} mean={statistics.mean(after):.0f} max={max(after)}")
+        print(f"  reduction        {1 - sum(after) / sum(before):.1%}")
+        print(f"  over budget      {sum(tokens > args.budget for tokens in after)} prompts, {result['dropped_messages']} messages dropped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--bursts", type=int, default=8, help="bursts per conversation, each followed by an extraction")
+    parser.add_argument("--burst-size", type=int, default=5, help="max short messages after the first one of a car")
+    parser.add_argument("--media-ratio", type=float, default=0.25, help="share of messages with a photo")
+    parser.add_argument("--budget", type=int, default=8000, help="PROMPT_TOKEN_BUDGET")
+    parser.add_argument("--seed", type=int, default=1)
+    run(parser.parse_args())
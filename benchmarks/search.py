@@ -0,0 +1,201 @@
+"""
+/search (src/backend/search.py) on a synthetic SQLite database of millions of messages.
+
+Fills a throwaway database with --messages WhatsApp messages and --orders orders spread over
+--users users, with their search terms, then times the searches /search runs against what
+the same questions cost without the index (LIKE over messages.content and over the JSON of
+order_requirements), and what indexing adds to storing a message in the webhook.
+
+    python benchmarks/search.py --messages 2000000 --orders 200000 --users 10
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/search.db")
+
+from sqlalchemy import select, insert, func, cast, String, text
+from src.backend.database import SessionLocal, create_tables, dispose_engine
+from src.backend.models import User, Client, Order, Message, OrderSearchTerm, MessageSearchTerm
+from src.backend.search import order_terms, message_term_rows, index_message, search_orders, search_messages
+
+PARTS = ["pastillas de freno", "discos de freno", "filtro de aceite", "filtro de aire", "kit de distribución", "bomba de agua", "amortiguadores delanteros", "embrague", "alternador", "correa auxiliar", "radiador", "termostato", "bujías", "batería", "faro delantero"]
+BRANDS = [("SEAT", "Ibiza"), ("Renault", "Clio"), ("Volkswagen", "Golf"), ("Peugeot", "308"), ("Ford", "Focus"), ("Toyota", "Corolla"), ("Citroën", "C4")]
+FILLERS = ["buenas", "cuando lo tendrías?", "vale gracias", "mañana paso a recogerlo", "es urgente, el cliente espera", "te mando foto de la pieza", "ok", "cuánto sería con el montaje?", "lo necesito para el viernes"]
+LETTERS = "BCDFGHJKLMNPRSTVWXYZ"
+BATCH_SIZE = 10000
+
+
+def plate(rng: random.Random) -> str:
+    return f"{rng.randint(0, 9999):04d}{''.join(rng.choice(LETTERS) for _ in range(3))}"
+
+
+def typo(rng: random.Random, value: str) -> str:
+    # A swapped pair or a wrong letter, the mistakes fuzzy plates are for
+    index = rng.randrange(len(value) - 1)
+    if rng.random() < 0.5:
+        return value[:index] + value[index + 1] + value[index] + value[index + 2:]
+    return value[:index] + rng.choice(LETTERS.replace(value[index], "")) + value[index + 1:]
+
+
+def message_text(rng: random.Random, plates: list[str]) -> str:
+    if rng.random() < 0.4:
+        brand, model = rng.choice(BRANDS)
+        car_plate = rng.choice(plates)
+        # Written the way mechanics do, with or without a space
+        if rng.random() < 0.5:
+            car_plate = f"{car_plate[:4]} {car_plate[4:]}"
+        return f"{' y '.join(rng.sample(PARTS, rng.randint(1, 2)))} para el {brand} {model} matrícula {car_plate}"
+    return rng.choice(FILLERS)
+
+
+def percentile(values: list[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def timed(queries: list, run) -> list[float]:
+    seconds = []
+    for query in queries:
+        start = time.perf_counter()
+        await run(query)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def report(name: str, seconds: list[float]):
+    ms = [value * 1000 for value in seconds]
+    print(f"  {name:<34} p50={statistics.median(ms):8.2f}ms p95={percentile(ms, 95):8.2f}ms max={max(ms):8.2f}ms")
+
+
+async def fill(args, rng: random.Random) -> dict:
+    """
+    Users, a client per --clients-per-user, orders and messages, with their search terms.
+    Returns the plates of every user and the seconds spent on the terms.
+    """
+    async with SessionLocal() as db:
+        db.add_all(User(id=user_id, phone_number=f"+34{user_id:09d}", password="") for user_id in range(1, args.users + 1))
+        clients = [(client_id, (client_id - 1) % args.users + 1) for client_id in range(1, args.users * args.clients_per_user + 1)]
+        await db.execute(insert(Client), [{"id": client_id, "user_id": user_id, "phone_number": f"+34{client_id:09d}"} for client_id, user_id in clients])
+        await db.commit()
+
+        plates = {user_id: [plate(rng) for _ in range(max(1, args.orders // args.users))] for user_id in range(1, args.users + 1)}
+        indexing = 0.0
+        for start in range(0, args.orders, BATCH_SIZE):
+            orders = []
+            for order_id in range(start + 1, min(start + BATCH_SIZE, args.orders) + 1):
+                client_id, user_id = rng.choice(clients)
+                brand, model = rng.choice(BRANDS)
+                parts = rng.sample(PARTS, rng.randint(1, 3))
+                orders.append(Order(
+                    id=order_id, client_id=client_id, status=rng.choice(["Esperando precio", "Presupuestado", "Entregado"]),
+                    car_plate=plates[user_id][(order_id - 1) // args.users % len(plates[user_id])], car_frame="", car_brand=brand, car_model=model,
+                    order_requirements=[{part: {"references": [{"part_reference": f"{rng.randint(0, 10**9):010d}", "reference_name": part}]}} for part in parts],
+                    reference_media_files=[],
+                ))
+            await db.execute(insert(Order), [{column: getattr(order, column) for column in ("id", "client_id", "status", "car_plate", "car_frame", "car_brand", "car_model", "order_requirements", "reference_media_files")} for order in orders])
+            started = time.perf_counter()
+            user_of = dict(clients)
+            await db.execute(insert(OrderSearchTerm), [{"user_id": user_of[order.client_id], "order_id": order.id, "kind": kind, "term": term} for order in orders for kind, term in order_terms(order)])
+            indexing += time.perf_counter() - started
+            await db.commit()
+
+        for start in range(0, args.messages, BATCH_SIZE):
+            messages = []
+            for message_id in range(start + 1, min(start + BATCH_SIZE, args.messages) + 1):
+                client_id, user_id = rng.choice(clients)
+                messages.append({"id": message_id, "client_id": client_id, "user_id": user_id, "content": message_text(rng, plates[user_id])})
+            await db.execute(insert(Message), [{"id": message["id"], "client_id": message["client_id"], "content": message["content"]} for message in messages])
+            started = time.perf_counter()
+            await db.execute(insert(MessageSearchTerm), [row for message in messages for row in message_term_rows(message["user_id"], message["id"], message["content"])])
+            indexing += time.perf_counter() - started
+            await db.commit()
+            if (start // BATCH_SIZE) % 50 == 49:
+                print(f"  {start + BATCH_SIZE} messages stored")
+    return {"plates": plates, "indexing": indexing}
+
+
+async def webhook_cost(args, user_id: int, rng: random.Random) -> tuple[list[float], list[float]]:
+    # Storing a message the way the webhook does, one transaction each, without and with its terms
+    without, with_terms = [], []
+    async with SessionLocal() as db:
+        for index in range(args.webhooks * 2):
+            message = Message(client_id=user_id, content=message_text(rng, ["1234BCD"]))
+            start = time.perf_counter()
+            db.add(message)
+            await db.flush()
+            if index % 2:
+                await index_message(db, user_id, message)
+            await db.commit()
+            (with_terms if index % 2 else without).append(time.perf_counter() - start)
+    return without, with_terms
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    await create_tables()
+    start = time.perf_counter()
+    filled = await fill(args, rng)
+    async with SessionLocal() as db:
+        await db.execute(text("ANALYZE"))
+        rows = {
+            "messages": (await db.execute(select(func.count()).select_from(Message))).scalar(),
+            "message_search_terms": (await db.execute(select(func.count()).select_from(MessageSearchTerm))).scalar(),
+            "orders": (await db.execute(select(func.count()).select_from(Order))).scalar(),
+            "order_search_terms": (await db.execute(select(func.count()).select_from(OrderSearchTerm))).scalar(),
+        }
+        size = (await db.execute(text("PRAGMA page_count"))).scalar() * (await db.execute(text("PRAGMA page_size"))).scalar()
+    print(f"dataset            {rows} in {time.perf_counter() - start:.0f}s, database {size / 2**20:.0f} MiB")
+    print(f"indexing           {filled['indexing']:.1f}s of terms for the whole dataset")
+
+    plates = filled["plates"]
+    users = [rng.randint(1, args.users) for _ in range(args.queries)]
+    picked = [(user_id, rng.choice(plates[user_id])) for user_id in users]
+    limit = args.limit + 1  # As /search fetches it
+    searches = {
+        "orders: plate": ([(user_id, car_plate) for user_id, car_plate in picked], lambda db, q: search_orders(db, q[0], q[1], limit=limit)),
+        "orders: plate prefix (4 chars)": ([(user_id, car_plate[:4]) for user_id, car_plate in picked], lambda db, q: search_orders(db, q[0], q[1], limit=limit)),
+        "orders: plate with a typo": ([(user_id, typo(rng, car_plate)) for user_id, car_plate in picked], lambda db, q: search_orders(db, q[0], q[1], limit=limit)),
+        "orders: part, open orders": ([(user_id, rng.choice(["radiador", "bomba agua", "pastillas"])) for user_id in users], lambda db, q: search_orders(db, q[0], q[1], status="Esperando precio", limit=limit)),
+        "messages: plate": ([(user_id, car_plate) for user_id, car_plate in picked], lambda db, q: search_messages(db, q[0], q[1], limit=limit)),
+        "messages: two words": ([(user_id, f"{rng.choice(['radiador', 'embrague', 'termostato'])} {rng.choice(BRANDS)[1]}") for user_id in users], lambda db, q: search_messages(db, q[0], q[1], limit=limit)),
+        "messages: common word": ([(user_id, "urgente") for user_id in users], lambda db, q: search_messages(db, q[0], q[1], limit=limit)),
+    }
+    # The same questions without the index, on fewer queries: every one of them reads the tables
+    baselines = {
+        "orders: plate, LIKE": ([(user_id, car_plate) for user_id, car_plate in picked[:args.baseline_queries]], lambda db, q: db.execute(
+            select(Order).join(Client, Client.id == Order.client_id).where(Client.user_id == q[0], Order.car_plate.startswith(q[1])).order_by(Order.id).limit(limit))),
+        "orders: part, LIKE over JSON": ([(user_id, "radiador") for user_id in users[:args.baseline_queries]], lambda db, q: db.execute(
+            select(Order).join(Client, Client.id == Order.client_id).where(Client.user_id == q[0], Order.status == "Esperando precio", cast(Order.order_requirements, String).like(f"%{q[1]}%")).order_by(Order.id).limit(limit))),
+        "messages: plate, LIKE": ([(user_id, car_plate) for user_id, car_plate in picked[:args.baseline_queries]], lambda db, q: db.execute(
+            select(Message).join(Client, Client.id == Message.client_id).where(Client.user_id == q[0], Message.content.like(f"%{q[1]}%")).order_by(Message.id).limit(limit))),
+    }
+
+    print(f"search             first page of {args.limit}, {args.queries} queries each ({args.baseline_queries} without the index)")
+    async with SessionLocal() as db:
+        for name, (queries, search) in {**searches, **baselines}.items():
+            report(name, await timed(queries, lambda q: search(db, q)))
+
+    without, with_terms = await webhook_cost(args, 1, rng)
+    print(f"webhook store      p50 {statistics.median(without) * 1000:.2f}ms without terms, {statistics.median(with_terms) * 1000:.2f}ms with them")
+    await dispose_engine()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000000)
+    parser.add_argument("--orders", type=int, default=200000)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--clients-per-user", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200, help="searches of each kind")
+    parser.add_argument("--baseline-queries", type=int, default=5, help="searches of each kind without the index")
+    parser.add_argument("--limit", type=int, default=50, help="page size")
+    parser.add_argument("--webhooks", type=int, default=200, help="messages stored with and without their terms")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
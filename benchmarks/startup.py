@@ -0,0 +1,100 @@
+"""
+Startup cost of the app: what `import main` takes and which modules it spends it on
+(`python -X importtime`), and the time from starting hypercorn to its first answer.
+
+Every measure runs in a fresh interpreter, --runs times, and the median is reported.
+--max-import-seconds makes the script fail when importing the app gets slower than that.
+
+    python benchmarks/startup.py --runs 5 --top 10 --max-import-seconds 1.5
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import statistics
+import subprocess
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that used to be imported with the app and are now imported when first used
+LAZY_MODULES = ["openai", "httpx", "PIL", "twilio"]
+
+
+def environment() -> dict:
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/startup.db")
+    env.setdefault("LLM_BACKEND", "stub")
+    return env
+
+
+def import_times(env: dict) -> dict[str, int]:
+    # Cumulative microseconds per module, as printed by -X importtime on stderr
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_to_first_request(env: dict, timeout: float) -> float:
+    port = free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "hypercorn", "main:app", "--bind", f"127.0.0.1:{port}"], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError(f"No answer from hypercorn after {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run(args):
+    env = environment()
+    # The schema is created beforehand, like `python manage.py init-db` does before a deploy
+    subprocess.run([sys.executable, "manage.py", "init-db"], cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+
+    runs = [import_times(env) for _ in range(args.runs)]
+    import_seconds = statistics.median(times["main"] for times in runs) / 1e6
+    print(f"import main        {import_seconds * 1000:.0f}ms (median of {args.runs})")
+    top_level = [name for name in runs[0] if "." not in name and name != "main"]
+    slowest = sorted(top_level, key=lambda name: statistics.median(times.get(name, 0) for times in runs), reverse=True)
+    for name in slowest[:args.top]:
+        print(f"  {name:<16} {statistics.median(times.get(name, 0) for times in runs) / 1000:.0f}ms")
+    imported = [name for name in LAZY_MODULES if name in runs[0]]
+    print(f"lazy modules       {', '.join(imported) + ' imported with the app' if imported else 'not imported'}")
+
+    if not args.skip_server:
+        seconds = [time_to_first_request(env, args.timeout) for _ in range(args.runs)]
+        print(f"first request      {statistics.median(seconds) * 1000:.0f}ms from starting hypercorn (median of {args.runs})")
+
+    if args.max_import_seconds is not None and import_seconds > args.max_import_seconds:
+        print(f"import main took {import_seconds:.2f}s, over --max-import-seconds {args.max_import_seconds}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest top level imports to list")
+    parser.add_argument("--max-import-seconds", type=float, default=None, help="fail when importing the app takes longer")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for hypercorn to answer")
+    parser.add_argument("--skip-server", action="store_true", help="only measure the import")
+    run(parser.parse_args())
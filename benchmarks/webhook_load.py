@@ -0,0 +1,151 @@
+"""
+Load test of /whatsapp/{user_id} with bursts of messages and photos, like mechanics send them.
+
+Runs the app in-process against a throwaway SQLite database with the stub LLM backend
+(LLM_BACKEND=stub, see llm_backends.py) and job workers on the same event loop. Twilio's
+media URLs are answered by a local fake. Reports webhook throughput and latency, event loop
+lag, and what the workers did once the queue drained.
+
+    python benchmarks/webhook_load.py --clients 50 --bursts 2 --burst-size 6 --media-ratio 0.3
+    LLM_STUB_EXTRACTION_LATENCY=fixed:0.2 python benchmarks/webhook_load.py --workers 8
+"""
+import io
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/webhook_load.db")
+os.environ.setdefault("MEDIA_ROOT", tempfile.mkdtemp())
+os.environ.setdefault("LLM_BACKEND", "stub")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+import httpx
+from PIL import Image
+from fastapi import FastAPI
+from fastapi.responses import Response
+from sqlalchemy import select, func
+import main
+import media
+import worker
+from llm_backends import token_usage
+from src.backend.database import SessionLocal, create_tables
+from src.backend.models import Job
+
+
+def fake_twilio_media() -> FastAPI:
+    image = io.BytesIO()
+    Image.new("RGB", (1600, 1200), (120, 90, 60)).save(image, "JPEG", quality=90)
+    app = FastAPI()
+
+    @app.get("/media/{name}")
+    async def get_media(name: str):
+        return Response(image.getvalue(), media_type="image/jpeg")
+
+    return app
+
+
+def percentile(values: list[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(name: str, values: list[float]):
+    ms = [value * 1000 for value in values]
+    print(f"{name:<18} p50={statistics.median(ms):7.1f}ms p95={percentile(ms, 95):7.1f}ms p99={percentile(ms, 99):7.1f}ms max={max(ms):7.1f}ms")
+
+
+async def monitor_loop_lag(stop: asyncio.Event, lags: list[float], interval: float = 0.01):
+    # How late the loop wakes up a sleeper tells how long something else blocked it
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def client_session(client: httpx.AsyncClient, user_id: int, number: int, args, rng: random.Random, latencies: list[float], errors: list[int]):
+    phone_number = f"whatsapp:+34{6 * 10 ** 8 + number:09d}"
+    plate = f"{1000 + number % 9000}{chr(65 + number % 26)}BC"
+    await asyncio.sleep(rng.uniform(0, args.ramp_up))
+    for burst in range(args.bursts):
+        for i in range(args.burst_size):
+            data = {"From": phone_number, "Body": f"pastillas de freno para el {plate}" if i == 0 else "y los discos", "MessageSid": f"SM{number}-{burst}-{i}"}
+            if rng.random() < args.media_ratio:
+                data.update({"NumMedia": "1", "MediaUrl0": f"http://twilio.fake/media/{number}-{burst}-{i}", "MediaContentType0": "image/jpeg"})
+            start = time.perf_counter()
+            response = await client.post(f"/whatsapp/{user_id}", data=data)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+            await asyncio.sleep(rng.uniform(0.2, args.max_gap))
+        await asyncio.sleep(rng.uniform(args.burst_interval / 2, args.burst_interval))
+
+
+async def queue_counts() -> dict:
+    async with SessionLocal() as db:
+        rows = (await db.execute(select(Job.kind, Job.status, func.count()).group_by(Job.kind, Job.status))).all()
+    return {f"{kind}/{status}": count for kind, status, count in rows}
+
+
+async def wait_for_queue(timeout: float) -> float:
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        counts = await queue_counts()
+        if not any(status.endswith(("/pending", "/running")) for status in counts):
+            break
+        await asyncio.sleep(0.5)
+    return time.perf_counter() - start
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    media._http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake_twilio_media()), base_url="http://twilio.fake")
+
+    stop = asyncio.Event()
+    lags, latencies, errors = [], [], []
+    await create_tables()
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            response = await client.post("/register", json={"phone_number": "+34000000000", "password": "benchmark"})
+            user_id = response.json()["user_id"]
+
+            tasks = [asyncio.create_task(monitor_loop_lag(stop, lags))]
+            tasks += [asyncio.create_task(worker.worker_loop(f"benchmark-{i}", stop)) for i in range(args.workers)]
+
+            start = time.perf_counter()
+            await asyncio.gather(*(client_session(client, user_id, number, args, rng, latencies, errors) for number in range(args.clients)))
+            elapsed = time.perf_counter() - start
+            drain = await wait_for_queue(args.drain_timeout) if args.workers else 0.0
+
+            stop.set()
+            await asyncio.gather(*tasks)
+
+    print(f"webhooks           {len(latencies)} in {elapsed:.1f}s, {len(latencies) / elapsed:.1f} req/s, {len(errors)} errors")
+    report("webhook latency", latencies)
+    report("event loop lag", lags)
+    if args.workers:
+        print(f"queue drained      {drain:.1f}s after the last webhook")
+        print(f"jobs               {await queue_counts()}")
+        print(f"LLM calls          {token_usage['calls']}, {token_usage['input_tokens']} input and {token_usage['output_tokens']} output tokens")
+    await media._http_client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=50, help="clients writing at the same time")
+    parser.add_argument("--bursts", type=int, default=2, help="bursts per client")
+    parser.add_argument("--burst-size", type=int, default=6, help="messages per burst")
+    parser.add_argument("--media-ratio", type=float, default=0.3, help="share of messages with a photo")
+    parser.add_argument("--max-gap", type=float, default=1.5, help="max seconds between messages of a burst")
+    parser.add_argument("--burst-interval", type=float, default=10, help="max seconds between bursts of a client")
+    parser.add_argument("--ramp-up", type=float, default=5, help="seconds over which clients start")
+    parser.add_argument("--workers", type=int, default=4, help="job workers on the same event loop, 0 for the webhook alone")
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,137 @@
+import os
+import shutil
+import asyncio
+from sqlalchemy import select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.backend.models import Client, Order, Message, Job, ExtractionCheckpoint, MediaFile
+from src.backend.events import record_event
+from src.backend.search import delete_order_terms, delete_message_terms
+from media import MEDIA_ROOT, encoded_images
+
+# Deleting everything of a user runs as a job (see worker.py) in small batches. Each batch
+# is its own short transaction, so a large account never holds locks long enough to stall
+# the webhook of other users, and the job's result shows the progress as it goes.
+
+DELETE_BATCH_SIZE = int(os.getenv("DELETE_BATCH_SIZE", "1000"))  # Rows per transaction
+DELETE_BATCH_PAUSE = float(os.getenv("DELETE_BATCH_PAUSE", "0"))  # Seconds between batches, to leave room for other writers
+
+
+async def save_progress(db: AsyncSession, job: Job, result: dict):
+    # A new dict so SQLAlchemy sees the JSON column changed
+    job.result = dict(result)
+    await db.commit()
+    if DELETE_BATCH_PAUSE:
+        await asyncio.sleep(DELETE_BATCH_PAUSE)
+
+
+async def next_batch(db: AsyncSession, model, user_id: int, after_id: int) -> list[int]:
+    # Walks the primary key of the user's rows through clients.user_id, one range at a time
+    query = (
+        select(model.id)
+        .join(Client, Client.id == model.client_id)
+        .where(Client.user_id == user_id, model.id > after_id)
+        .order_by(model.id)
+        .limit(DELETE_BATCH_SIZE)
+    )
+    return (await db.execute(query)).scalars().all()
+
+
+async def delete_user_messages(db: AsyncSession, job: Job, user_id: int, result: dict):
+    result.setdefault("messages", 0)
+    result.setdefault("media_files", 0)
+    result.setdefault("derived_files", 0)
+    last_id = 0
+    while ids := await next_batch(db, Message, user_id, last_id):
+        derived = (await db.execute(
+            select(MediaFile.sha256, MediaFile.derived_path).where(MediaFile.message_id.in_(ids), MediaFile.derived_path.is_not(None))
+        )).all()
+        # Attachments and search terms reference their message, so their rows go first
+        await delete_message_terms(db, ids)
+        media_files = await db.execute(delete(MediaFile).where(MediaFile.message_id.in_(ids)))
+        messages = await db.execute(delete(Message).where(Message.id.in_(ids)))
+        result["media_files"] += media_files.rowcount
+        result["messages"] += messages.rowcount
+        record_event(db, user_id, "message.deleted", {"message_ids": ids})
+        last_id = ids[-1]
+        await save_progress(db, job, result)
+        if derived:
+            result["derived_files"] += await remove_derived_copies(db, derived)
+
+
+async def delete_user_orders(db: AsyncSession, job: Job, user_id: int, result: dict):
+    result.setdefault("orders", 0)
+    last_id = 0
+    while ids := await next_batch(db, Order, user_id, last_id):
+        await delete_order_terms(db, ids)
+        deleted = await db.execute(delete(Order).where(Order.id.in_(ids)))
+        result["orders"] += deleted.rowcount
+        record_event(db, user_id, "order.deleted", {"order_ids": ids})
+        last_id = ids[-1]
+        await save_progress(db, job, result)
+    # The extraction checkpoints must not bring the deleted orders back
+    client_ids = select(Client.id).where(Client.user_id == user_id)
+    await db.execute(update(ExtractionCheckpoint).where(ExtractionCheckpoint.client_id.in_(client_ids)).values(orders=[], summary=None))
+    await save_progress(db, job, result)
+
+
+async def remove_derived_copies(db: AsyncSession, derived: list[tuple[str, str]]) -> int:
+    """
+    Unlink the downscaled copies of deleted attachments and drop them from the prompt cache.
+    A copy the same file sent in another message still uses is kept.
+    """
+    paths = {path for _, path in derived}
+    in_use = set((await db.execute(select(MediaFile.derived_path).where(MediaFile.derived_path.in_(paths)))).scalars())
+    for sha256, _ in derived:
+        encoded_images.pop(sha256)
+    return await asyncio.to_thread(remove_files, paths - in_use)
+
+
+def remove_files(paths) -> int:
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass  # Removed with its directory, or never written
+    return removed
+
+
+def remove_media_directory(media_directory: str) -> tuple[int, int]:
+    """
+    Remove a media directory and return how many files and bytes were removed.
+    """
+    files, size = 0, 0
+    for root, _, names in os.walk(media_directory):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+                files += 1
+            except OSError:
+                pass  # Removed by someone else in the meantime
+    shutil.rmtree(media_directory, ignore_errors=True)
+    return files, size
+
+
+async def delete_messages_job(db: AsyncSession, job: Job):
+    # Counts carry over from the batches a failed attempt already committed
+    result = dict(job.result or {})
+    await delete_user_messages(db, job, job.payload["user_id"], result)
+
+
+async def delete_orders_job(db: AsyncSession, job: Job):
+    result = dict(job.result or {})
+    await delete_user_orders(db, job, job.payload["user_id"], result)
+
+
+async def delete_all_job(db: AsyncSession, job: Job):
+    user_id = job.payload["user_id"]
+    result = dict(job.result or {})
+    await delete_user_orders(db, job, user_id, result)
+    await delete_user_messages(db, job, user_id, result)
+
+    # Walking and unlinking files blocks, so it runs in a thread
+    files, size = await asyncio.to_thread(remove_media_directory, os.path.join(MEDIA_ROOT, str(user_id)))
+    result["files"] = result.get("files", 0) + files
+    result["bytes"] = result.get("bytes", 0) + size
+    await save_progress(db, job, result)
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from src.backend.database import SessionLocal
+from src.backend.events import events_after, last_event_id, first_event_id, EVENTS_PAGE_SIZE
+from src.backend.models import Event
+
+# Server-sent events for the dashboards, instead of polling /clients and the orders.
+# One poller per process reads the new rows of the events table, whichever process wrote
+# them (the webhook here, the extraction in the worker), and hands them to the open
+# streams of their user through in-memory queues. An idle stream costs a queue and a
+# heartbeat every EVENTS_HEARTBEAT_SECONDS, no database connection.
+
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "0.5"))  # Seconds between reads of the events table
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))  # Keeps proxies from closing idle streams
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "1000"))  # Events waiting for a slow client before its stream is closed
+EVENTS_GAP_TIMEOUT = float(os.getenv("EVENTS_GAP_TIMEOUT", "10"))  # Seconds a missing id is waited for, its transaction may still commit
+EVENTS_MAX_GAP = int(os.getenv("EVENTS_MAX_GAP", "100"))  # Longer runs of missing ids are jumps of the auto increment, not open transactions
+EVENTS_RETRY_MS = int(os.getenv("EVENTS_RETRY_MS", "3000"))  # Reconnect delay for EventSource
+
+logger = logging.getLogger(__name__)
+
+
+def format_event(event: Event) -> str:
+    data = json.dumps(event.data, ensure_ascii=False, separators=(",", ":"), default=str)
+    return f"id: {event.id}\nevent: {event.kind}\ndata: {data}\n\n"
+
+
+class Subscription:
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.queue = asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self.overflowed = False
+
+    def put(self, event: Event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # The client reconnects with Last-Event-ID and catches up from the table
+            self.overflowed = True
+
+
+class EventBroker:
+    """
+    Reads the events table and fans the new events out to the subscriptions of their user.
+    Ids are given out when rows are inserted but become visible when their transaction
+    commits, so an id missing below a newer one is read again for EVENTS_GAP_TIMEOUT.
+    """
+
+    def __init__(self):
+        self.subscriptions: dict[int, set[Subscription]] = {}
+        self.last_id = 0
+        self.gaps: dict[int, float] = {}  # Missing id -> when it was first missed
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    async def start(self):
+        async with SessionLocal() as db:
+            self.last_id = await last_event_id(db)
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def notify(self):
+        # Called after a commit in this process, so its events go out without waiting for the next poll
+        self.wakeup.set()
+
+    def subscribe(self, user_id: int) -> Subscription:
+        subscription = Subscription(user_id)
+        self.subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self.subscriptions.get(subscription.user_id, set())
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            self.subscriptions.pop(subscription.user_id, None)
+
+    def stats(self) -> dict:
+        return {"users": len(self.subscriptions), "streams": sum(len(subscriptions) for subscriptions in self.subscriptions.values()), "last_id": self.last_id, "gaps": len(self.gaps)}
+
+    async def poll(self):
+        now = time.monotonic()
+        self.gaps = {event_id: since for event_id, since in self.gaps.items() if now - since < EVENTS_GAP_TIMEOUT}
+        async with SessionLocal() as db:
+            while True:
+                events = await events_after(db, self.last_id, include_ids=list(self.gaps))
+                for event in events:
+                    if event.id in self.gaps:
+                        del self.gaps[event.id]
+                    elif event.id > self.last_id:
+                        if event.id - self.last_id - 1 <= EVENTS_MAX_GAP:
+                            self.gaps.update(dict.fromkeys(range(self.last_id + 1, event.id), now))
+                        self.last_id = event.id
+                    for subscription in self.subscriptions.get(event.user_id, ()):
+                        subscription.put(event)
+                if len(events) < EVENTS_PAGE_SIZE:
+                    break
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                # Database hiccups should not end the streams
+                logger.warning("Error while reading events: %s", e)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=EVENTS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+
+broker = EventBroker()
+
+
+async def replay(user_id: int, after_id: int) -> list[Event]:
+    async with SessionLocal() as db:
+        first = await first_event_id(db)
+        if first is not None and after_id + 1 < first:
+            # Events the client missed were purged, it has to fetch everything again and
+            # carry on from the newest event
+            return [Event(id=broker.last_id, kind="resync", data={})]
+        events = []
+        while page := await events_after(db, after_id, user_id=user_id):
+            events += page
+            after_id = page[-1].id
+        return events
+
+
+async def event_stream(user_id: int, last_event_id: int | None):
+    """
+    Server-sent events of a user: the ones after last_event_id first when the client
+    resumes, then live ones, with a comment line as heartbeat.
+    """
+    subscription = broker.subscribe(user_id)
+    try:
+        yield f"retry: {EVENTS_RETRY_MS}\n\n"
+        # Subscribed before reading, so nothing committed in between is lost. Live events
+        # already sent by the replay are skipped.
+        replayed = set()
+        if last_event_id is not None:
+            for event in await replay(user_id, last_event_id):
+                replayed.add(event.id)
+                yield format_event(event)
+        while not (subscription.overflowed and subscription.queue.empty()):
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), timeout=EVENTS_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+                continue
+            if event.id in replayed:
+                continue
+            if replayed and event.id > max(replayed):
+                replayed = set()
+            yield format_event(event)
+    finally:
+        broker.unsubscribe(subscription)
@@ -0,0 +1,311 @@
+import os
+import asyncio
+import logging
+from sqlalchemy import select, true
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from src.backend.models import Client, Order, Message, Job, ExtractionCheckpoint, MediaFile, requirements_of
+from src.backend.jobs import raise_if_cancelled
+from src.backend.events import record_event, order_data as event_order_data, client_owner
+from src.backend.search import index_orders
+from language import call_llm, get_part_references, Order as ExtractedOrder
+from media import media_directory, download_all_media, preprocess_image
+from observability import span
+from prompt_compaction import messages_within_budget, trim_summary
+
+logger = logging.getLogger(__name__)
+
+EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "incremental")  # "incremental" or "full" (re-send the whole conversation)
+EXTRACTION_WINDOW = int(os.getenv("EXTRACTION_WINDOW", "20"))  # Max new messages sent to the LLM per call
+# Order fields the search terms are built from, the plate never changes on an update
+SEARCHED_FIELDS = {"car_brand", "car_model", "car_frame", "order_requirements"}
+
+
+async def fetch_message_media(db: AsyncSession, job: Job):
+    """
+    Download the attachments of a stored message and record them on it.
+    """
+    message = await db.get(Message, job.payload["message_id"])
+    if message is None:
+        logger.info("Message %s no longer exists, skipping media download", job.payload["message_id"])
+        return
+
+    directory = media_directory(job.payload["user_id"], message.client_id)
+    with span("media", "media_download"):
+        downloaded = await download_all_media(job.payload.get("media_urls", []), directory)
+
+    for media in downloaded:
+        if media["mime_type"].startswith("image/"):
+            # Done once here so building prompts is only a lookup
+            with span("media", "image_preprocess"):
+                preprocessed = await asyncio.to_thread(preprocess_image, media["path"], media["sha256"])
+            if preprocessed:
+                media = {**media, **preprocessed, "mime_type": preprocessed["mime_type"] or media["mime_type"]}
+        db.add(MediaFile(message_id=message.id, client_id=message.client_id, **media))
+    # Convert media URLs list to a comma-separated string for storage
+    message.media_urls = ",".join(media["path"] for media in downloaded) if downloaded else None
+    with span("media", "commit"):
+        await db.commit()
+
+
+def normalize_plate(car_plate: str) -> str:
+    return car_plate.replace(" ", "").replace("-", "").upper()
+
+
+def is_empty_order(order_data) -> bool:
+    return order_data.car_brand == "" and order_data.car_model == "" and normalize_plate(order_data.car_plate) == "" and not order_data.order_requirements
+
+
+async def safe_part_references(part_ordered: str, car_brand: str, car_model: str) -> dict:
+    # A failed or timed out search leaves the part without references instead of failing the whole extraction
+    try:
+        return await get_part_references(part_ordered, car_brand, car_model)
+    except Exception as e:
+        logger.warning("Reference search failed for %r: %r", part_ordered, e)
+        return {"references": []}
+
+
+async def lookup_part_references(lookups: set[tuple[str, str, str]]) -> dict[tuple[str, str, str], dict]:
+    """
+    Search the references of (part, car brand, car model) lookups concurrently.
+    """
+    lookups = list(lookups)
+    with span("extraction", "reference_lookups"):
+        results = await asyncio.gather(*(safe_part_references(part_ordered, car_brand, car_model) for part_ordered, car_brand, car_model in lookups))
+    return dict(zip(lookups, results))
+
+
+def known_references(order: Order | None, order_data) -> dict[str, dict]:
+    """
+    References of the parts a stored order already has, from its [{part: references}]. None
+    can be reused when the car's brand or model changed, they were searched for another car.
+    """
+    if order is None:
+        return {}
+    for field in ("car_brand", "car_model"):
+        if getattr(order_data, field) and getattr(order_data, field) != getattr(order, field):
+            return {}
+    return {part: references for requirement in requirements_of(order) for part, references in requirement.items()}
+
+
+def order_changes(order: Order, order_data, requirements: list[dict]) -> dict:
+    """
+    Fields of a stored order that differ from a new extraction. Brand, model and frame the
+    LLM left empty keep their stored value.
+    """
+    changes = {}
+    for field in ("car_brand", "car_model", "car_frame"):
+        value = getattr(order_data, field)
+        if value and value != getattr(order, field):
+            changes[field] = value
+    if requirements != requirements_of(order):
+        changes["order_requirements"] = requirements
+    if order_data.reference_media_files != (order.reference_media_files or []):
+        changes["reference_media_files"] = order_data.reference_media_files
+    return changes
+
+
+async def upsert_orders(db: AsyncSession, client_id: int, orders):
+    """
+    Create or update the orders of a client from the orders returned by the LLM, matched by
+    normalized plate. The client's orders are loaded once, references are only searched for
+    parts an order did not have yet, and an order the new extraction does not change is left
+    as it is. Flushes once, the caller commits.
+    """
+    # The last extraction of a plate wins, as in merge_order_state
+    extracted = {}
+    for order_data in orders:  # Assuming llm_response returns a list of orders
+        # Check if required fields are empty
+        if is_empty_order(order_data):
+            logger.debug("Skipping order with empty fields: %s", order_data)
+            continue
+        extracted[normalize_plate(order_data.car_plate)] = order_data
+    if not extracted:
+        return
+
+    existing = {}
+    for order in (await db.execute(select(Order).where(Order.client_id == client_id).order_by(Order.id))).scalars():
+        # Plates stored before they were normalized still match, the oldest order of a plate is the one updated
+        existing.setdefault(normalize_plate(order.car_plate or ""), order)
+
+    lookups = set()
+    for car_plate, order_data in extracted.items():
+        known_parts = known_references(existing.get(car_plate), order_data)
+        lookups.update((part, order_data.car_brand, order_data.car_model) for part in order_data.order_requirements if part not in known_parts)
+    references = await lookup_part_references(lookups)
+
+    with span("extraction", "upsert"):
+        created, updated = [], []
+        for car_plate, order_data in extracted.items():
+            order = existing.get(car_plate)
+            known_parts = known_references(order, order_data)
+            requirements = [
+                {part: known_parts[part] if part in known_parts else references[(part, order_data.car_brand, order_data.car_model)]}
+                for part in dict.fromkeys(order_data.order_requirements)
+            ]
+            if order is None:
+                order = Order(
+                    status="Esperando precio",
+                    car_frame=order_data.car_frame, # potentially hardcode it in here
+                    car_plate=car_plate,
+                    car_brand=order_data.car_brand,
+                    car_model=order_data.car_model,
+                    order_requirements=requirements,
+                    reference_media_files=order_data.reference_media_files,
+                    client_id=client_id
+                )
+                db.add(order)
+                created.append(order)
+                continue
+            changes = order_changes(order, order_data, requirements)
+            if changes:
+                # A changed order needs a new price
+                changes["status"] = "Esperando precio"
+                for field, value in changes.items():
+                    setattr(order, field, value)
+                updated.append((order, changes))
+        # Inserts and updates go to the database together
+        await db.flush()
+
+        # Pushed to the dashboards (see event_stream.py) once the caller commits, an update only carries what changed
+        if created or updated:
+            user_id = await client_owner(db, client_id)
+            # Search terms of the new orders, and of the changed ones again (see src/backend/search.py)
+            await index_orders(db, user_id, created, replace=False)
+            await index_orders(db, user_id, [order for order, changes in updated if changes.keys() & SEARCHED_FIELDS])
+            for order in created:
+                record_event(db, user_id, "order.created", event_order_data(order))
+            for order, changes in updated:
+                record_event(db, user_id, "order.updated", {"order_id": order.id, "client_id": client_id, **changes})
+    logger.debug(
+        "Upserted orders of client %s: %s new, %s updated, %s unchanged", client_id, len(created), len(updated), len(extracted) - len(created) - len(updated),
+        extra={"reference_lookups": len(lookups)},
+    )
+
+
+def order_to_state(order: Order) -> dict:
+    # Same shape as the orders returned by the LLM, without the part references
+    return {
+        "car_plate": order.car_plate or "",
+        "car_brand": order.car_brand or "",
+        "car_model": order.car_model or "",
+        "car_frame": order.car_frame or "",
+        "order_requirements": [part for requirement in requirements_of(order) for part in requirement],
+        "reference_media_files": order.reference_media_files or [],
+    }
+
+
+def merge_order_state(current_orders: list[dict], orders) -> list[dict]:
+    merged = {normalize_plate(order["car_plate"]): order for order in current_orders}
+    for order_data in orders:
+        if is_empty_order(order_data):
+            continue
+        order = order_data.model_dump()
+        order["car_plate"] = normalize_plate(order["car_plate"])
+        merged[order["car_plate"]] = order
+    return list(merged.values())
+
+
+async def load_checkpoint(db: AsyncSession, client_id: int) -> ExtractionCheckpoint:
+    checkpoint = (await db.execute(select(ExtractionCheckpoint).where(ExtractionCheckpoint.client_id == client_id))).scalars().first()
+    if checkpoint is None:
+        # First incremental run for this client, start from the orders it already has
+        existing_orders = (await db.execute(select(Order).where(Order.client_id == client_id))).scalars().all()
+        checkpoint = ExtractionCheckpoint(client_id=client_id, last_message_id=0, orders=[order_to_state(order) for order in existing_orders])
+        db.add(checkpoint)
+    return checkpoint
+
+
+async def extract_orders_full(db: AsyncSession, client_id: int, job_id: int = None):
+    """
+    Run the LLM over the whole conversation of a client and create or update its orders.
+    """
+    await raise_if_cancelled(job_id)
+    with span("extraction", "load_messages"):
+        all_messages = (await db.execute(
+            select(Message)
+            .where(Message.client_id == client_id)
+            .order_by(Message.id.asc())
+            .options(selectinload(Message.media_files))  # Needed to build the prompt
+        )).scalars().all()
+    if not all_messages:
+        return
+
+    # Photos the orders already point to are only named, and over the token budget the
+    # oldest messages are dropped, see prompt_compaction.py
+    reflected_media = (await db.execute(select(Order.reference_media_files).where(Order.client_id == client_id))).scalars().all()
+    result = await call_llm(all_messages, reflected_media=[path for paths in reflected_media for path in paths or []])
+    if result is None:
+        raise RuntimeError(f"The LLM returned no orders for client {client_id}")
+    # A newer job will send the conversation again, with the messages this one missed
+    await raise_if_cancelled(job_id)
+
+    await upsert_orders(db, client_id, result.orders)
+    # Commit the changes to the database
+    with span("extraction", "commit"):
+        await db.commit()
+
+
+async def extract_orders_incremental(db: AsyncSession, client_id: int, job_id: int = None, upsert_each_window: bool = True, up_to_message_id: int = None):
+    """
+    Send only the messages after the client's checkpoint, in windows of EXTRACTION_WINDOW
+    messages, together with the orders extracted so far, and merge the result. With
+    upsert_each_window=False the windows only build up the checkpoint, and the orders are
+    upserted from it once at the end, so stored orders never see a single window's partial
+    view of them (used by reextract.py, which replays a whole conversation). Messages after
+    up_to_message_id are left to the job queued for them, behind their media download.
+    """
+    checkpoint = await load_checkpoint(db, client_id)
+    while True:
+        # Windows already committed stay, the newer job continues from the checkpoint
+        await raise_if_cancelled(job_id)
+        with span("extraction", "load_messages"):
+            new_messages = (await db.execute(
+                select(Message)
+                .where(Message.client_id == client_id, Message.id > checkpoint.last_message_id)
+                .where(Message.id <= up_to_message_id if up_to_message_id else true())
+                .order_by(Message.id.asc())
+                .limit(EXTRACTION_WINDOW)
+                .options(selectinload(Message.media_files))  # Needed to build the prompt
+            )).scalars().all()
+        if not new_messages:
+            break
+        # Messages past the token budget are left for the next window rather than dropped
+        new_messages = new_messages[:messages_within_budget(new_messages, checkpoint.orders, checkpoint.summary)]
+
+        result = await call_llm(new_messages, current_orders=checkpoint.orders, summary=checkpoint.summary)
+        if result is None:
+            raise RuntimeError(f"The LLM returned no orders for client {client_id}")
+
+        if upsert_each_window:
+            await upsert_orders(db, client_id, result.orders)
+        checkpoint.orders = merge_order_state(checkpoint.orders, result.orders)
+        # Older messages are never sent again, what they said beyond the orders lives on in the summary
+        checkpoint.summary = trim_summary(result.summary)
+        checkpoint.last_message_id = new_messages[-1].id
+        if upsert_each_window:
+            # Orders and checkpoint are committed together so a retry never skips or repeats a window
+            with span("extraction", "commit"):
+                await db.commit()
+
+    if not upsert_each_window:
+        # The merged orders of every window, committed with the checkpoint they come from
+        await upsert_orders(db, client_id, [ExtractedOrder(**order) for order in checkpoint.orders])
+        with span("extraction", "commit"):
+            await db.commit()
+
+
+async def extract_orders_for_client(db: AsyncSession, client_id: int, job_id: int = None, up_to_message_id: int = None):
+    if EXTRACTION_MODE == "full":
+        await extract_orders_full(db, client_id, job_id)
+    else:
+        await extract_orders_incremental(db, client_id, job_id, up_to_message_id=up_to_message_id)
+
+
+async def extract_orders(db: AsyncSession, job: Job):
+    if await db.get(Client, job.client_id) is None:
+        logger.info("Client %s no longer exists, skipping extraction", job.client_id)
+        return
+    # The newest message the job was queued for. A message stored since may still wait for
+    # its fetch_media job, which runs after this one
+    await extract_orders_for_client(db, job.client_id, job.id, (job.payload or {}).get("message_id"))
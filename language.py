@@ -1,101 +1,119 @@
 import sys
 #from utils.chat_loader import ChatWhatsapp, Message
 from src.backend.models import Message
-from openai import OpenAI
-from pydantic import BaseModel
-import json
+from pydantic import BaseModel, Field
+import os
 import asyncio
+import logging
+import mimetypes
+from src.backend.part_cache import part_reference_cache
+from llm_client import openai_semaphore
+from llm_backends import get_backend, token_usage
+from media import image_data_url
+from observability import span, record_llm_call
+from prompt_compaction import compact_prompt, resolve_media_labels
 
-SYSTEM_DEFAULT = "You are an expert at structured data extraction. You will be given unstructured text from a chat with a mechanic asking for quotas on car parts and should convert it into the given structure."
+logger = logging.getLogger(__name__)
+
+SYSTEM_DEFAULT = "You are an expert at structured data extraction. You will be given unstructured text from a chat with a mechanic asking for quotas on car parts and should convert it into the given structure. The messages come one per line as [day/month hour:minute] text, with their attachments cited by file name; use those file names in reference_media_files. In summary, write in a few short sentences what the conversation says that the orders do not capture but later messages may need."
+
+# Used when only the new messages of a conversation are sent together with the orders extracted so far
+SYSTEM_INCREMENTAL = SYSTEM_DEFAULT + " You will also be given, as JSON, the orders already extracted from the earlier messages of the chat, and a summary of those messages. Return only the orders that are new or that the new messages change, with all their fields filled in (keep the requirements already known for an order and add the new ones). Do not return orders that the new messages do not affect. Return the summary updated with the new messages."
 
 def encode_image(image_path):
   import base64
   with open(image_path, "rb") as image_file:
     return base64.b64encode(image_file.read()).decode('utf-8')
 
-OpenAIclient = OpenAI()
-
-
-
-async def message_to_orders(messages: list[Message]):
-
-    # TODO get rid of this in here
-    class Order(BaseModel):
-        car_plate: str
-        car_brand: str
-        car_model: str
-        car_frame: str
-        order_requirements: list[str]
-        reference_media_files: list[str]
-
-    class Orders(BaseModel):
-        orders: list[Order]
-
-    gpt_messages = [{"role": "system", "content": SYSTEM_DEFAULT}]
-
-    user_message = {"role": "user", "content": []}
-    for message in messages:
-        print (str(message))
-        if message.media_urls == None:
-            user_message["content"].append({"type": "text", "text": f"Mensaje del mecánico: {message.content}"})
-        else:
-           image = encode_image(message.media_urls)
-           user_message["content"].extend([
-              {"type":  "text", "text": f"Mensaje del mecánico: {message.content} {message.media_urls} (archivo adjunto)"},
-              {"type": "image_url",  "image_url": { "url":  f"data:image/jpeg;base64,{image}", "detail": "high"}}
-           ]
-           )
-    # TODO maybe change to put the image url instead of passing the base64?
-    gpt_messages.append(user_message)
-    print ("GPT MESSAGES ")
-    # Print content but exclude image_url items
-    for item in gpt_messages[-1]["content"]:
-        if item.get("type") != "image_url":
-            print(item)
-    print ("--------")
-    
-    # Run the OpenAI call in a separate thread to avoid blocking the event loop
-    completion = await asyncio.to_thread(
-        OpenAIclient.beta.chat.completions.parse,
-        model="gpt-4o", 
-        messages=gpt_messages, 
-        response_format=Orders
-    )
-    return completion
-
-
-async def call_llm(messages: list[Message]): # -> list[Order]
-
-    completion = await message_to_orders(messages)
-    if hasattr(completion, 'choices') and len(completion.choices) > 0:
-        # Check the structure of the first choice
-        first_choice = completion.choices[0]
-        # Access the orders from the parsed attribute of the message
-        if hasattr(first_choice, 'message') and hasattr(first_choice.message, 'parsed'):
-            orders = first_choice.message.parsed.orders
-            print (orders)
-            return orders
-        else:
-            print("No orders found in the first choice's message.")
-    else:
-        print("No choices found in the completion response.")
-    return None
+# Catalog file uploaded to OpenAI that part references are searched in. Changing it invalidates the reference cache.
+CATALOG_FILE_ID = os.getenv("CATALOG_FILE_ID", "file-CJ8A4DVQZMiaw5gHgKDFGc")
+VISION_IMAGE_DETAIL = os.getenv("VISION_IMAGE_DETAIL", "auto")  # "low", "high" or "auto"
+PART_REFERENCE_TIMEOUT = float(os.getenv("PART_REFERENCE_TIMEOUT", "60"))  # Seconds per catalog search
 
-async def get_part_references(ordered_part:str):
 
-    # # add this paramters to fn , car_brand, car_model
-    # search_queue =""
-    # if car_brand:
-    #     search_queue += f"Car Brand: {car_brand}   "
+# Structured output of the extraction
+class Order(BaseModel):
+    car_plate: str
+    car_brand: str
+    car_model: str
+    car_frame: str
+    order_requirements: list[str]
+    reference_media_files: list[str]
 
-    # if car_model:
-    #     search_queue += f"Car Model: {car_model}   "
-    # input_prompt = f"Search in the catalog Top3 most relevant \"referencia original\" for this part: {ordered_part}\n\n if there is not any part that is very relevant just return empty",
+class Orders(BaseModel):
+    orders: list[Order]
+    summary: str = Field(description="What the conversation says that the orders do not capture, in a few short sentences")
 
-    # if car_model or car_brand:
-    #     input_prompt = f"Search in the catalog Top3 most relevant \"referencia original\" for this part: {ordered_part}\n\nuse this queue to help your search {queue}\n\n if there is not any part that is very relevant just return empty",
 
-    print ("getting references")
+async def image_content(image: dict) -> list[dict]:
+    # The label first, so the LLM can cite the image in reference_media_files
+    if image["media_file"] is not None:
+        # Downscaled copies made at ingestion, cached as ready-to-send data URLs
+        url = await image_data_url(image["media_file"])
+    else:
+        mime_type = mimetypes.guess_type(image["path"])[0] or "image/jpeg"
+        url = f"data:{mime_type};base64,{await asyncio.to_thread(encode_image, image['path'])}"
+    return [{"type": "text", "text": image["label"]}, {"type": "image_url", "image_url": {"url": url, "detail": image["detail"]}}]
+
+
+async def message_to_orders(messages: list[Message], current_orders: list[dict] | None = None, summary: str | None = None, reflected_media: list[str] | None = None):
+    # Only the new messages are sent when there are orders (and a summary) of the earlier ones
+    system = SYSTEM_DEFAULT if current_orders is None else SYSTEM_INCREMENTAL
+    with span("extraction", "prompt_build"):
+        # One line per message and a token budget, see prompt_compaction.py
+        prompt = compact_prompt(messages, current_orders, summary, reflected_media, detail=VISION_IMAGE_DETAIL)
+        content = [{"type": "text", "text": prompt["text"]}]
+        for image in prompt["images"]:
+            content.extend(await image_content(image))
+    if prompt["dropped_images"] or prompt["dropped_messages"]:
+        logger.info(
+            "Prompt over the token budget, dropped %s images and %s messages", prompt["dropped_images"], prompt["dropped_messages"],
+            extra={"prompt_tokens": prompt["tokens"]},
+        )
+    logger.debug("Prompt: %s", prompt["text"], extra={"prompt_tokens": prompt["tokens"], "images": len(prompt["images"])})
+    gpt_messages = [{"role": "system", "content": system}, {"role": "user", "content": content}]
+
+    async with openai_semaphore:
+        with span("extraction", "llm_call"):
+            try:
+                parsed = await get_backend().extract_orders("gpt-4o", gpt_messages, Orders)
+            except Exception:
+                record_llm_call("extract", 0, 0, "error")
+                raise
+    if parsed is not None:
+        resolve_media_labels(parsed.orders, prompt["media"])
+    return parsed
+
+
+async def call_llm(messages: list[Message], current_orders: list[dict] | None = None, summary: str | None = None, reflected_media: list[str] | None = None) -> Orders | None:
+    """
+    Extract the orders of some messages. Returns the orders and the updated summary of the conversation.
+    """
+    parsed = await message_to_orders(messages, current_orders, summary, reflected_media)
+    if parsed is None:
+        logger.warning("No orders found in the completion response")
+        return None
+    logger.debug("Orders: %s", parsed.orders)
+    return parsed
+
+async def get_part_references(ordered_part: str, car_brand: str = "", car_model: str = ""):
+
+    # The same part is looked up over and over, so searches are cached per catalog file
+    cached = await part_reference_cache.get(CATALOG_FILE_ID, ordered_part, car_brand, car_model)
+    if cached is not None:
+        return cached
+
+    search_queue = ""
+    if car_brand:
+        search_queue += f"Car Brand: {car_brand}   "
+    if car_model:
+        search_queue += f"Car Model: {car_model}   "
+
+    input_prompt = f"Search in the catalog Top3 most relevant \"referencia original\" for this part: {ordered_part}\n\n"
+    if search_queue:
+        input_prompt += f"use this queue to help your search {search_queue}\n\n"
+    input_prompt += "if there is not any part that is very relevant just return empty\n\npart_reference is an alphanumeric code of around 10 characters, reference_name is the natural language name of the part"
+
     reference_format = {
         "type": "json_schema",
         "name": "part_references",
@@ -121,26 +139,27 @@ async def get_part_references(ordered_part:str):
         "strict": True
     }
 
-    # Run the OpenAI call in a separate thread to avoid blocking the event loop
-    response = await asyncio.to_thread(
-        OpenAIclient.responses.create,
-        model="gpt-4o",
-        input=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "input_file",
-                        "file_id": "file-CJ8A4DVQZMiaw5gHgKDFGc",
-                    },
-                    {
-                        "type": "input_text",
-                        "text": f"Search in the catalog Top3 most relevant \"referencia original\" for this part: {ordered_part}\n\n if there is not any part that is very relevant just return empty\n\npart_reference is an alphanumeric code of around 10 characters, reference_name is the natural language name of the part",
-                    },
-                ]
-            }
-        ],
-        text={"format": {"type": "json_schema", "name": "parts_references", "schema": reference_format["schema"]}}
-    )
-    print ("reference search done")
-    return json.loads(response.output_text)
+    input_messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "input_file",
+                    "file_id": CATALOG_FILE_ID,
+                },
+                {
+                    "type": "input_text",
+                    "text": input_prompt,
+                },
+            ]
+        }
+    ]
+    async with openai_semaphore:
+        with span("extraction", "reference_search"):
+            try:
+                references = await get_backend().search_part_references("gpt-4o", input_messages, reference_format["schema"], PART_REFERENCE_TIMEOUT)
+            except Exception:
+                record_llm_call("search", 0, 0, "error")
+                raise
+    await part_reference_cache.set(CATALOG_FILE_ID, ordered_part, car_brand, car_model, references)
+    return references
@@ -0,0 +1,172 @@
+import os
+import re
+import json
+import random
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from pydantic import BaseModel
+from llm_client import open_client, close_client, get_client
+from observability import record_llm_call
+
+logger = logging.getLogger(__name__)
+
+# The LLM calls of language.py go through a backend chosen with LLM_BACKEND:
+#   openai  the OpenAI API (default), see llm_client.py
+#   stub    answers locally after a simulated latency, for load tests and local runs without an API key
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+
+# Stub settings. Latencies are "fixed:0.8", "uniform:0.5,2", "lognormal:<mu>,<sigma>" or "exponential:<mean>" seconds
+LLM_STUB_EXTRACTION_LATENCY = os.getenv("LLM_STUB_EXTRACTION_LATENCY", "lognormal:0.7,0.4")  # Median about 2s
+LLM_STUB_SEARCH_LATENCY = os.getenv("LLM_STUB_SEARCH_LATENCY", "lognormal:1.4,0.3")  # Median about 4s, file search is slower
+LLM_STUB_SEED = int(os.getenv("LLM_STUB_SEED", "0"))
+LLM_STUB_RESPONSES = os.getenv("LLM_STUB_RESPONSES")  # JSON file with canned {"orders": [...], "summary": "...", "references": [...]}
+
+# Tokens used by this process
+token_usage = {"calls": 0, "input_tokens": 0, "output_tokens": 0}
+
+
+def record_usage(call: str, input_tokens: int, output_tokens: int):
+    # call is "extract" or "search", the label of the llm_* metrics
+    token_usage["calls"] += 1
+    token_usage["input_tokens"] += input_tokens or 0
+    token_usage["output_tokens"] += output_tokens or 0
+    record_llm_call(call, input_tokens, output_tokens)
+
+
+class LLMBackend(ABC):
+    """
+    What language.py needs from an LLM: orders extracted from a prompt and references
+    searched in the catalog.
+    """
+
+    @abstractmethod
+    async def extract_orders(self, model: str, messages: list[dict], response_format: type[BaseModel]) -> BaseModel | None:
+        ...
+
+    @abstractmethod
+    async def search_part_references(self, model: str, input_messages: list[dict], schema: dict, timeout: float) -> dict:
+        ...
+
+    def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class OpenAIBackend(LLMBackend):
+
+    async def extract_orders(self, model, messages, response_format):
+        completion = await get_client().beta.chat.completions.parse(model=model, messages=messages, response_format=response_format)
+        if completion.usage:
+            record_usage("extract", completion.usage.prompt_tokens, completion.usage.completion_tokens)
+        if not completion.choices:
+            logger.warning("No choices found in the completion response")
+            return None
+        return completion.choices[0].message.parsed
+
+    async def search_part_references(self, model, input_messages, schema, timeout):
+        response = await get_client().responses.create(
+            model=model,
+            input=input_messages,
+            text={"format": {"type": "json_schema", "name": "parts_references", "schema": schema}},
+            timeout=timeout,
+        )
+        if response.usage:
+            record_usage("search", response.usage.input_tokens, response.usage.output_tokens)
+        return json.loads(response.output_text)
+
+    def open(self):
+        open_client()
+
+    async def close(self):
+        await close_client()
+
+
+def latency_sampler(spec: str, rng: random.Random):
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+    samplers = {
+        "fixed": lambda: values[0],
+        "uniform": lambda: rng.uniform(values[0], values[1]),
+        "lognormal": lambda: rng.lognormvariate(values[0], values[1]),
+        "exponential": lambda: rng.expovariate(1 / values[0]),
+    }
+    if kind not in samplers:
+        raise ValueError(f"Unknown latency distribution: {spec}")
+    return samplers[kind]
+
+
+def prompt_text(messages: list[dict]) -> str:
+    texts = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            texts.append(content)
+        else:
+            texts.extend(part.get("text", "") for part in content if part.get("type") in ("text", "input_text"))
+    return "\n".join(texts)
+
+
+class StubBackend(LLMBackend):
+    """
+    Deterministic local stand-in. Returns one order per Spanish plate found in the prompt (or
+    the canned orders of LLM_STUB_RESPONSES) after a latency drawn from the configured
+    distribution. Token usage is estimated as characters / 4.
+    """
+
+    PLATE = re.compile(r"\b(\d{4})\s?-?([A-Z]{3})\b")
+
+    def __init__(self, extraction_latency: str = LLM_STUB_EXTRACTION_LATENCY, search_latency: str = LLM_STUB_SEARCH_LATENCY, seed: int = LLM_STUB_SEED, responses_file: str = LLM_STUB_RESPONSES):
+        rng = random.Random(seed)
+        self.extraction_latency = latency_sampler(extraction_latency, rng)
+        self.search_latency = latency_sampler(search_latency, rng)
+        self.canned = {}
+        if responses_file:
+            with open(responses_file) as f:
+                self.canned = json.load(f)
+
+    async def extract_orders(self, model, messages, response_format):
+        await asyncio.sleep(self.extraction_latency())
+        prompt = prompt_text(messages)
+        orders = self.canned.get("orders")
+        if orders is None:
+            plates = dict.fromkeys("".join(match) for match in self.PLATE.findall(prompt))
+            orders = [
+                {"car_plate": plate, "car_brand": "", "car_model": "", "car_frame": "", "order_requirements": ["pastillas de freno"], "reference_media_files": []}
+                for plate in plates
+            ]
+        output = {"orders": orders, "summary": self.canned.get("summary", "")}
+        record_usage("extract", len(prompt) // 4, len(json.dumps(output)) // 4)
+        return response_format.model_validate(output)
+
+    async def search_part_references(self, model, input_messages, schema, timeout):
+        await asyncio.wait_for(asyncio.sleep(self.search_latency()), timeout)
+        references = {"references": self.canned.get("references", [{"part_reference": "STUB000001", "reference_name": "pastillas de freno"}])}
+        record_usage("search", len(prompt_text(input_messages)) // 4, len(json.dumps(references)) // 4)
+        return references
+
+
+BACKENDS = {"openai": OpenAIBackend, "stub": StubBackend}
+
+_backend: LLMBackend | None = None
+
+
+def get_backend() -> LLMBackend:
+    global _backend
+    if _backend is None:
+        if LLM_BACKEND not in BACKENDS:
+            raise ValueError(f"Unknown LLM_BACKEND: {LLM_BACKEND}, expected one of {', '.join(BACKENDS)}")
+        _backend = BACKENDS[LLM_BACKEND]()
+    return _backend
+
+
+def open_backend():
+    get_backend().open()
+
+
+async def close_backend():
+    if _backend is not None:
+        await _backend.close()
@@ -0,0 +1,51 @@
+import os
+import asyncio
+
+# One AsyncOpenAI client per process, sharing a keep-alive connection pool.
+# OPENAI_BASE_URL points it at a local stub server for tests and load tests.
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "30"))  # Seconds an idle connection is kept
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))  # Default read timeout of a request
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+# Caps the OpenAI calls in flight in this process, so a burst of messages can't exhaust the rate limits
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+_client: "AsyncOpenAI | None" = None
+
+
+def open_client() -> "AsyncOpenAI":
+    global _client
+    if _client is None:
+        # The openai package takes most of the import time of the app, it is loaded on first use
+        import httpx
+        from openai import AsyncOpenAI
+
+        timeout = httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+        http_client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+            ),
+        )
+        _client = AsyncOpenAI(base_url=OPENAI_BASE_URL, timeout=timeout, max_retries=OPENAI_MAX_RETRIES, http_client=http_client)
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.close()  # Also closes the connection pool
+        _client = None
+
+
+def get_client() -> "AsyncOpenAI":
+    # Opened by the worker and reextract.py, lazily for scripts that don't
+    return open_client()
@@ -1,348 +1,413 @@
 import os
-from fastapi import FastAPI, HTTPException, Depends, Form, Request
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
+import asyncio
+from typing import Literal
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Form, Query, Request, Response, Header
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, update, func, and_
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError  # Add this import at the top of your file
-from src.backend.database import SessionLocal, engine, Base
-from src.backend.schemas import UserCreate, UserLogin, ClientCreate, OrderCreate
-from src.backend.models import User, Client, Order, Message
-from passlib.context import CryptContext
-from jose import JWTError, jwt
+from sqlalchemy.orm import selectinload
+from src.backend.database import get_db, dispose_engine, pool_stats
+from src.backend.schemas import UserCreate, UserLogin, UserResponse, ClientCreate, OrderCreate, ClientResponse, OrderResponse, ClientOrderCount, ClientPage, OrderPage, ClientOrderCountPage, JobResponse, MessageResponse, MessagePage
+from src.backend.models import User, Client, Order, Message, Job
 from pydantic import BaseModel, Field
 #from twilio.rest import Client as TwilioClient
-import requests
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from twilio.twiml.messaging_response import MessagingResponse
-from language import call_llm, get_part_references
+from fastapi.security import OAuth2PasswordRequestForm
+from src.backend.jobs import enqueue_job, enqueue_debounced_job
+from src.backend.events import record_event
+from src.backend.search import index_message, search_orders, search_messages
+from event_stream import broker, event_stream
+from deletion import remove_media_directory
+from media_serving import media_path, media_response, file_contents
+from auth import create_access_token, get_current_user, get_current_user_or_query_token, token_cache
+from passwords import hash_password, verify_password, shutdown_executor
+from src.backend.ttl_cache import TTLCache
+from observability import configure_logging, span, gauges, metrics_response, TracingMiddleware
 
 
 # TODO do this correctly
-TWILIO_SID = os.getenv("TWILIO_SID")
-TWILIO_AUTH = os.getenv("TWILIO_AUTH")
 #twilio_client = Client(TWILIO_SID, TWILIO_AUTH)
 
-# JWT settings
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 120
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_logging()
+    # The schema is created and migrated by `python manage.py init-db`, before the app starts.
+    # The app makes no LLM calls, the backend is opened by worker.py and reextract.py
+    # Reads the events table for the /events streams of this process
+    await broker.start()
+    yield
+    await broker.close()
+    shutdown_executor()
+    await dispose_engine()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-
-# Create the database tables
-
-app = FastAPI()
-
-Base.metadata.create_all(bind=engine)
-
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-# Dependency to get the database session
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-# Function to create JWT token
-def create_access_token(data: dict, expires_delta=None):
-    from datetime import datetime, timedelta
-
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+router = APIRouter()
 
 # Endpoint to register a user
-@app.post("/register")
-async def register(user: UserCreate, db: Session = Depends(get_db)):
-    existing_user = db.query(User).filter(User.phone_number == user.phone_number).first()
+@router.post("/register")
+async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
+    existing_user = (await db.execute(select(User).where(User.phone_number == user.phone_number))).scalars().first()
     if existing_user:
         raise HTTPException(status_code=400, detail="User already exists")
-    hashed_password = pwd_context.hash(user.password)
+    await db.rollback()  # Give the connection back to the pool while the password is hashed
+    hashed_password = await hash_password(user.password)
     new_user = User(phone_number=user.phone_number, password=hashed_password)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
     return {"message": "User registered successfully", "user_id": new_user.id}
 
 # Endpoint to login and get JWT token
-@app.post("/token")
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.phone_number == form_data.username).first()
-    if not user or not pwd_context.verify(form_data.password, user.password):
+@router.post("/token")
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = (await db.execute(select(User).where(User.phone_number == form_data.username))).scalars().first()
+    if not user:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
-    access_token = create_access_token(data={"sub": user.phone_number})
+    user_id, phone_number, hashed_password = user.id, user.phone_number, user.password
+    await db.rollback()  # Give the connection back to the pool while the password is verified
+    valid, new_hash = await verify_password(form_data.password, hashed_password)
+    if not valid:
+        raise HTTPException(status_code=400, detail="Incorrect username or password")
+    if new_hash:
+        # The bcrypt cost factor changed since this password was hashed
+        await db.execute(update(User).where(User.id == user_id).values(password=new_hash))
+        await db.commit()
+    access_token = create_access_token(data={"sub": phone_number})
     return {"access_token": access_token, "token_type": "bearer"}
 
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "200"))
+
+
+def order_filters(status: str | None, car_plate: str | None) -> list:
+    filters = []
+    if status:
+        filters.append(Order.status == status)
+    if car_plate:
+        # Plates are stored without spaces or dashes, a prefix matches "1234" to "1234ABC"
+        plate = car_plate.replace(" ", "").replace("-", "")
+        filters.append(Order.car_plate.startswith(plate, autoescape=True))
+    return filters
+
+
+def page(items: list, limit: int) -> tuple[list, int | None]:
+    # One extra row is fetched to know whether there is a next page
+    if len(items) > limit:
+        items = items[:limit]
+        return items, items[-1].id
+    return items, None
+
+
+def client_response(client: Client, orders: list | None = None) -> ClientResponse:
+    # Built by hand so the lazy orders relationship is never touched
+    return ClientResponse(
+        id=client.id,
+        phone_number=client.phone_number,
+        name=client.name,
+        orders=[OrderResponse.model_validate(order) for order in orders] if orders is not None else None,
+    )
+
+
 # Endpoint to get clients of the logged-in user
-@app.get("/clients")
-async def get_clients(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(status_code=401, detail="Could not validate credentials")
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        phone_number: str = payload.get("sub")
-        if phone_number is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = db.query(User).filter(User.phone_number == phone_number).first()
-    if user is None:
-        raise credentials_exception
-    return user.clients
+@router.get("/clients", response_model=ClientPage)
+async def get_clients(
+    cursor: int = Query(0, ge=0, description="next_cursor of the previous page"),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    status: str | None = Query(None, description="Only clients with an order in this status"),
+    car_plate: str | None = Query(None, description="Only clients with an order whose plate starts with this"),
+    include_orders: bool = Query(False, description="Embed the (filtered) orders of each client"),
+    user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    filters = order_filters(status, car_plate)
+    query = select(Client).where(Client.user_id == user.id, Client.id > cursor).order_by(Client.id).limit(limit + 1)
+    if filters:
+        query = query.where(select(Order.id).where(Order.client_id == Client.id, *filters).exists())
+    if include_orders:
+        # One extra query for the orders of the whole page instead of one per client
+        query = query.options(selectinload(Client.orders.and_(*filters)))
+    clients, next_cursor = page((await db.execute(query)).scalars().all(), limit)
+    items = [client_response(client, sorted(client.orders, key=lambda order: order.id) if include_orders else None) for client in clients]
+    return ClientPage(items=items, next_cursor=next_cursor)
+
+# Endpoint to get clients with how many orders each one has
+@router.get("/clients/order_counts", response_model=ClientOrderCountPage)
+async def get_client_order_counts(
+    cursor: int = Query(0, ge=0, description="next_cursor of the previous page"),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    status: str | None = Query(None, description="Only count orders in this status"),
+    user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    # A single grouped query, clients without orders get a count of 0
+    query = (
+        select(Client.id, Client.phone_number, Client.name, func.count(Order.id).label("order_count"))
+        .outerjoin(Order, and_(Order.client_id == Client.id, *order_filters(status, None)))
+        .where(Client.user_id == user.id, Client.id > cursor)
+        .group_by(Client.id, Client.phone_number, Client.name)
+        .order_by(Client.id)
+        .limit(limit + 1)
+    )
+    rows, next_cursor = page((await db.execute(query)).all(), limit)
+    return ClientOrderCountPage(items=[ClientOrderCount.model_validate(row) for row in rows], next_cursor=next_cursor)
 
 # Endpoint to get orders of a specific client
-@app.get("/clients/{client_id}/orders")
-async def get_orders(client_id: int, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(status_code=401, detail="Could not validate credentials")
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        phone_number: str = payload.get("sub")
-        if phone_number is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = db.query(User).filter(User.phone_number == phone_number).first()
-    if user is None:
-        raise credentials_exception
-    client = db.query(Client).filter(Client.id == client_id, Client.user_id == user.id).first()
+@router.get("/clients/{client_id}/orders", response_model=OrderPage)
+async def get_orders(
+    client_id: int,
+    cursor: int = Query(0, ge=0, description="next_cursor of the previous page"),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    status: str | None = Query(None),
+    car_plate: str | None = Query(None, description="Plate or start of the plate"),
+    user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    client = (await db.execute(select(Client.id).where(Client.id == client_id, Client.user_id == user.id))).scalar()
     if client is None:
         raise HTTPException(status_code=404, detail="Client not found")
-    return client.orders
+    query = (
+        select(Order)
+        .where(Order.client_id == client_id, Order.id > cursor, *order_filters(status, car_plate))
+        .order_by(Order.id)
+        .limit(limit + 1)
+    )
+    orders, next_cursor = page((await db.execute(query)).scalars().all(), limit)
+    return OrderPage(items=[OrderResponse.model_validate(order) for order in orders], next_cursor=next_cursor)
+
+# Search of the user's orders by plate, frame, car, part or reference, or of their messages by
+# their words, through the terms kept in src/backend/search.py
+@router.get("/search", response_model=OrderPage | MessagePage)
+async def search(
+    q: str = Query(..., min_length=1, max_length=200, description="Plate, part, reference or words, each matches the words it starts"),
+    scope: Literal["orders", "messages"] = Query("orders"),
+    status: str | None = Query(None, description="Only orders in this status"),
+    client_id: int | None = Query(None, description="Only orders or messages of this client"),
+    fuzzy: bool = Query(True, description="Also orders whose plate is a typo away from the query"),
+    cursor: int = Query(0, ge=0, description="next_cursor of the previous page"),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    user: UserResponse = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    if scope == "messages":
+        messages, next_cursor = page(await search_messages(db, user.id, q, client_id, cursor, limit + 1), limit)
+        return MessagePage(items=[MessageResponse.model_validate(message) for message in messages], next_cursor=next_cursor)
+    orders, next_cursor = page(await search_orders(db, user.id, q, status, client_id, fuzzy, cursor, limit + 1), limit)
+    return OrderPage(items=[OrderResponse.model_validate(order) for order in orders], next_cursor=next_cursor)
+
+
+# Twilio retries a webhook that is slow or fails, with the same MessageSid. Deliveries already
+# stored get the same reply without storing the message or queueing its jobs again. The set is
+# per process, the unique index on messages.message_sid catches the rest.
+WEBHOOK_SEEN_CACHE_SIZE = int(os.getenv("WEBHOOK_SEEN_CACHE_SIZE", "100000"))
+WEBHOOK_SEEN_TTL_SECONDS = int(os.getenv("WEBHOOK_SEEN_TTL_SECONDS", "3600"))
+seen_messages = TTLCache(maxsize=WEBHOOK_SEEN_CACHE_SIZE, ttl=WEBHOOK_SEEN_TTL_SECONDS)
+
+# Extraction waits until the client stops writing for EXTRACTION_QUIET_SECONDS, and at most
+# EXTRACTION_MAX_DELAY_SECONDS after the first message of the burst
+EXTRACTION_QUIET_SECONDS = float(os.getenv("EXTRACTION_QUIET_SECONDS", "3"))
+EXTRACTION_MAX_DELAY_SECONDS = float(os.getenv("EXTRACTION_MAX_DELAY_SECONDS", "15"))
 
 
 class WhatsAppMessage(BaseModel):
     From: str = Field(..., description="The sender's phone number")
     Body: str = Field("", description="The message body")  # Optional for media-only messages
     NumMedia: int = Field(0, description="Number of media files attached")
+    MessageSid: str | None = Field(None, description="Twilio's id of the message, the same on every retry")
 
 # Dependency to parse form data into the Pydantic model
 async def whatsapp_message(
     From: str = Form(...),
     Body: str = Form(""),
-    NumMedia: int = Form(0)
+    NumMedia: int = Form(0),
+    MessageSid: str | None = Form(None)
 ) -> WhatsAppMessage:
-    return WhatsAppMessage(From=From, Body=Body, NumMedia=NumMedia)
+    return WhatsAppMessage(From=From, Body=Body, NumMedia=NumMedia, MessageSid=MessageSid)
+
+def twiml_reply() -> str:
+    # Imported by the first webhook rather than at startup
+    from twilio.twiml.messaging_response import MessagingResponse
+
+    # Create a response message
+    response = MessagingResponse()
+    response.message("Message and any media received!")
 
-@app.post("/whatsapp/{user_id}")
-async def whatsapp_webhook(user_id: int, request: Request, message: WhatsAppMessage = Depends(whatsapp_message), db: Session = Depends(get_db)):
+    # Return the XML response required by Twilio
+    return str(response)
+
+@router.post("/whatsapp/{user_id}")
+async def whatsapp_webhook(user_id: int, request: Request, message: WhatsAppMessage = Depends(whatsapp_message), db: AsyncSession = Depends(get_db)):
     """
     Webhook endpoint to handle incoming WhatsApp messages, including media.
     """
-    # Gather media URLs if available
+    if message.MessageSid:
+        reply = seen_messages.get(message.MessageSid)
+        if reply is not None:
+            return reply
+
     form_data = await request.form()
 
-    # Gather media URLs if available and download them
-    media_urls = []
-    from datetime import datetime
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     phone_number = message.From.replace("whatsapp:", "")
 
     # TODO IMPORTANT THIS ONLY WORKS WITH ONE USER
-    client = db.query(Client).filter(Client.phone_number == phone_number, Client.user_id == user_id).first()
-    if not client:
-        client = Client(phone_number=phone_number, user_id=user_id)
-        db.add(client)
-        try:
-            db.commit()  # Attempt to commit the new client
-            db.refresh(client)
-        except IntegrityError:
-            db.rollback()  # Rollback if there's an integrity error
-            client = db.query(Client).filter(Client.phone_number == phone_number, Client.user_id == user_id).first()  # Fetch the existing client
-        else:
-            db.refresh(client)  # Refresh the client if successfully added
+    client_query = select(Client).where(Client.phone_number == phone_number, Client.user_id == user_id)
+    with span("webhook", "client_lookup"):
+        client = (await db.execute(client_query)).scalars().first()
+        if not client:
+            client = Client(phone_number=phone_number, user_id=user_id)
+            db.add(client)
+            try:
+                await db.flush()
+                record_event(db, user_id, "client.created", {"client_id": client.id, "phone_number": phone_number})
+                await db.commit()  # Attempt to commit the new client
+            except IntegrityError:
+                await db.rollback()  # Rollback if there's an integrity error
+                client = (await db.execute(client_query)).scalars().first()  # Fetch the existing client
 
     # Store the message
     sanitized_content = message.Body.replace('\xa0', ' ')  # Replace non-breaking spaces with regular spaces
 
-    for i in range(message.NumMedia):
-        media_url = form_data.get(f"MediaUrl{i}")
-        if media_url:
-            media_response = requests.get(media_url, auth=(TWILIO_SID, TWILIO_AUTH))
-            if media_response.status_code == 200:
-                # Determine the file extension based on media type
-                content_type = media_response.headers.get("Content-Type")
-                extension = content_type.split('/')[-1] if content_type else 'bin'  # Default to binary if type is unknown
-
-                filename = f"media/{user_id}/{client.id}/FILE-{current_time}.{extension}"
-
-                directory = os.path.dirname(filename)
-
-                # Check if the directory exists, create if it doesn't
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-                    print(f'Created directory: {directory}')
-
-                with open(filename, "wb") as f:
-                    f.write(media_response.content)
-                print(f"Media downloaded and saved as {filename}")
-
-            media_urls.append(filename)
-
-
-    # Convert media URLs list to a comma-separated string for storage
-    media_urls_str = ",".join(media_urls) if media_urls else None
-
-    new_message = Message(content=sanitized_content, media_urls=media_urls_str, client_id=client.id)
+    new_message = Message(content=sanitized_content, media_urls=None, client_id=client.id, message_sid=message.MessageSid)
     db.add(new_message)
-    db.commit()
-    db.refresh(new_message)
-
-    all_messages = db.query(Message).filter(Message.client_id == client.id).order_by(Message.id.asc()).all()
-
-    orders = await call_llm(all_messages)
-
-    # TODO change that if the order exists, but the list of requirements is different (the stuff changed, or is longer or smth) update it
-    for order_data in orders:  # Assuming llm_response returns a list of orders
-        car_plate = order_data.car_plate.replace(" ", "").replace("-", "")
-
-        # Check if required fields are empty
-        if order_data.car_brand == "" and order_data.car_model == "" and car_plate == "" and not order_data.order_requirements:
-            print(f"Order is new with empty fields: car_plate='{car_plate}' car_brand='{order_data.car_brand}' car_model='{order_data.car_model}' order_requirements={order_data.order_requirements} reference_media_files={order_data.reference_media_files}")
-            # Do not skip, proceed with creating a new order
-            continue
-
-        existing_order = db.query(Order).filter(Order.car_plate == car_plate, Order.client_id == client.id).first()
-        if existing_order:
-            # Update the existing order with new information
-            print(f"this order exists {order_data}")
-            existing_order.status = "Esperando precio"  # Update status or any other fields as needed
-            existing_order.car_brand = order_data.car_brand
-            existing_order.car_frame = order_data.car_frame
-            existing_order.car_model = order_data.car_model
-            existing_order.order_requirements =[{f"{part_ordered}": await get_part_references(part_ordered)} for part_ordered in order_data.order_requirements] if order_data.order_requirements else [],  # Assuming order_details is a dict
-            existing_order.reference_media_files = order_data.reference_media_files  # Update media files if necessary
-        else:
-            # Create a new order if it doesn't exist
-            print(f"this order is new {order_data}")
-            new_order = Order(
-                status="Esperando precio",
-                car_frame=order_data.car_frame, # potentially hardcode it in here
-                car_plate=car_plate,
-                car_brand=order_data.car_brand,
-                car_model=order_data.car_model,
-                order_requirements=[{f"{part_ordered}": await get_part_references(part_ordered)} for part_ordered in order_data.order_requirements] if order_data.order_requirements else [],  # Assuming order_details is a dict
-                reference_media_files=order_data.reference_media_files,
-                client_id=client.id
-            )
-            db.add(new_order)
-
-    # Commit the changes to the database
-    db.commit()
-    # Create a response message
-    response = MessagingResponse()
-    response.message("Message and any media received!")
-
-    # Return the XML response required by Twilio
-    return str(response)
-
-@app.get("/media/{user_id}/{client_id}/{file_name}")
-async def get_media(user_id: str, client_id: str, file_name: str):
-    file_path = f"./media/{user_id}/{client_id}/{file_name}"
-
-    if os.path.exists(file_path):
-
-        return FileResponse(file_path)
+    try:
+        with span("webhook", "store_message"):
+            await db.flush()
+    except IntegrityError:
+        # Stored by another process, or before this one restarted
+        await db.rollback()
+        reply = twiml_reply()
+        seen_messages.set(message.MessageSid, reply)
+        return reply
+
+    # Media download and order extraction are slow, so they run in the worker (worker.py).
+    # Jobs of the same client run in the order they were enqueued, so the media is stored
+    # before the extraction that reads it.
+    media_urls = [form_data.get(f"MediaUrl{i}") for i in range(message.NumMedia)]
+    media_urls = [media_url for media_url in media_urls if media_url]
+    with span("webhook", "search_index"):
+        await index_message(db, user_id, new_message)
+
+    with span("webhook", "enqueue"):
+        if media_urls:
+            enqueue_job(db, "fetch_media", client_id=client.id, payload={"message_id": new_message.id, "user_id": user_id, "media_urls": media_urls})
+        # A burst of messages gets one extraction, once the client has been quiet for a moment
+        await enqueue_debounced_job(
+            db,
+            "extract_orders",
+            client_id=client.id,
+            payload={"message_id": new_message.id},
+            quiet_seconds=EXTRACTION_QUIET_SECONDS,
+            max_delay_seconds=EXTRACTION_MAX_DELAY_SECONDS,
+        )
+
+    record_event(db, user_id, "message.created", {"client_id": client.id, "message_id": new_message.id, "content": sanitized_content, "media": len(media_urls)})
+
+    # The message, its search terms, its jobs and its event are committed together
+    with span("webhook", "commit"):
+        await db.commit()
+    broker.notify()
+
+    reply = twiml_reply()
+    if message.MessageSid:
+        seen_messages.set(message.MessageSid, reply)
+    return reply
+
+@router.get("/media/{user_id}/{client_id}/{file_name}")
+async def get_media(request: Request, user_id: int, client_id: int, file_name: str, user: UserResponse = Depends(get_current_user_or_query_token)):
+    # Users only see their own files
+    file_path = media_path(user_id, client_id, file_name) if user_id == user.id else None
+
+    if file_path and os.path.isfile(file_path):
+        # ETag, Last-Modified, Range and cache headers (see media_serving.py)
+        return await media_response(request, file_path)
     else:
         raise HTTPException(status_code=404, detail="File not found")
 
-@app.delete("/media")
+@router.delete("/media")
 async def delete_media():
     media_directory = "./media"
 
     if os.path.exists(media_directory):
-        for root, dirs, files in os.walk(media_directory, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
-        return {"detail": "All media files have been deleted."}
+        # Walking and unlinking files blocks, so it runs in a thread
+        files, size = await asyncio.to_thread(remove_media_directory, media_directory)
+        return {"detail": "All media files have been deleted.", "files": files, "bytes": size}
     else:
         raise HTTPException(status_code=404, detail="Media directory not found")
 
+async def enqueue_user_job(db: AsyncSession, kind: str, user_id: int) -> dict:
+    job = enqueue_job(db, kind, payload={"user_id": user_id})
+    await db.commit()
+    return {"job_id": job.id, "status_url": f"/jobs/{job.id}"}
+
+# Deletions run in the worker in small batches (see deletion.py), poll /jobs/{job_id} for progress
+@router.delete("/messages", status_code=202)
+async def delete_all_messages(user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    job = await enqueue_user_job(db, "delete_messages", user.id)
+    return {"detail": "The messages of the current user are being deleted.", **job}
+
+@router.delete("/orders", status_code=202)
+async def delete_all_orders(user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    job = await enqueue_user_job(db, "delete_orders", user.id)
+    return {"detail": "The orders of the current user are being deleted.", **job}
+
+@router.delete("/all", status_code=202)
+async def delete_all(user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    job = await enqueue_user_job(db, "delete_all", user.id)
+    return {"detail": "The orders, messages, and media files of the current user are being deleted.", **job}
+
+@router.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: int, user: UserResponse = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    job = await db.get(Job, job_id)
+    if job is None or (job.payload or {}).get("user_id") != user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+# Changes to the user's clients, orders and messages as server-sent events, instead of polling
+@router.get("/events")
+async def events(
+    last_event_id: int | None = Header(None, description="Sent by EventSource when it reconnects, the stream resumes after it"),
+    after: int | None = Query(None, description="Same as Last-Event-ID, for the first connection of a client that kept its last id"),
+    user: UserResponse = Depends(get_current_user_or_query_token),
+    db: AsyncSession = Depends(get_db),
+):
+    # The session of the authentication would otherwise stay open, with its connection, as long as the stream
+    await db.close()
+    return StreamingResponse(
+        event_stream(user.id, last_event_id if last_event_id is not None else after),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.get("/stats")
+async def stats():
+    return {"auth_cache": token_cache.stats(), "webhook_seen_messages": seen_messages.stats(), "db_pool": pool_stats(), "event_streams": broker.stats()}
+
+gauges.add("auth_cache", "Cache of authenticated users", token_cache.stats)
+gauges.add("webhook_seen_messages", "MessageSids answered recently", seen_messages.stats)
+gauges.add("media_file_contents", "Small media files kept in memory", file_contents.stats)
+gauges.add("db_pool", "Database connection pool", pool_stats)
+gauges.add("event_streams", "Open /events streams", broker.stats)
+
+# Prometheus scrape endpoint: stage timings, request and job durations, LLM tokens and cost, caches and pool
+@router.get("/metrics")
+async def metrics():
+    content, content_type = metrics_response()
+    return Response(content, media_type=content_type)
+
+@router.get("/")
+async def root():
+    return {"greeting": "Hello, World!", "message": "Welcome to FastAPI!"}
 
-@app.delete("/messages")
-async def delete_all_messages(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(status_code=401, detail="Could not validate credentials")
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        phone_number: str = payload.get("sub")
-        if phone_number is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-
-    user = db.query(User).filter(User.phone_number == phone_number).first()
-    if user is None:
-        raise credentials_exception
-
-    # Delete all messages for the current user
-    db.query(Message).filter(Message.client.has(user_id=user.id)).delete(synchronize_session=False)
-    db.commit()
-
-    return {"detail": "All messages have been deleted for the current user."}
-
-
-@app.delete("/orders")
-async def delete_all_orders(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(status_code=401, detail="Could not validate credentials")
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        phone_number: str = payload.get("sub")
-        if phone_number is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-
-    user = db.query(User).filter(User.phone_number == phone_number).first()
-    if user is None:
-        raise credentials_exception
-
-    # Delete all orders for the current user's clients
-    db.query(Order).filter(Order.client.has(user_id=user.id)).delete(synchronize_session=False)
-    db.commit()
-
-    return {"detail": "All orders have been deleted for the current user."}
-
-@app.delete("/all")
-async def delete_all(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(status_code=401, detail="Could not validate credentials")
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        phone_number: str = payload.get("sub")
-        if phone_number is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-
-    user = db.query(User).filter(User.phone_number == phone_number).first()
-    if user is None:
-        raise credentials_exception
-
-    # Delete all orders for the current user's clients
-    db.query(Order).filter(Order.client.has(user_id=user.id)).delete(synchronize_session=False)
-
-    # Delete all messages for the current user
-    db.query(Message).filter(Message.client.has(user_id=user.id)).delete(synchronize_session=False)
-
-    # Delete media files
-    media_directory = f"./media/{user.id}"
-    if os.path.exists(media_directory):
-        for root, dirs, files in os.walk(media_directory, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root, name))
 
-    db.commit()
+def create_app() -> FastAPI:
+    """
+    Build the application. Nothing connects here: the database engine and twilio are set
+    up on first use or by the lifespan.
+    """
+    app = FastAPI(lifespan=lifespan)
+    # Trace id, duration and stage timings of every request (see observability.py)
+    app.add_middleware(TracingMiddleware)
+    app.include_router(router)
+    return app
 
-    return {"detail": "All orders, messages, and media files have been deleted for the current user."}
 
-@app.get("/")
-async def root():
-    return {"greeting": "Hello, World!", "message": "Welcome to FastAPI!"}
+# For `hypercorn main:app`
+app = create_app()
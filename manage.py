@@ -0,0 +1,38 @@
+"""
+Maintenance commands, run before starting the app and the worker.
+
+    python manage.py init-db              # create the schema or migrate it to the latest revision
+    python manage.py init-db --revision 0005
+    python manage.py reindex-search       # search terms of every order and message, e.g. after migrating to 0008
+"""
+import asyncio
+import argparse
+from src.backend.database import SessionLocal, create_tables, dispose_engine
+from src.backend.search import rebuild_search_index, SEARCH_REINDEX_BATCH_SIZE
+
+
+async def init_db(args):
+    # Same as `alembic upgrade head`, and stamps databases created before the migrations existed
+    await create_tables(args.revision)
+    await dispose_engine()
+    print(f"Database schema at revision {args.revision}")
+
+
+async def reindex_search(args):
+    async with SessionLocal() as db:
+        counts = await rebuild_search_index(db, args.batch_size)
+    await dispose_engine()
+    print(f"Indexed {counts['orders']} orders and {counts['messages']} messages")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("init-db", help="create or migrate the database schema")
+    command.add_argument("--revision", default="head")
+    command.set_defaults(run=init_db)
+    command = commands.add_parser("reindex-search", help="rebuild the search terms of every order and message")
+    command.add_argument("--batch-size", type=int, default=SEARCH_REINDEX_BATCH_SIZE, help="rows per transaction")
+    command.set_defaults(run=reindex_search)
+    args = parser.parse_args()
+    asyncio.run(args.run(args))
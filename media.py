@@ -0,0 +1,177 @@
+import os
+import uuid
+import base64
+import asyncio
+import hashlib
+import logging
+import mimetypes
+from src.backend.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Download of the Twilio attachments. Files are streamed to disk in chunks and stored
+# under the sha256 of their content, so the same file sent twice is stored once.
+
+TWILIO_SID = os.getenv("TWILIO_SID")
+TWILIO_AUTH = os.getenv("TWILIO_AUTH")
+
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "media")
+MEDIA_CHUNK_SIZE = int(os.getenv("MEDIA_CHUNK_SIZE", str(64 * 1024)))
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(25 * 1024 * 1024)))  # Twilio caps WhatsApp media at 16MB
+MEDIA_DOWNLOAD_TIMEOUT = float(os.getenv("MEDIA_DOWNLOAD_TIMEOUT", "60"))
+MEDIA_MAX_CONNECTIONS = int(os.getenv("MEDIA_MAX_CONNECTIONS", "10"))
+
+# Images are downscaled and recompressed once, at ingestion, and the copy is what the LLM gets
+MEDIA_IMAGE_MAX_SIZE = int(os.getenv("MEDIA_IMAGE_MAX_SIZE", "1024"))  # Longest side in pixels
+MEDIA_IMAGE_QUALITY = int(os.getenv("MEDIA_IMAGE_QUALITY", "80"))  # JPEG quality of the copy
+# The copies go in a .derived directory next to their originals, so they are removed with
+# the media of the client or user. Older copies are all in MEDIA_ROOT/.derived, the
+# deletion jobs unlink them by their derived_path
+MEDIA_DERIVED_DIR_NAME = ".derived"
+ENCODED_IMAGE_CACHE_SIZE = int(os.getenv("ENCODED_IMAGE_CACHE_SIZE", "256"))
+
+# Data URLs of the downscaled images, keyed by the sha256 of the original
+encoded_images = TTLCache(maxsize=ENCODED_IMAGE_CACHE_SIZE, ttl=3600)
+
+# mimetypes picks odd extensions for some common types
+EXTENSIONS = {"image/jpeg": ".jpg", "audio/ogg": ".ogg", "video/mp4": ".mp4"}
+
+_http_client: "httpx.AsyncClient | None" = None
+
+
+def open_http_client() -> "httpx.AsyncClient":
+    # httpx and Pillow are only imported by the code that downloads and preprocesses, not by the web app
+    import httpx
+
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            auth=(TWILIO_SID, TWILIO_AUTH) if TWILIO_SID else None,
+            follow_redirects=True,  # Twilio redirects media URLs to their storage
+            timeout=httpx.Timeout(MEDIA_DOWNLOAD_TIMEOUT),
+            limits=httpx.Limits(max_connections=MEDIA_MAX_CONNECTIONS),
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def media_directory(user_id: int, client_id: int) -> str:
+    return os.path.join(MEDIA_ROOT, str(user_id), str(client_id))
+
+
+def extension_for(mime_type: str) -> str:
+    return EXTENSIONS.get(mime_type) or mimetypes.guess_extension(mime_type) or ".bin"
+
+
+def _remove(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _store(tmp_path: str, path: str) -> bool:
+    # Returns False when the same content was already stored
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, path)
+    return True
+
+
+async def download_media(media_url: str, directory: str) -> dict:
+    """
+    Stream one attachment to `directory`. Returns its path, sha256, mime type and size.
+    """
+    await asyncio.to_thread(os.makedirs, directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f".{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    size_bytes = 0
+
+    try:
+        async with open_http_client().stream("GET", media_url) as response:
+            if response.status_code != 200:
+                # Raising makes the worker retry the job with backoff
+                raise RuntimeError(f"Media download failed with status {response.status_code}: {media_url}")
+            mime_type = response.headers.get("Content-Type", "application/octet-stream").split(";")[0].strip()
+
+            f = await asyncio.to_thread(open, tmp_path, "wb")
+            try:
+                async for chunk in response.aiter_bytes(MEDIA_CHUNK_SIZE):
+                    size_bytes += len(chunk)
+                    if size_bytes > MEDIA_MAX_BYTES:
+                        raise RuntimeError(f"Media larger than {MEDIA_MAX_BYTES} bytes: {media_url}")
+                    digest.update(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+    except BaseException:
+        await asyncio.to_thread(_remove, tmp_path)
+        raise
+
+    sha256 = digest.hexdigest()
+    path = os.path.join(directory, f"{sha256}{extension_for(mime_type)}")
+    stored = await asyncio.to_thread(_store, tmp_path, path)
+    logger.debug("Media %s %s", "downloaded and saved as" if stored else "already stored as", path)
+    return {"path": path, "sha256": sha256, "mime_type": mime_type, "size_bytes": size_bytes}
+
+
+async def download_all_media(media_urls: list[str], directory: str) -> list[dict]:
+    # All attachments of a message are downloaded concurrently, results keep the order of the urls
+    return await asyncio.gather(*(download_media(media_url, directory) for media_url in media_urls))
+
+
+def preprocess_image(path: str, sha256: str) -> dict | None:
+    """
+    Store a downscaled JPEG copy of an image under its content hash, in the .derived directory
+    next to it. Blocking, run it in a thread.
+    Returns None when the file is not an image Pillow can read.
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(path) as image:
+            mime_type = Image.MIME.get(image.format)
+            image = ImageOps.exif_transpose(image)  # Phone photos are often stored rotated
+            width, height = image.size
+            image.thumbnail((MEDIA_IMAGE_MAX_SIZE, MEDIA_IMAGE_MAX_SIZE))
+            derived_directory = os.path.join(os.path.dirname(path), MEDIA_DERIVED_DIR_NAME)
+            derived_path = os.path.join(derived_directory, f"{sha256}.jpg")
+            if not os.path.exists(derived_path):
+                os.makedirs(derived_directory, exist_ok=True)
+                tmp_path = f"{derived_path}.{uuid.uuid4().hex}.part"
+                image.convert("RGB").save(tmp_path, format="JPEG", quality=MEDIA_IMAGE_QUALITY, optimize=True)
+                os.replace(tmp_path, derived_path)
+    except (OSError, Image.DecompressionBombError) as e:
+        logger.warning("Could not preprocess %s: %s", path, e)
+        return None
+
+    return {
+        "mime_type": mime_type,
+        "width": width,
+        "height": height,
+        "derived_path": derived_path,
+        "derived_mime_type": "image/jpeg",
+        "derived_size_bytes": os.path.getsize(derived_path),
+    }
+
+
+def _read_base64(path: str) -> str:
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8")
+
+
+async def image_data_url(media_file) -> str:
+    """
+    Ready-to-send data URL of the downscaled copy of an image, read from disk only on a cache miss.
+    """
+    data_url = encoded_images.get(media_file.sha256)
+    if data_url is None:
+        encoded = await asyncio.to_thread(_read_base64, media_file.derived_path)
+        data_url = f"data:{media_file.derived_mime_type};base64,{encoded}"
+        encoded_images.set(media_file.sha256, data_url)
+    return data_url
@@ -0,0 +1,163 @@
+import os
+import re
+import hashlib
+import mimetypes
+import anyio
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import Request
+from fastapi.responses import Response, FileResponse, StreamingResponse
+from src.backend.ttl_cache import TTLCache
+from media import MEDIA_ROOT
+
+# Serving of the stored attachments to the dashboard. Files are stored under the sha256 of
+# their content and never change, so browsers can cache them for good and revalidate with
+# the hash as ETag. Small files are kept in memory, large ones are streamed from disk.
+
+MEDIA_MEMORY_CACHE_SIZE = int(os.getenv("MEDIA_MEMORY_CACHE_SIZE", "256"))  # Files kept in memory
+MEDIA_MEMORY_CACHE_MAX_FILE_BYTES = int(os.getenv("MEDIA_MEMORY_CACHE_MAX_FILE_BYTES", str(256 * 1024)))
+MEDIA_STREAM_CHUNK_SIZE = int(os.getenv("MEDIA_STREAM_CHUNK_SIZE", str(256 * 1024)))
+MEDIA_MAX_AGE_SECONDS = 365 * 24 * 3600
+
+# Content-addressed names, e.g. 9f86d0...0f00a08.jpg
+HASHED_NAME = re.compile(r"^([0-9a-f]{64})\.[A-Za-z0-9]{1,10}$")
+# Anything else stored before files were content-addressed, e.g. FILE-2025-03-18 10:22:33.jpeg
+SAFE_NAME = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.: -]{0,254}$")
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# Small file contents and the hashes of legacy file names, keyed by (path, mtime, size)
+file_contents = TTLCache(maxsize=MEDIA_MEMORY_CACHE_SIZE, ttl=3600)
+file_hashes = TTLCache(maxsize=10000, ttl=24 * 3600)
+
+
+def media_path(user_id: int, client_id: int, file_name: str) -> str | None:
+    """
+    Path of a stored file, or None when the name could escape the media directory.
+    """
+    if not SAFE_NAME.match(file_name):
+        return None
+    root = os.path.realpath(MEDIA_ROOT)
+    path = os.path.realpath(os.path.join(root, str(user_id), str(client_id), file_name))
+    if os.path.dirname(path) != os.path.join(root, str(user_id), str(client_id)):
+        return None  # A symlink pointing somewhere else
+    return path
+
+
+def _hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(MEDIA_STREAM_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+async def file_etag(path: str, key: tuple) -> str:
+    match = HASHED_NAME.match(os.path.basename(path))
+    if match:
+        return f'"{match.group(1)}"'
+    digest = file_hashes.get(key)
+    if digest is None:
+        digest = await anyio.to_thread.run_sync(_hash_file, path)
+        file_hashes.set(key, digest)
+    return f'"{digest}"'
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, W/"x" matches "x"
+    if header.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == etag for candidate in header.split(","))
+
+
+def not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when If-None-Match is sent
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def byte_range(request: Request, etag: str, size: int) -> tuple[int, int] | None | bool:
+    """
+    The (start, end) requested by a single Range header, None to send the whole file
+    and False when the range can't be satisfied.
+    """
+    header = request.headers.get("range")
+    if not header:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range.strip() != etag:
+        return None  # The client's copy is outdated, it gets the whole file
+    match = RANGE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None  # Multiple or malformed ranges, the whole file is a valid answer
+    start, end = match.groups()
+    if start == "":
+        # bytes=-500 is the last 500 bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+async def stream_file(path: str, start: int, end: int):
+    async with await anyio.open_file(path, "rb") as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(MEDIA_STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def read_small_file(path: str, key: tuple) -> bytes:
+    content = file_contents.get(key)
+    if content is None:
+        content = await anyio.Path(path).read_bytes()
+        file_contents.set(key, content)
+    return content
+
+
+async def media_response(request: Request, path: str) -> Response:
+    stat = await anyio.Path(path).stat()
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    etag = await file_etag(path, key)
+    immutable = HASHED_NAME.match(os.path.basename(path)) is not None
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        # private: the files are only served to their owner
+        "Cache-Control": f"private, max-age={MEDIA_MAX_AGE_SECONDS}, immutable" if immutable else "private, no-cache",
+        "Accept-Ranges": "bytes",
+    }
+    if not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    size = stat.st_size
+    requested = byte_range(request, etag, size)
+    if requested is False:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    start, end = requested or (0, size - 1)
+    status_code = 206 if requested else 200
+    if requested:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    if size <= MEDIA_MEMORY_CACHE_MAX_FILE_BYTES:
+        content = await read_small_file(path, key)
+        return Response(content[start:end + 1], status_code=status_code, media_type=media_type, headers=headers)
+    if not requested:
+        # Whole large files are streamed by FileResponse. Neither Starlette 0.27 nor Hypercorn
+        # offer a sendfile extension, so chunked reads off the event loop is as close as it gets
+        return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(stream_file(path, start, end), status_code=206, media_type=media_type, headers=headers)
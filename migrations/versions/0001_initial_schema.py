@@ -0,0 +1,70 @@
+"""initial schema
+
+The users, clients, orders and messages tables as Base.metadata.create_all built them
+before migrations were added.
+Databases created that way are stamped at this revision by create_tables.
+
+Revision ID: 0001
+Revises: 
+Create Date: 2026-10-18 19:18:21
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('users',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('phone_number', sa.String(length=25), nullable=True),
+    sa.Column('password', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_users_id'), 'users', ['id'], unique=False)
+    op.create_index(op.f('ix_users_phone_number'), 'users', ['phone_number'], unique=True)
+
+    op.create_table('clients',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('phone_number', sa.String(length=25), nullable=True),
+    sa.Column('name', sa.String(length=50), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_clients_id'), 'clients', ['id'], unique=False)
+
+    op.create_table('messages',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('content', sa.String(length=255), nullable=True),
+    sa.Column('media_urls', sa.String(length=255), nullable=True),
+    sa.Column('client_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['client_id'], ['clients.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_messages_id'), 'messages', ['id'], unique=False)
+
+    op.create_table('orders',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=125), nullable=True),
+    sa.Column('car_plate', sa.String(length=20), nullable=True),
+    sa.Column('car_frame', sa.String(length=20), nullable=True),
+    sa.Column('car_brand', sa.String(length=125), nullable=True),
+    sa.Column('car_model', sa.String(length=125), nullable=True),
+    sa.Column('order_requirements', sa.JSON(), nullable=True),
+    sa.Column('reference_media_files', sa.JSON(), nullable=True),
+    sa.Column('client_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['client_id'], ['clients.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_orders_id'), 'orders', ['id'], unique=False)
+
+
+def downgrade():
+    # Dropping a table drops its indexes
+    for table in ["orders", "messages", "clients", "users"]:
+        op.drop_table(table)
@@ -0,0 +1,101 @@
+"""background worker tables
+
+The jobs, extraction_checkpoints, part_references and media_files tables that came with
+the background worker, after the schema that 0001 describes. Databases created with
+create_all while these tables already existed are stamped at 0001 too, so only the
+missing tables are created.
+
+Revision ID: 0001a
+Revises: 0001
+Create Date: 2026-10-18 19:18:21
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001a'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+    if 'part_references' not in existing:
+        op.create_table('part_references',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('cache_key', sa.String(length=64), nullable=True),
+        sa.Column('catalog_file_id', sa.String(length=100), nullable=True),
+        sa.Column('part_name', sa.String(length=255), nullable=True),
+        sa.Column('car_brand', sa.String(length=125), nullable=True),
+        sa.Column('car_model', sa.String(length=125), nullable=True),
+        sa.Column('references', sa.JSON(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_part_references_cache_key'), 'part_references', ['cache_key'], unique=True)
+        op.create_index(op.f('ix_part_references_catalog_file_id'), 'part_references', ['catalog_file_id'], unique=False)
+        op.create_index(op.f('ix_part_references_id'), 'part_references', ['id'], unique=False)
+
+    if 'extraction_checkpoints' not in existing:
+        op.create_table('extraction_checkpoints',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('client_id', sa.Integer(), nullable=True),
+        sa.Column('last_message_id', sa.Integer(), nullable=True),
+        sa.Column('orders', sa.JSON(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['client_id'], ['clients.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('client_id')
+        )
+        op.create_index(op.f('ix_extraction_checkpoints_id'), 'extraction_checkpoints', ['id'], unique=False)
+
+    if 'jobs' not in existing:
+        op.create_table('jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=50), nullable=True),
+        sa.Column('client_id', sa.Integer(), nullable=True),
+        sa.Column('payload', sa.JSON(), nullable=True),
+        sa.Column('status', sa.String(length=20), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=True),
+        sa.Column('max_attempts', sa.Integer(), nullable=True),
+        sa.Column('run_after', sa.DateTime(), nullable=True),
+        sa.Column('locked_by', sa.String(length=100), nullable=True),
+        sa.Column('locked_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['client_id'], ['clients.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_jobs_client_id'), 'jobs', ['client_id'], unique=False)
+        op.create_index(op.f('ix_jobs_id'), 'jobs', ['id'], unique=False)
+        op.create_index(op.f('ix_jobs_status'), 'jobs', ['status'], unique=False)
+
+    if 'media_files' not in existing:
+        op.create_table('media_files',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('message_id', sa.Integer(), nullable=True),
+        sa.Column('client_id', sa.Integer(), nullable=True),
+        sa.Column('sha256', sa.String(length=64), nullable=True),
+        sa.Column('path', sa.String(length=255), nullable=True),
+        sa.Column('mime_type', sa.String(length=100), nullable=True),
+        sa.Column('size_bytes', sa.Integer(), nullable=True),
+        sa.Column('width', sa.Integer(), nullable=True),
+        sa.Column('height', sa.Integer(), nullable=True),
+        sa.Column('derived_path', sa.String(length=255), nullable=True),
+        sa.Column('derived_mime_type', sa.String(length=100), nullable=True),
+        sa.Column('derived_size_bytes', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['client_id'], ['clients.id'], ),
+        sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.create_index(op.f('ix_media_files_id'), 'media_files', ['id'], unique=False)
+        op.create_index(op.f('ix_media_files_message_id'), 'media_files', ['message_id'], unique=False)
+        op.create_index(op.f('ix_media_files_sha256'), 'media_files', ['sha256'], unique=False)
+
+
+def downgrade():
+    # Dropping a table drops its indexes
+    for table in ["media_files", "jobs", "extraction_checkpoints", "part_references"]:
+        op.drop_table(table)
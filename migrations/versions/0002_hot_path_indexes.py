@@ -0,0 +1,70 @@
+"""indexes for the webhook and extraction lookups
+
+Adds the unique (user_id, phone_number) index on clients that the webhook's
+IntegrityError fallback relies on, plus composite indexes for orders by plate and
+messages by client. Duplicate clients created before the unique index existed are
+merged into the oldest one first.
+
+Revision ID: 0002
+Revises: 0001a
+Create Date: 2026-10-18 19:30:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0002'
+down_revision = '0001a'
+branch_labels = None
+depends_on = None
+
+# Tables whose client_id has to follow a merged client
+CLIENT_CHILD_TABLES = ["orders", "messages", "jobs", "media_files"]
+
+
+def merge_duplicate_clients():
+    connection = op.get_bind()
+    duplicates = connection.execute(sa.text(
+        "SELECT user_id, phone_number, MIN(id) FROM clients"
+        " GROUP BY user_id, phone_number HAVING COUNT(*) > 1"
+    )).all()
+    for user_id, phone_number, keep_id in duplicates:
+        merged_ids = connection.execute(
+            sa.text("SELECT id FROM clients WHERE user_id = :user_id AND phone_number = :phone_number AND id != :keep_id"),
+            {"user_id": user_id, "phone_number": phone_number, "keep_id": keep_id},
+        ).scalars().all()
+        statement_ids = sa.bindparam("merged_ids", expanding=True)
+        for table in CLIENT_CHILD_TABLES:
+            connection.execute(
+                sa.text(f"UPDATE {table} SET client_id = :keep_id WHERE client_id IN :merged_ids").bindparams(statement_ids),
+                {"keep_id": keep_id, "merged_ids": merged_ids},
+            )
+        # The merged conversation is extracted again from the start
+        connection.execute(
+            sa.text("DELETE FROM extraction_checkpoints WHERE client_id IN :client_ids").bindparams(sa.bindparam("client_ids", expanding=True)),
+            {"client_ids": [keep_id, *merged_ids]},
+        )
+        connection.execute(
+            sa.text("DELETE FROM clients WHERE id IN :merged_ids").bindparams(statement_ids),
+            {"merged_ids": merged_ids},
+        )
+
+
+def upgrade():
+    merge_duplicate_clients()
+    op.create_index('uq_clients_user_id_phone_number', 'clients', ['user_id', 'phone_number'], unique=True)
+    op.create_index('ix_orders_client_id_car_plate', 'orders', ['client_id', 'car_plate'], unique=False)
+    op.create_index('ix_messages_client_id_id', 'messages', ['client_id', 'id'], unique=False)
+
+
+def downgrade():
+    # MySQL needs an index on every foreign key column and drops its own once a composite
+    # index covers the column, so single column indexes go back before the drop
+    mysql = op.get_bind().dialect.name == "mysql"
+    for table, index_name, column in [
+        ("messages", "ix_messages_client_id_id", "client_id"),
+        ("orders", "ix_orders_client_id_car_plate", "client_id"),
+        ("clients", "uq_clients_user_id_phone_number", "user_id"),
+    ]:
+        if mysql:
+            op.create_index(f"ix_{table}_{column}", table, [column], unique=False)
+        op.drop_index(index_name, table_name=table)
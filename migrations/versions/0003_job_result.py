@@ -0,0 +1,25 @@
+"""job result
+
+Jobs that report progress, like the batched deletions, store it in jobs.result.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 20:05:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('jobs') as batch_op:
+        batch_op.add_column(sa.Column('result', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('jobs') as batch_op:
+        batch_op.drop_column('result')
@@ -0,0 +1,28 @@
+"""message sid
+
+Twilio's MessageSid on messages, unique so retried webhook deliveries are stored once.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 20:40:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.add_column(sa.Column('message_sid', sa.String(length=64), nullable=True))
+    # Messages stored before have no sid, unique indexes allow any number of NULLs
+    op.create_index(op.f('ix_messages_message_sid'), 'messages', ['message_sid'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_messages_message_sid'), table_name='messages')
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_column('message_sid')
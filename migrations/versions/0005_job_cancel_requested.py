@@ -0,0 +1,25 @@
+"""job cancel requested
+
+Set on a running job when a newer job of the same kind and client supersedes it.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 21:10:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('jobs') as batch_op:
+        batch_op.add_column(sa.Column('cancel_requested', sa.Boolean(), nullable=True, server_default=sa.false()))
+
+
+def downgrade():
+    with op.batch_alter_table('jobs') as batch_op:
+        batch_op.drop_column('cancel_requested')
@@ -0,0 +1,30 @@
+"""message text and conversation summary
+
+messages.content becomes TEXT, String(255) cut long messages. extraction_checkpoints.summary
+keeps what the earlier messages of a conversation said beyond the orders.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 22:40:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.alter_column('content', existing_type=sa.String(length=255), type_=sa.Text(), existing_nullable=True)
+    with op.batch_alter_table('extraction_checkpoints') as batch_op:
+        batch_op.add_column(sa.Column('summary', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('extraction_checkpoints') as batch_op:
+        batch_op.drop_column('summary')
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.alter_column('content', existing_type=sa.Text(), type_=sa.String(length=255), existing_nullable=True)
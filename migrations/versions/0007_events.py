@@ -0,0 +1,37 @@
+"""events
+
+Changes pushed to the dashboards over /events, written in the transaction that makes them.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 23:20:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('events',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('kind', sa.String(length=50), nullable=True),
+    sa.Column('data', sa.JSON(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_events_id'), 'events', ['id'], unique=False)
+    op.create_index(op.f('ix_events_created_at'), 'events', ['created_at'], unique=False)
+    op.create_index('ix_events_user_id_id', 'events', ['user_id', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_events_user_id_id', table_name='events')
+    op.drop_index(op.f('ix_events_created_at'), table_name='events')
+    op.drop_index(op.f('ix_events_id'), table_name='events')
+    op.drop_table('events')
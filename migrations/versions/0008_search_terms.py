@@ -0,0 +1,52 @@
+"""search terms
+
+Normalized terms of orders (plates and their trigrams, frame, car, parts and part
+references) and words of messages, kept up to date with them, for /search. Existing
+orders and messages are indexed by `python manage.py reindex-search`.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-19 01:10:00
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('order_search_terms',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('order_id', sa.Integer(), nullable=True),
+    sa.Column('kind', sa.String(length=20), nullable=True),
+    sa.Column('term', sa.String(length=64), nullable=True),
+    sa.ForeignKeyConstraint(['order_id'], ['orders.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_order_search_terms_order_id'), 'order_search_terms', ['order_id'], unique=False)
+    op.create_index('ix_order_search_terms_user_id_kind_term', 'order_search_terms', ['user_id', 'kind', 'term', 'order_id'], unique=False)
+    op.create_table('message_search_terms',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('message_id', sa.Integer(), nullable=True),
+    sa.Column('term', sa.String(length=64), nullable=True),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_message_search_terms_message_id'), 'message_search_terms', ['message_id'], unique=False)
+    op.create_index('ix_message_search_terms_user_id_term', 'message_search_terms', ['user_id', 'term', 'message_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_message_search_terms_user_id_term', table_name='message_search_terms')
+    op.drop_index(op.f('ix_message_search_terms_message_id'), table_name='message_search_terms')
+    op.drop_table('message_search_terms')
+    op.drop_index('ix_order_search_terms_user_id_kind_term', table_name='order_search_terms')
+    op.drop_index(op.f('ix_order_search_terms_order_id'), table_name='order_search_terms')
+    op.drop_table('order_search_terms')
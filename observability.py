@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from prometheus_client import Counter, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+
+# Logging, timing spans and Prometheus metrics shared by the app, the worker and the CLIs.
+# Every log line of a request or job carries its trace id, and span() times a stage of the
+# pipeline into the stage_seconds histogram.
+
+logger = logging.getLogger("http")
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" or "text"
+
+# USD per million tokens, defaults are gpt-4o's list prices
+LLM_INPUT_COST_PER_MTOK = float(os.getenv("LLM_INPUT_COST_PER_MTOK", "2.5"))
+LLM_OUTPUT_COST_PER_MTOK = float(os.getenv("LLM_OUTPUT_COST_PER_MTOK", "10"))
+
+# Id of the request or job being handled, and the stages it went through
+trace_id: ContextVar[str | None] = ContextVar("trace_id", default=None)
+trace_spans: ContextVar[list | None] = ContextVar("trace_spans", default=None)
+
+STAGE_SECONDS = Histogram(
+    "stage_seconds",
+    "Time spent in each stage of the webhook, media and extraction pipelines",
+    ["pipeline", "stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+HTTP_REQUEST_SECONDS = Histogram("http_request_seconds", "HTTP request duration", ["method", "route", "status"])
+JOB_SECONDS = Histogram(
+    "job_seconds",
+    "Duration of the jobs run by the worker",
+    ["kind", "outcome"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+LLM_CALLS = Counter("llm_calls_total", "LLM calls", ["call", "outcome"])
+LLM_TOKENS = Counter("llm_tokens_total", "LLM tokens used", ["call", "direction"])
+LLM_COST = Counter("llm_cost_usd_total", "Estimated LLM spend in USD", ["call"])
+
+
+class JsonFormatter(logging.Formatter):
+    # Attributes every LogRecord has, anything else was passed with extra={...}
+    RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if trace_id.get():
+            entry["trace_id"] = trace_id.get()
+        entry.update({key: value for key, value in vars(record).items() if key not in self.RESERVED})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+    # Chatty at INFO: a line per pool event and per outgoing request
+    for name in ("sqlalchemy", "src.backend.database.TimedQueuePool", "httpx"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+@contextmanager
+def trace(new_trace_id: str | None = None):
+    """
+    Start a trace for a request or a job. span() calls inside it are collected and can be
+    logged together with trace_summary().
+    """
+    id_token = trace_id.set(new_trace_id or uuid.uuid4().hex[:16])
+    spans_token = trace_spans.set([])
+    try:
+        yield trace_id.get()
+    finally:
+        trace_id.reset(id_token)
+        trace_spans.reset(spans_token)
+
+
+@contextmanager
+def span(pipeline: str, stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(pipeline, stage).observe(elapsed)
+        spans = trace_spans.get()
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+
+def trace_summary() -> dict:
+    # Stages that ran more than once, e.g. one reference lookup per part, are added up
+    stages = {}
+    for stage, elapsed in trace_spans.get() or []:
+        stages[stage] = stages.get(stage, 0.0) + elapsed
+    return {f"{stage}_ms": round(elapsed * 1000, 2) for stage, elapsed in stages.items()}
+
+
+def record_llm_call(call: str, input_tokens: int, output_tokens: int, outcome: str = "ok"):
+    LLM_CALLS.labels(call, outcome).inc()
+    LLM_TOKENS.labels(call, "input").inc(input_tokens or 0)
+    LLM_TOKENS.labels(call, "output").inc(output_tokens or 0)
+    LLM_COST.labels(call).inc(((input_tokens or 0) * LLM_INPUT_COST_PER_MTOK + (output_tokens or 0) * LLM_OUTPUT_COST_PER_MTOK) / 1_000_000)
+
+
+class CallbackGauges:
+    """
+    Gauges read when Prometheus scrapes, from functions returning a dict of numbers, e.g.
+    the stats() of the caches and the database pool.
+    """
+
+    def __init__(self):
+        self.sources = {}
+
+    def add(self, name: str, description: str, stats):
+        self.sources[name] = (description, stats)
+
+    def collect(self):
+        for name, (description, stats) in self.sources.items():
+            gauge = GaugeMetricFamily(name, description, labels=["stat"])
+            for stat, value in stats().items():
+                if isinstance(value, (int, float)):
+                    gauge.add_metric([stat], value)
+            yield gauge
+
+
+gauges = CallbackGauges()
+REGISTRY.register(gauges)
+
+
+def metrics_response() -> tuple[bytes, str]:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware that gives every request a trace id (X-Request-ID, kept when the client
+    sends one), observes http_request_seconds by route and logs one line per request with the
+    time of each stage it went through.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        status = 500
+
+        with trace(headers.get(b"x-request-id", b"").decode("latin-1")[:64] or None) as request_id:
+            async def send_with_request_id(message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+                await send(message)
+
+            start = time.perf_counter()
+            try:
+                await self.app(scope, receive, send_with_request_id)
+            finally:
+                elapsed = time.perf_counter() - start
+                route = scope.get("route")
+                path = route.path if route is not None else "unmatched"
+                HTTP_REQUEST_SECONDS.labels(scope["method"], path, str(status)).observe(elapsed)
+                logger.info(
+                    "%s %s %s", scope["method"], path, status,
+                    extra={"method": scope["method"], "route": path, "status": status, "duration_ms": round(elapsed * 1000, 2), **trace_summary()},
+                )
@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import math
+import mimetypes
+from src.backend.models import Message
+from media import MEDIA_IMAGE_MAX_SIZE
+
+# Builds the user prompt of the extraction from a list of messages, as small as it can be:
+# one line per message with its time, attachments cited by a short name instead of their
+# path, no images the orders already point to, older images at low detail, and a token
+# budget that drops the oldest images and then the oldest messages when it is exceeded.
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "8000"))  # Estimated tokens of the user prompt
+PROMPT_RECENT_IMAGES = int(os.getenv("PROMPT_RECENT_IMAGES", "4"))  # Newest images sent at VISION_IMAGE_DETAIL, older ones at low detail
+PROMPT_SUMMARY_MAX_CHARS = int(os.getenv("PROMPT_SUMMARY_MAX_CHARS", "2000"))  # Longer summaries are cut when stored
+
+# Image tokens as OpenAI counts them: a flat 85 at low detail, otherwise 85 plus 170 per
+# 512px tile once the image is fit in 2048x2048 and its short side scaled to 768
+LOW_DETAIL_TOKENS = 85
+TILE_TOKENS = 170
+
+# Names of the content-addressed files, media/<user>/<client>/<sha256>.<ext> (see media.download_media)
+SHA256_NAME = re.compile(r"^[0-9a-f]{64}$")
+
+
+def estimate_text_tokens(text: str) -> int:
+    # About 4 characters per token for Spanish and JSON, close enough for a budget
+    return (len(text) + 3) // 4
+
+
+def estimate_image_tokens(width: int | None, height: int | None, detail: str) -> int:
+    if detail == "low":
+        return LOW_DETAIL_TOKENS
+    if not width or not height:
+        width = height = MEDIA_IMAGE_MAX_SIZE
+    # The copy sent is the one downscaled at ingestion (see media.preprocess_image)
+    scale = min(1, MEDIA_IMAGE_MAX_SIZE / max(width, height), 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1, 768 / min(width, height))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return LOW_DETAIL_TOKENS + TILE_TOKENS * tiles
+
+
+def media_label(path: str) -> str:
+    # Files stored under their sha256 are told apart by its first characters. Older files are
+    # named by the second they arrived (FILE-%Y-%m-%d %H:%M:%S.ext) and keep their whole name
+    name = os.path.basename(path)
+    stem, extension = os.path.splitext(name)
+    if SHA256_NAME.match(stem):
+        return f"{stem[:10]}{extension}"
+    return name
+
+
+def attachments(message: Message) -> list[dict]:
+    if message.media_files:
+        return [
+            {
+                "label": media_label(media_file.path),
+                "path": media_file.path,
+                "media_file": media_file,
+                # Only images that were downscaled at ingestion are sent to the LLM
+                "image": bool(media_file.derived_path),
+                "width": media_file.width,
+                "height": media_file.height,
+            }
+            for media_file in message.media_files
+        ]
+    # Messages stored before attachments were preprocessed only have their paths
+    return [
+        {
+            "label": media_label(path),
+            "path": path,
+            "media_file": None,
+            "image": (mimetypes.guess_type(path)[0] or "image/jpeg").startswith("image/"),
+            "width": None,
+            "height": None,
+        }
+        for path in (message.media_urls or "").split(",") if path
+    ]
+
+
+def message_line(message: Message, reflected: set[str]) -> str:
+    line = message.content or ""
+    if message.created_at:
+        line = f"[{message.created_at:%d/%m %H:%M}] {line}"
+    for attachment in attachments(message):
+        kind = "foto" if attachment["image"] else "adjunto"
+        note = ", ya en un pedido" if attachment["label"] in reflected else ""
+        line += f" ({kind} {attachment['label']}{note})"
+    return line
+
+
+def reflected_labels(current_orders: list[dict] | None, reflected_media: list[str] | None = None) -> set[str]:
+    # Attachments the orders already point to, the LLM saw them when it extracted those orders
+    paths = [path for order in current_orders or [] for path in order.get("reference_media_files") or []]
+    return {media_label(path) for path in paths + list(reflected_media or [])}
+
+
+def compact_order(order: dict) -> dict:
+    # Empty fields left out and attachments by label, the LLM returns the orders it changes whole
+    order = {key: value for key, value in order.items() if value}
+    if "reference_media_files" in order:
+        order["reference_media_files"] = [media_label(path) for path in order["reference_media_files"]]
+    return order
+
+
+def prompt_header(current_orders: list[dict] | None, summary: str | None) -> list[str]:
+    header = []
+    if summary:
+        header.append(f"Resumen de la conversación: {summary}")
+    if current_orders is not None:
+        orders = [compact_order(order) for order in current_orders]
+        header.append(f"Pedidos ya extraídos: {json.dumps(orders, ensure_ascii=False, separators=(',', ':'))}")
+    return header
+
+
+def messages_within_budget(messages: list[Message], current_orders: list[dict] | None = None, summary: str | None = None, budget: int = PROMPT_TOKEN_BUDGET) -> int:
+    """
+    How many of the oldest messages fit in the budget with their images at low detail, at least
+    one. Incremental extraction sends that many and leaves the rest for the next window.
+    """
+    reflected = reflected_labels(current_orders)
+    tokens = estimate_text_tokens("\n".join(prompt_header(current_orders, summary)))
+    for count, message in enumerate(messages):
+        tokens += estimate_text_tokens(message_line(message, reflected)) + 1
+        tokens += sum(LOW_DETAIL_TOKENS for attachment in attachments(message) if attachment["image"] and attachment["label"] not in reflected)
+        if tokens > budget:
+            return max(count, 1)
+    return len(messages)
+
+
+def compact_prompt(messages: list[Message], current_orders: list[dict] | None = None, summary: str | None = None, reflected_media: list[str] | None = None, detail: str = "auto", budget: int = PROMPT_TOKEN_BUDGET) -> dict:
+    """
+    Plan the user prompt for a list of messages. Returns its text, the images to send with
+    their detail, the short labels mapped back to the stored paths, the estimated tokens and
+    what the budget dropped. Images in reflected_media, or in the reference_media_files of
+    current_orders, are only named. Over the budget, older images go to low detail, then
+    images are dropped oldest first, then messages oldest first. The newest message always stays.
+    """
+    reflected = reflected_labels(current_orders, reflected_media)
+    header = prompt_header(current_orders, summary)
+    lines = [message_line(message, reflected) for message in messages]
+
+    media, images = {}, []
+    for message in messages:
+        for attachment in attachments(message):
+            media[attachment["label"]] = attachment["path"]
+            if attachment["image"] and attachment["label"] not in reflected:
+                images.append(attachment)
+    for age, image in enumerate(reversed(images)):
+        image["detail"] = detail if age < PROMPT_RECENT_IMAGES else "low"
+
+    # Tokens are kept as running totals, every line costs its newline too
+    line_tokens = [estimate_text_tokens(line) + 1 for line in lines]
+    text_tokens = estimate_text_tokens("\n".join(header)) + sum(line_tokens)
+    # Each image goes after a text part with its label
+    image_tokens = [estimate_image_tokens(image["width"], image["height"], image["detail"]) + estimate_text_tokens(image["label"]) for image in images]
+    total = text_tokens + sum(image_tokens)
+
+    for index, image in enumerate(images):
+        if total <= budget:
+            break
+        if image["detail"] != "low":
+            low_tokens = LOW_DETAIL_TOKENS + estimate_text_tokens(image["label"])
+            total -= image_tokens[index] - low_tokens
+            image["detail"], image_tokens[index] = "low", low_tokens
+    dropped_images = 0
+    while total > budget and dropped_images < len(images):
+        total -= image_tokens[dropped_images]
+        dropped_images += 1
+    images = images[dropped_images:]
+    dropped_messages = 0
+    while total > budget and dropped_messages < len(lines) - 1:
+        total -= line_tokens[dropped_messages]
+        dropped_messages += 1
+    lines = lines[dropped_messages:]
+    if dropped_messages:
+        lines.insert(0, f"({dropped_messages} mensajes anteriores omitidos)")
+
+    return {
+        "text": "\n".join([*header, "Mensajes del mecánico:", *lines]),
+        "images": images,
+        "media": media,
+        "tokens": total,
+        "dropped_images": dropped_images,
+        "dropped_messages": dropped_messages,
+    }
+
+
+def resolve_media_labels(orders, media: dict[str, str]):
+    # The LLM cites attachments by their label, the orders keep the stored path
+    for order in orders:
+        order.reference_media_files = [media.get(media_label(reference), reference) for reference in order.reference_media_files]
+
+
+def trim_summary(summary: str | None) -> str | None:
+    return summary[:PROMPT_SUMMARY_MAX_CHARS] if summary else None
@@ -0,0 +1,128 @@
+"""
+Re-extract the orders of many clients at once, e.g. after changing SYSTEM_DEFAULT or the
+Order schema in language.py.
+
+Clients are read from the database in chunks of --chunk-size and up to --concurrency of them
+are re-extracted at the same time. Each client's conversation starts again from an empty
+checkpoint and is sent in windows of EXTRACTION_WINDOW messages (or whole with --mode full).
+The windows are merged first and the orders upserted by plate once per client, so orders
+already in the database keep their id, and their status unless the re-extraction changes
+them (a changed order goes back to "Esperando precio"). Progress is saved to
+--checkpoint-file after every chunk and a run that is stopped continues from there. Best run
+while the worker is stopped, it would extract the same clients.
+
+    python reextract.py --user-id 3 --concurrency 8
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 python reextract.py   # against benchmarks/fake_openai_server.py
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import traceback
+from sqlalchemy import select
+from src.backend.database import SessionLocal, dispose_engine
+from src.backend.models import Client
+from extraction import load_checkpoint, extract_orders_full, extract_orders_incremental
+from language import token_usage
+from llm_backends import open_backend, close_backend
+from observability import configure_logging
+
+
+def load_progress(path: str) -> dict:
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"last_client_id": 0, "done": 0, "failed": []}
+
+
+def save_progress(path: str, progress: dict):
+    # Written next to the old file and renamed, so a crash never leaves half a file
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(progress, f)
+    os.replace(f"{path}.tmp", path)
+
+
+async def client_chunks(args, after_id: int):
+    while True:
+        query = select(Client.id).where(Client.id > after_id).order_by(Client.id).limit(args.chunk_size)
+        if args.user_id is not None:
+            query = query.where(Client.user_id == args.user_id)
+        if args.client_ids:
+            query = query.where(Client.id.in_(args.client_ids))
+        async with SessionLocal() as db:
+            client_ids = (await db.execute(query)).scalars().all()
+        if not client_ids:
+            return
+        yield client_ids
+        after_id = client_ids[-1]
+
+
+async def reextract_client(client_id: int, mode: str):
+    async with SessionLocal() as db:
+        if mode == "full":
+            await extract_orders_full(db, client_id)
+            return
+        checkpoint = await load_checkpoint(db, client_id)
+        checkpoint.last_message_id = 0
+        checkpoint.orders = []
+        checkpoint.summary = None
+        await db.commit()
+        await extract_orders_incremental(db, client_id, upsert_each_window=False)
+
+
+async def run(args):
+    configure_logging()
+    progress = {"last_client_id": 0, "done": 0, "failed": []} if args.restart else load_progress(args.checkpoint_file)
+    if progress["last_client_id"]:
+        print(f"Resuming after client {progress['last_client_id']} ({progress['done']} done, {len(progress['failed'])} failed)")
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    start = time.perf_counter()
+    clients_done = 0
+
+    async def reextract(client_id: int) -> bool:
+        async with semaphore:
+            try:
+                await reextract_client(client_id, args.mode)
+                return True
+            except Exception:
+                print(f"Client {client_id} failed: {traceback.format_exc()}")
+                return False
+
+    open_backend()
+    try:
+        async for client_ids in client_chunks(args, progress["last_client_id"]):
+            results = await asyncio.gather(*(reextract(client_id) for client_id in client_ids))
+            progress["done"] += sum(results)
+            progress["failed"] += [client_id for client_id, ok in zip(client_ids, results) if not ok]
+            progress["last_client_id"] = client_ids[-1]
+            save_progress(args.checkpoint_file, progress)
+
+            clients_done += len(client_ids)
+            elapsed = time.perf_counter() - start
+            tokens = token_usage["input_tokens"] + token_usage["output_tokens"]
+            print(
+                f"{progress['done']} clients done, {len(progress['failed'])} failed, up to client {client_ids[-1]} | "
+                f"{clients_done / elapsed:.2f} clients/s, {tokens / elapsed:.0f} tokens/s, {token_usage['calls']} LLM calls"
+            )
+    finally:
+        await close_backend()
+        await dispose_engine()
+
+    elapsed = time.perf_counter() - start
+    print(f"Finished in {elapsed:.1f}s: {token_usage['input_tokens']} input and {token_usage['output_tokens']} output tokens")
+    if progress["failed"]:
+        print(f"Failed clients, run them again with --restart --client-ids: {progress['failed']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-id", type=int, help="only the clients of this user")
+    parser.add_argument("--client-ids", type=int, nargs="+", help="only these clients")
+    parser.add_argument("--mode", choices=["incremental", "full"], default="incremental")
+    parser.add_argument("--chunk-size", type=int, default=100, help="clients read from the database at a time")
+    parser.add_argument("--concurrency", type=int, default=8, help="clients re-extracted at the same time (OPENAI_MAX_CONCURRENCY also applies)")
+    parser.add_argument("--checkpoint-file", default="reextract.checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint file and start from the first client")
+    asyncio.run(run(parser.parse_args()))
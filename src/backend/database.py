@@ -1,21 +1,148 @@
 import os
-from sqlalchemy import create_engine
+import time
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 MYSQL_USER = os.getenv("MYSQLUSER")
 MYSQL_HOST = os.getenv("MYSQLHOST")
 MYSQL_DB = os.getenv("MYSQL_DATABASE")
 MYSQL_PORT = os.getenv("MYSQLPORT")
 MYSQL_PASSWORD = os.getenv("MYSQL_ROOT_PASSWORD")
-MYSQL_CONNECTOR = "mysql+mysqlconnector"
-DATABASE_URL = f"{MYSQL_CONNECTOR}://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}"
+MYSQL_CONNECTOR = "mysql+aiomysql"
+# DATABASE_URL overrides the MySQL settings, e.g. sqlite+aiosqlite:///local.db for local runs and benchmarks
+DATABASE_URL = os.getenv("DATABASE_URL") or f"{MYSQL_CONNECTOR}://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HOST}:{MYSQL_PORT}/{MYSQL_DB}"
+# Plain sqlite:// URLs get the async driver
+if DATABASE_URL.startswith("sqlite://"):
+    DATABASE_URL = DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
 
-# Create the SQLAlchemy engine
-engine = create_engine(DATABASE_URL)
+# Connection pool settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # MySQL drops idle connections after wait_timeout
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_POOL_WAIT_THRESHOLD = float(os.getenv("DB_POOL_WAIT_THRESHOLD", "0.01"))  # Slower checkouts count as a wait for a free connection
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Queue pool that counts its checkouts and records the ones that had to wait for a free connection.
+    """
+
+    checkouts = 0
+    waits = 0
+    wait_seconds_total = 0.0
+    max_wait_seconds = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            TimedQueuePool.checkouts += 1
+            if waited > DB_POOL_WAIT_THRESHOLD:
+                TimedQueuePool.waits += 1
+                TimedQueuePool.wait_seconds_total += waited
+            TimedQueuePool.max_wait_seconds = max(TimedQueuePool.max_wait_seconds, waited)
+
+
+def _engine_options() -> dict:
+    if DATABASE_URL.startswith("sqlite") and ":memory:" in DATABASE_URL:
+        return {}  # In-memory SQLite keeps a single connection
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+# The engine (and its driver) is created on first use, importing the app stays cheap
+_engine = None
+_sessionmaker = None
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = create_async_engine(DATABASE_URL, **_engine_options())
+    return _engine
+
+
+def SessionLocal() -> AsyncSession:
+    # Named like the sessionmaker it replaces: `async with SessionLocal() as db`
+    global _sessionmaker
+    if _sessionmaker is None:
+        _sessionmaker = async_sessionmaker(bind=get_engine(), autoflush=False, expire_on_commit=False)
+    return _sessionmaker()
+
+
+def __getattr__(name: str):
+    # `from src.backend.database import engine` keeps working, and creates the engine
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+async def dispose_engine():
+    if _engine is not None:
+        await _engine.dispose()
 
-# Create a configured "Session" class
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Create a Base class for declarative models
 Base = declarative_base()
+
+
+# Dependency to get the database session
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
+
+
+def pool_stats() -> dict:
+    if _engine is None:
+        return {}
+    pool = _engine.sync_engine.pool
+    if not isinstance(pool, TimedQueuePool):
+        return {}
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "checkouts": TimedQueuePool.checkouts,
+        "waits": TimedQueuePool.waits,
+        "wait_seconds_total": TimedQueuePool.wait_seconds_total,
+        "max_wait_seconds": TimedQueuePool.max_wait_seconds,
+    }
+
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "alembic.ini")
+
+
+def _run_migrations(connection, revision: str):
+    from alembic import command
+    from alembic.config import Config
+    from sqlalchemy import inspect
+
+    config = Config(ALEMBIC_INI)
+    config.attributes["connection"] = connection  # migrations/env.py runs on this connection
+    config.attributes["configure_logger"] = False  # Keep the app's logging setup
+    tables = inspect(connection).get_table_names()
+    if "users" in tables and "alembic_version" not in tables:
+        # Database created with create_all before migrations existed
+        command.stamp(config, "0001")
+    command.upgrade(config, revision)
+
+
+async def create_tables(revision: str = "head"):
+    """
+    Bring the schema up to date by running the Alembic migrations (alembic upgrade head).
+    Run by `python manage.py init-db`, the app and the worker don't touch the schema.
+    """
+    async with get_engine().begin() as conn:
+        await conn.run_sync(_run_migrations, revision)
@@ -0,0 +1,70 @@
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.backend.models import Event, Order, Client
+
+# Changes the dashboards are told about over /events (see event_stream.py). Events are
+# added to the session of the change, so they are committed, or rolled back, with it.
+
+EVENTS_RETENTION_HOURS = int(os.getenv("EVENTS_RETENTION_HOURS", "24"))  # Clients away longer than this refetch instead of resuming
+EVENTS_PAGE_SIZE = int(os.getenv("EVENTS_PAGE_SIZE", "500"))  # Events read per query
+
+
+def record_event(db: AsyncSession, user_id: int, kind: str, data: dict) -> Event:
+    """
+    Add a change event for a user. The caller commits, together with the change.
+    """
+    event = Event(user_id=user_id, kind=kind, data=data)
+    db.add(event)
+    return event
+
+
+def order_data(order: Order) -> dict:
+    # Same fields as OrderResponse, a created order does not need to be fetched
+    return {
+        "order_id": order.id,
+        "client_id": order.client_id,
+        "status": order.status,
+        "car_plate": order.car_plate,
+        "car_frame": order.car_frame,
+        "car_brand": order.car_brand,
+        "car_model": order.car_model,
+        "order_requirements": order.order_requirements,
+        "reference_media_files": order.reference_media_files,
+    }
+
+
+async def client_owner(db: AsyncSession, client_id: int) -> int | None:
+    return (await db.execute(select(Client.user_id).where(Client.id == client_id))).scalar()
+
+
+async def events_after(db: AsyncSession, after_id: int, user_id: int = None, include_ids: list[int] = None, limit: int = EVENTS_PAGE_SIZE) -> list[Event]:
+    """
+    Events with an id above after_id, oldest first, of one user or of everyone. include_ids
+    adds older ids that were not committed yet when a newer one was read.
+    """
+    condition = Event.id > after_id
+    if include_ids:
+        condition = condition | Event.id.in_(include_ids)
+    query = select(Event).where(condition).order_by(Event.id).limit(limit)
+    if user_id is not None:
+        query = query.where(Event.user_id == user_id)
+    return (await db.execute(query)).scalars().all()
+
+
+async def last_event_id(db: AsyncSession) -> int:
+    return (await db.execute(select(func.max(Event.id)))).scalar() or 0
+
+
+async def first_event_id(db: AsyncSession) -> int | None:
+    return (await db.execute(select(func.min(Event.id)))).scalar()
+
+
+async def purge_old_events(db: AsyncSession, older_than: timedelta = timedelta(hours=EVENTS_RETENTION_HOURS), now: datetime = None) -> int:
+    now = now or datetime.utcnow()
+    # The newest event stays, SQLite would hand its id out again and resuming clients would skip the new one
+    newest = await last_event_id(db)
+    result = await db.execute(delete(Event).where(Event.created_at < now - older_than, Event.id < newest))
+    await db.commit()
+    return result.rowcount
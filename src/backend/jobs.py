@@ -0,0 +1,217 @@
+import os
+import random
+import asyncio
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, exists, select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from src.backend.database import SessionLocal
+from src.backend.models import Job
+
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_BACKOFF_BASE_SECONDS = float(os.getenv("JOB_BACKOFF_BASE_SECONDS", "2"))
+JOB_BACKOFF_MAX_SECONDS = float(os.getenv("JOB_BACKOFF_MAX_SECONDS", "300"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "600"))  # Running jobs not renewed for this long are considered abandoned
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", str(JOB_LEASE_SECONDS / 4)))  # How often running jobs renew their lease
+
+
+def enqueue_job(db: AsyncSession, kind: str, client_id: int = None, payload: dict = None, run_after: datetime = None) -> Job:
+    """
+    Add a job to the queue. The caller commits, so the job is stored in the same
+    transaction as the rows it refers to.
+    """
+    job = Job(
+        kind=kind,
+        client_id=client_id,
+        payload=payload or {},
+        status="pending",
+        attempts=0,
+        max_attempts=JOB_MAX_ATTEMPTS,
+        run_after=run_after or datetime.utcnow(),
+    )
+    db.add(job)
+    return job
+
+
+def job_first_enqueued_at(payload: dict | None, created_at: datetime) -> datetime:
+    first = (payload or {}).get("first_enqueued_at")
+    return datetime.fromisoformat(first) if first else created_at
+
+
+async def enqueue_debounced_job(
+    db: AsyncSession,
+    kind: str,
+    client_id: int,
+    payload: dict,
+    quiet_seconds: float,
+    max_delay_seconds: float,
+    now: datetime = None,
+) -> Job:
+    """
+    Enqueue a job that waits for `quiet_seconds` without newer jobs of the same kind and client,
+    but never more than `max_delay_seconds` after the first of them. Pending jobs it replaces are
+    deleted and a running one is asked to stop, unless it already reached that cap, so a burst of
+    messages ends in one job. The new job keeps the first time of the jobs it replaces, and is
+    enqueued after the ones the caller added before, so it still runs after them.
+    The caller commits.
+    """
+    now = now or datetime.utcnow()
+    first_enqueued_at = now
+    pending = (await db.execute(
+        select(Job.id, Job.payload, Job.created_at)
+        .where(Job.kind == kind, Job.client_id == client_id, Job.status == "pending")
+    )).all()
+    for job_id, job_payload, created_at in pending:
+        # A worker may have claimed it in the meantime
+        result = await db.execute(delete(Job).where(Job.id == job_id, Job.status == "pending"))
+        if result.rowcount:
+            first_enqueued_at = min(first_enqueued_at, job_first_enqueued_at(job_payload, created_at))
+    running = (await db.execute(
+        select(Job.id, Job.payload, Job.created_at)
+        .where(Job.kind == kind, Job.client_id == client_id, Job.status == "running")
+    )).all()
+    for job_id, job_payload, created_at in running:
+        first = job_first_enqueued_at(job_payload, created_at)
+        if first + timedelta(seconds=max_delay_seconds) <= now:
+            continue  # Already at the cap, cancelling it would put off its messages again
+        await db.execute(update(Job).where(Job.id == job_id, Job.status == "running").values(cancel_requested=True))
+        first_enqueued_at = min(first_enqueued_at, first)
+    run_after = min(now + timedelta(seconds=quiet_seconds), first_enqueued_at + timedelta(seconds=max_delay_seconds))
+    return enqueue_job(db, kind, client_id=client_id, payload={**payload, "first_enqueued_at": first_enqueued_at.isoformat()}, run_after=run_after)
+
+
+class JobCancelled(Exception):
+    """
+    Raised by handlers that stop early because the job was superseded.
+    """
+
+
+async def cancel_requested(job_id: int | None) -> bool:
+    if job_id is None:
+        return False
+    # Own session, the handler's transaction could be looking at an older snapshot
+    async with SessionLocal() as db:
+        return bool((await db.execute(select(Job.cancel_requested).where(Job.id == job_id))).scalar())
+
+
+async def raise_if_cancelled(job_id: int | None):
+    if await cancel_requested(job_id):
+        raise JobCancelled(f"Job {job_id} was superseded by a newer one")
+
+
+async def renew_lease(job_id: int, worker_id: str, now: datetime = None) -> bool:
+    """
+    Push back the lease of a running job. Returns False when the worker no longer holds it.
+    """
+    # Own session, the handler's transaction may stay open for a while
+    async with SessionLocal() as db:
+        result = await db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "running", Job.locked_by == worker_id)
+            .values(locked_at=now or datetime.utcnow())
+        )
+        await db.commit()
+    return bool(result.rowcount)
+
+
+async def keep_lease(job_id: int, worker_id: str):
+    # Runs next to the handler until it is cancelled, so long jobs are not taken for abandoned
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+        try:
+            if not await renew_lease(job_id, worker_id):
+                return
+        except Exception:
+            pass  # Database hiccup, the next beat tries again
+
+
+async def release_expired_leases(db: AsyncSession, now: datetime):
+    # Jobs left running by a worker that died go back to the queue. Their attempt was
+    # counted when they were claimed, so a job that keeps killing its worker fails in the end
+    expired = and_(Job.status == "running", Job.locked_at < now - timedelta(seconds=JOB_LEASE_SECONDS))
+    await db.execute(
+        update(Job)
+        .where(expired, Job.attempts >= Job.max_attempts)
+        .values(status="failed", locked_by=None, locked_at=None, last_error="The worker running the job stopped renewing its lease")
+    )
+    await db.execute(
+        update(Job)
+        .where(expired)
+        .values(status="pending", locked_by=None, locked_at=None, run_after=now)
+    )
+    await db.commit()
+
+
+async def claim_next_job(db: AsyncSession, worker_id: str, now: datetime = None) -> Job | None:
+    """
+    Take the next runnable job. A job is runnable when it is due and no earlier job of the
+    same client is still pending or running, which keeps the jobs of each client in order.
+    """
+    now = now or datetime.utcnow()
+    await release_expired_leases(db, now)
+
+    earlier = aliased(Job)
+    blocked = exists().where(
+        earlier.client_id == Job.client_id,
+        or_(earlier.status == "running", and_(earlier.status == "pending", earlier.id < Job.id)),
+    )
+    candidates = (await db.execute(
+        select(Job.id)
+        .where(Job.status == "pending", Job.run_after <= now, ~blocked)
+        .order_by(Job.id.asc())
+        .limit(10)
+    )).scalars().all()
+
+    for job_id in candidates:
+        # Only one worker wins the update, the others move on to the next candidate
+        result = await db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "pending")
+            .values(status="running", locked_by=worker_id, locked_at=now, attempts=Job.attempts + 1)
+        )
+        await db.commit()
+        if result.rowcount:
+            return await db.get(Job, job_id)
+    return None
+
+
+async def release_job(db: AsyncSession, job_id: int, worker_id: str, **values) -> bool:
+    # Only the worker holding the lease settles the job. One whose lease expired leaves it
+    # to the worker that took it over, returns False and changes nothing
+    result = await db.execute(
+        update(Job)
+        .where(Job.id == job_id, Job.status == "running", Job.locked_by == worker_id)
+        .values(locked_by=None, locked_at=None, **values)
+    )
+    await db.commit()
+    return bool(result.rowcount)
+
+
+async def mark_done(db: AsyncSession, job: Job, worker_id: str) -> bool:
+    return await release_job(db, job.id, worker_id, status="done", last_error=None)
+
+
+def backoff_seconds(attempts: int) -> float:
+    delay = min(JOB_BACKOFF_MAX_SECONDS, JOB_BACKOFF_BASE_SECONDS * (2 ** max(attempts - 1, 0)))
+    return delay * random.uniform(0.8, 1.2)  # Jitter so retries of a burst don't line up
+
+
+async def mark_failed(db: AsyncSession, job: Job, worker_id: str, error: str, now: datetime = None) -> bool:
+    now = now or datetime.utcnow()
+    await db.refresh(job)  # The failed handler's transaction was rolled back
+    if job.attempts >= job.max_attempts:
+        return await release_job(db, job.id, worker_id, status="failed", last_error=error)
+    run_after = now + timedelta(seconds=backoff_seconds(job.attempts))
+    return await release_job(db, job.id, worker_id, status="pending", last_error=error, run_after=run_after)
+
+
+async def mark_cancelled(db: AsyncSession, job: Job, worker_id: str) -> bool:
+    await db.refresh(job)
+    return await release_job(db, job.id, worker_id, status="cancelled")
+
+
+async def purge_finished_jobs(db: AsyncSession, older_than: timedelta, now: datetime = None) -> int:
+    now = now or datetime.utcnow()
+    result = await db.execute(delete(Job).where(Job.status.in_(("done", "cancelled")), Job.updated_at < now - older_than))
+    await db.commit()
+    return result.rowcount
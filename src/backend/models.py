@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Index, Boolean
 from sqlalchemy.types import JSON
 from sqlalchemy.orm import relationship
 from src.backend.database import Base
@@ -14,6 +14,10 @@ class User(Base):
 
 class Client(Base):
     __tablename__ = "clients"
+    __table_args__ = (
+        # The webhook looks clients up by phone number, and two messages arriving together must not create the client twice
+        Index("uq_clients_user_id_phone_number", "user_id", "phone_number", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     phone_number = Column(String(25))  # Specify length for phone_number
@@ -25,6 +29,9 @@ class Client(Base):
 
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        Index("ix_orders_client_id_car_plate", "client_id", "car_plate"),  # Upserts match orders by plate within a client
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     status = Column(String(125))  # Specify length for status
@@ -38,12 +45,129 @@ class Order(Base):
     client = relationship("Client", back_populates="orders")
 
 
+def requirements_of(order: Order) -> list[dict]:
+    """
+    The [{part: references}] of an order. Orders updated by the first version of the webhook
+    hold them wrapped in one more list, a trailing comma stored a tuple of the list.
+    """
+    requirements = order.order_requirements or []
+    if len(requirements) == 1 and isinstance(requirements[0], list):
+        return requirements[0]
+    return requirements
+
+
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_messages_client_id_id", "client_id", "id"),  # Conversation of a client in order, and messages after a checkpoint
+    )
 
     id = Column(Integer, primary_key=True, index=True)  # Unique identifier for each message
-    content = Column(String(255))  # Store the message content (up to 255 characters)
+    content = Column(Text)  # Store the message content
     media_urls = Column(String(255), nullable=True)
+    message_sid = Column(String(64), nullable=True, unique=True, index=True)  # Twilio MessageSid, retried deliveries are stored once
     client_id = Column(Integer, ForeignKey("clients.id"))  # Foreign key to link to the Client model
     client = relationship("Client", back_populates="messages")  # Relationship to Client
     created_at = Column(DateTime, default=datetime.utcnow)  # Timestamp for when the message was created
+    media_files = relationship("MediaFile", back_populates="message", order_by="MediaFile.id")  # Attachments of the message
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(50))  # Name of the handler that runs the job, e.g. "extract_orders"
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=True, index=True)  # Jobs of the same client run in order
+    payload = Column(JSON)
+    status = Column(String(20), default="pending", index=True)  # pending, running, done, failed or cancelled
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=5)
+    run_after = Column(DateTime, default=datetime.utcnow)  # Not picked up before this time (used for retry backoff)
+    locked_by = Column(String(100), nullable=True)  # Worker currently running the job
+    locked_at = Column(DateTime, nullable=True)
+    cancel_requested = Column(Boolean, default=False)  # Set when a newer job supersedes this one while it runs
+    last_error = Column(Text, nullable=True)
+    result = Column(JSON, nullable=True)  # Set by handlers that report progress, e.g. rows deleted so far
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class ExtractionCheckpoint(Base):
+    __tablename__ = "extraction_checkpoints"
+
+    id = Column(Integer, primary_key=True, index=True)
+    client_id = Column(Integer, ForeignKey("clients.id"), unique=True)
+    last_message_id = Column(Integer, default=0)  # Messages up to this id are reflected in orders
+    orders = Column(JSON)  # Orders extracted so far, as returned by the LLM
+    summary = Column(Text, nullable=True)  # What the earlier messages said beyond the orders, written by the LLM
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class Event(Base):
+    __tablename__ = "events"
+    __table_args__ = (
+        Index("ix_events_user_id_id", "user_id", "id"),  # A user's events after the last one a client saw
+    )
+
+    id = Column(Integer, primary_key=True, index=True)  # Also the id of the server-sent event, clients resume after it
+    user_id = Column(Integer, ForeignKey("users.id"))  # Whose /events stream it goes to
+    kind = Column(String(50))  # e.g. "order.updated"
+    data = Column(JSON)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class PartReference(Base):
+    __tablename__ = "part_references"
+
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String(64), unique=True, index=True)  # sha256 of the catalog file id and the normalized part, brand and model
+    catalog_file_id = Column(String(100), index=True)  # Catalog the references were searched in
+    part_name = Column(String(255))  # Normalized part name
+    car_brand = Column(String(125))  # Normalized, empty when unknown
+    car_model = Column(String(125))  # Normalized, empty when unknown
+    references = Column(JSON)  # Response of the catalog search
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class MediaFile(Base):
+    __tablename__ = "media_files"
+
+    id = Column(Integer, primary_key=True, index=True)
+    message_id = Column(Integer, ForeignKey("messages.id"), index=True)
+    client_id = Column(Integer, ForeignKey("clients.id"))
+    sha256 = Column(String(64), index=True)  # Content hash, also the file name on disk
+    path = Column(String(255))  # Relative path, e.g. media/<user_id>/<client_id>/<sha256>.jpg
+    mime_type = Column(String(100))
+    size_bytes = Column(Integer)
+    width = Column(Integer, nullable=True)  # Set for images
+    height = Column(Integer, nullable=True)
+    derived_path = Column(String(255), nullable=True)  # Downscaled copy sent to the LLM
+    derived_mime_type = Column(String(100), nullable=True)
+    derived_size_bytes = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    message = relationship("Message", back_populates="media_files")
+
+
+class OrderSearchTerm(Base):
+    __tablename__ = "order_search_terms"
+    __table_args__ = (
+        Index("ix_order_search_terms_user_id_kind_term", "user_id", "kind", "term", "order_id"),  # Prefix search of a user's orders, without reading the rows
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    order_id = Column(Integer, ForeignKey("orders.id"), index=True)  # Terms are replaced when their order changes
+    kind = Column(String(20))  # plate, plate_gram, frame, car, part or reference (see src/backend/search.py)
+    term = Column(String(64))  # Normalized: lower case ASCII letters and digits
+
+
+class MessageSearchTerm(Base):
+    __tablename__ = "message_search_terms"
+    __table_args__ = (
+        Index("ix_message_search_terms_user_id_term", "user_id", "term", "message_id"),  # Prefix search of a user's messages, without reading the rows
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    message_id = Column(Integer, ForeignKey("messages.id"), index=True)
+    term = Column(String(64))  # A normalized word of the message
@@ -0,0 +1,108 @@
+import os
+import re
+import hashlib
+import unicodedata
+from sqlalchemy import select, delete
+from sqlalchemy.exc import IntegrityError
+from src.backend.database import SessionLocal
+from src.backend.models import PartReference
+from src.backend.ttl_cache import TTLCache
+
+PART_CACHE_SIZE = int(os.getenv("PART_CACHE_SIZE", "5000"))  # Entries kept in memory per process
+PART_CACHE_TTL_SECONDS = int(os.getenv("PART_CACHE_TTL_SECONDS", "3600"))
+
+
+def normalize_text(text: str | None) -> str:
+    # "Pastillas de  Freno!" and "pastillas de freno" share the same entry
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r"[^a-z0-9]+", " ", text.lower())
+    return text.strip()
+
+
+def cache_key(catalog_file_id: str, part_name: str, car_brand: str, car_model: str) -> str:
+    raw = "|".join([catalog_file_id, part_name, car_brand, car_model])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class PartReferenceCache:
+    """
+    Cache of catalog searches. An in-process LRU/TTL cache sits in front of the
+    part_references table, which is shared by every process.
+    """
+
+    def __init__(self, session_factory=SessionLocal, maxsize: int = PART_CACHE_SIZE, ttl: float = PART_CACHE_TTL_SECONDS):
+        self.session_factory = session_factory
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.db_hits = 0
+        self.misses = 0
+
+    async def _load(self, key: str):
+        async with self.session_factory() as db:
+            result = await db.execute(select(PartReference.references).where(PartReference.cache_key == key))
+            return result.scalars().first()
+
+    async def _store(self, key: str, catalog_file_id: str, part_name: str, car_brand: str, car_model: str, references: dict):
+        async with self.session_factory() as db:
+            db.add(PartReference(
+                cache_key=key,
+                catalog_file_id=catalog_file_id,
+                part_name=part_name[:255],
+                car_brand=car_brand[:125],
+                car_model=car_model[:125],
+                references=references,
+            ))
+            try:
+                await db.commit()
+            except IntegrityError:
+                # Another worker stored the same lookup first
+                await db.rollback()
+
+    async def _delete_other_catalogs(self, catalog_file_id: str | None) -> int:
+        async with self.session_factory() as db:
+            statement = delete(PartReference)
+            if catalog_file_id is not None:
+                statement = statement.where(PartReference.catalog_file_id != catalog_file_id)
+            result = await db.execute(statement)
+            await db.commit()
+            return result.rowcount
+
+    async def get(self, catalog_file_id: str, part_name: str, car_brand: str = "", car_model: str = "") -> dict | None:
+        key = cache_key(catalog_file_id, normalize_text(part_name), normalize_text(car_brand), normalize_text(car_model))
+        references = self.memory.get(key)
+        if references is not None:
+            return references
+        references = await self._load(key)
+        if references is None:
+            self.misses += 1
+            return None
+        self.db_hits += 1
+        self.memory.set(key, references)
+        return references
+
+    async def set(self, catalog_file_id: str, part_name: str, car_brand: str, car_model: str, references: dict):
+        part_name, car_brand, car_model = normalize_text(part_name), normalize_text(car_brand), normalize_text(car_model)
+        key = cache_key(catalog_file_id, part_name, car_brand, car_model)
+        self.memory.set(key, references)
+        await self._store(key, catalog_file_id, part_name, car_brand, car_model, references)
+
+    async def invalidate(self, keep_catalog_file_id: str | None = None) -> int:
+        """
+        Drop the entries of every catalog but `keep_catalog_file_id` (all entries when None).
+        Call it when the catalog file changes.
+        """
+        self.memory.clear()
+        return await self._delete_other_catalogs(keep_catalog_file_id)
+
+    def stats(self) -> dict:
+        lookups = self.memory.hits + self.db_hits + self.misses
+        return {
+            "memory_hits": self.memory.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory.hits + self.db_hits) / lookups if lookups else 0.0,
+            "memory_size": len(self.memory),
+        }
+
+
+part_reference_cache = PartReferenceCache()
@@ -1,3 +1,4 @@
+from datetime import datetime
 from pydantic import BaseModel
 
 class UserCreate(BaseModel):
@@ -19,35 +20,84 @@ class ClientCreate(BaseModel):
     phone_number: str
     name: str = None
 
+class OrderCreate(BaseModel):
+    status: str
+    car_plate: str
+    car_frame: str | None = None
+    car_brand: str | None = None
+    car_model: str | None = None
+    order_requirements: list = []
+    reference_media_files: list = []
+    client_id: int
+
+class OrderResponse(BaseModel):
+    id: int
+    client_id: int
+    status: str | None
+    car_plate: str | None
+    car_frame: str | None
+    car_brand: str | None
+    car_model: str | None
+    order_requirements: list | None  # [{part_name: {"references": [...]}}, ...]
+    reference_media_files: list | None
+
+    class Config:
+        from_attributes = True
+
 class ClientResponse(BaseModel):
     id: int
     phone_number: str
     name: str | None
-    orders: list['OrderResponse'] = []  # This will reference the OrderResponse schema
+    orders: list[OrderResponse] | None = None  # Only filled when the orders are requested
 
     class Config:
         from_attributes = True
 
-class OrderCreate(BaseModel):
-    status: str
-    car_plate: str
-    order_bullet_list: str
-    client_id: int
-
-class OrderResponse(BaseModel):
+class ClientOrderCount(BaseModel):
     id: int
-    status: str
-    car_plate: str
-    order_bullet_list: str
+    phone_number: str
+    name: str | None
+    order_count: int
 
     class Config:
         from_attributes = True
 
-class OrderCreate(BaseModel):
-    status: str
-    car_plate: str
-    order_bullet_list: str
+# Pages are keyset paginated: pass next_cursor as ?cursor= to get the following page,
+# it is None on the last page.
+class ClientPage(BaseModel):
+    items: list[ClientResponse]
+    next_cursor: int | None
+
+class OrderPage(BaseModel):
+    items: list[OrderResponse]
+    next_cursor: int | None
+
+class ClientOrderCountPage(BaseModel):
+    items: list[ClientOrderCount]
+    next_cursor: int | None
+
+class MessageResponse(BaseModel):
+    id: int
     client_id: int
+    content: str | None
+    media_urls: str | None
+    created_at: datetime | None
+
+    class Config:
+        from_attributes = True
 
+class MessagePage(BaseModel):
+    items: list[MessageResponse]
+    next_cursor: int | None
 
+class JobResponse(BaseModel):
+    id: int
+    kind: str
+    status: str  # pending, running, done or failed
+    attempts: int
+    result: dict | None
+    created_at: datetime
+    updated_at: datetime
 
+    class Config:
+        from_attributes = True
@@ -0,0 +1,252 @@
+import os
+import re
+import unicodedata
+from sqlalchemy import select, insert, delete, func, and_, union
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.backend.models import Order, Message, Client, OrderSearchTerm, MessageSearchTerm, requirements_of
+
+# Search over a user's orders and messages (/search). order_requirements is a JSON blob and
+# messages are free text, so both are broken into normalized terms that are written in the
+# transaction of the change: plates, frame, car, part names and part references of every
+# order, and the words of every message. A query term matches the terms it is a prefix of,
+# and a plate also matches plates a typo away through their trigrams.
+
+SEARCH_MESSAGE_MAX_TERMS = int(os.getenv("SEARCH_MESSAGE_MAX_TERMS", "200"))  # Words of a long message past this are not indexed
+SEARCH_PLATE_MAX_DISTANCE = int(os.getenv("SEARCH_PLATE_MAX_DISTANCE", "1"))  # Typos (edits, swapped characters) a fuzzy plate match allows
+SEARCH_FUZZY_CANDIDATES = int(os.getenv("SEARCH_FUZZY_CANDIDATES", "200"))  # Orders sharing trigrams with the plate that are compared to it
+SEARCH_REINDEX_BATCH_SIZE = int(os.getenv("SEARCH_REINDEX_BATCH_SIZE", "1000"))  # Rows per transaction of rebuild_search_index
+
+TERM_MAX_LENGTH = 64  # Length of the term columns
+MIN_FUZZY_PLATE_LENGTH = 4  # Shorter plates share trigrams with too many others
+# Kinds of order terms a query word is matched against, plate_gram is only for fuzzy plates
+ORDER_TEXT_KINDS = ("plate", "frame", "car", "part", "reference")
+# Too common to narrow anything down, left out of the index and of queries
+STOPWORDS = frozenset("a al con de del el en es la las lo los me mi o para por que se su te un una y".split())
+
+
+def normalize(text: str) -> str:
+    # Lower case ASCII: "Matrícula" and "matricula" are the same term
+    text = unicodedata.normalize("NFKD", text or "")
+    return "".join(char for char in text if not unicodedata.combining(char)).lower()
+
+
+def words(text: str) -> list[str]:
+    return re.findall(r"[a-z0-9]+", normalize(text))
+
+
+def compact_key(text: str) -> str:
+    # Plates, frames and references without spaces or dashes: "1234-abc" is "1234abc"
+    return "".join(words(text))[:TERM_MAX_LENGTH]
+
+
+def text_terms(text: str) -> list[str]:
+    """
+    Distinct words of a text worth indexing, in order. A plate written in two parts
+    ("1234 ABC") is also indexed joined.
+    """
+    tokens = words(text)
+    terms = [token[:TERM_MAX_LENGTH] for token in tokens if len(token) > 1 and token not in STOPWORDS]
+    for first, second in zip(tokens, tokens[1:]):
+        if 5 <= len(first) + len(second) <= 10 and first.isdigit() != second.isdigit():
+            terms.append(first + second)
+    return list(dict.fromkeys(terms))
+
+
+def trigrams(key: str) -> set[str]:
+    return {key[index:index + 3] for index in range(len(key) - 2)}
+
+
+def query_terms(q: str) -> list[str]:
+    # Stopwords are only kept when the query is nothing else, e.g. "de" as the start of "delantero"
+    tokens = list(dict.fromkeys(token[:TERM_MAX_LENGTH] for token in words(q)))
+    return [token for token in tokens if token not in STOPWORDS] or tokens
+
+
+def prefix_range(column, prefix: str):
+    """
+    Terms starting with prefix. Terms only hold a-z and 0-9, so anything between the prefix
+    and the prefix followed by z's starts with it. A range rather than LIKE, so the index is
+    used on SQLite and MySQL whatever their collation.
+    """
+    return and_(column >= prefix, column <= prefix + "z" * (TERM_MAX_LENGTH - len(prefix)))
+
+
+def edit_distance(first: str, second: str) -> int:
+    # Levenshtein distance where two swapped characters count as one edit
+    previous, current = None, list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            cost = first[i - 1] != second[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+    return current[-1]
+
+
+def order_terms(order: Order) -> set[tuple[str, str]]:
+    """
+    (kind, term) pairs of an order: its plate and the plate's trigrams, frame, brand and
+    model, the words of its parts and the codes and names of their references.
+    """
+    terms = set()
+    plate = compact_key(order.car_plate)
+    if plate:
+        terms.add(("plate", plate))
+        terms.update(("plate_gram", gram) for gram in trigrams(plate))
+    frame = compact_key(order.car_frame)
+    if frame:
+        terms.add(("frame", frame))
+    terms.update(("car", term) for term in text_terms(f"{order.car_brand or ''} {order.car_model or ''}"))
+    for requirement in requirements_of(order):
+        for part, found in requirement.items():
+            terms.update(("part", term) for term in text_terms(part))
+            # {"references": [{"part_reference": ..., "reference_name": ...}]}, as get_part_references returns
+            for reference in (found or {}).get("references", []) if isinstance(found, dict) else []:
+                code = compact_key(reference.get("part_reference"))
+                if code:
+                    terms.add(("reference", code))
+                terms.update(("part", term) for term in text_terms(reference.get("reference_name")))
+    return terms
+
+
+def message_term_rows(user_id: int, message_id: int, content: str | None) -> list[dict]:
+    return [{"user_id": user_id, "message_id": message_id, "term": term} for term in text_terms(content)[:SEARCH_MESSAGE_MAX_TERMS]]
+
+
+async def index_orders(db: AsyncSession, user_id: int, orders: list[Order], replace: bool = True):
+    """
+    Write the search terms of orders, replacing the ones they had unless they are new. The
+    orders must have been flushed, the caller commits.
+    """
+    if not orders:
+        return
+    if replace:
+        await delete_order_terms(db, [order.id for order in orders])
+    rows = [{"user_id": user_id, "order_id": order.id, "kind": kind, "term": term} for order in orders for kind, term in order_terms(order)]
+    if rows:
+        await db.execute(insert(OrderSearchTerm), rows)
+
+
+async def index_message(db: AsyncSession, user_id: int, message: Message):
+    # Added next to the message by the webhook, the caller commits
+    rows = message_term_rows(user_id, message.id, message.content)
+    if rows:
+        await db.execute(insert(MessageSearchTerm), rows)
+
+
+async def delete_order_terms(db: AsyncSession, order_ids: list[int]):
+    await db.execute(delete(OrderSearchTerm).where(OrderSearchTerm.order_id.in_(order_ids)))
+
+
+async def delete_message_terms(db: AsyncSession, message_ids: list[int]):
+    await db.execute(delete(MessageSearchTerm).where(MessageSearchTerm.message_id.in_(message_ids)))
+
+
+def matching_orders(user_id: int, kinds: tuple[str, ...], term: str):
+    return select(OrderSearchTerm.order_id).where(OrderSearchTerm.user_id == user_id, OrderSearchTerm.kind.in_(kinds), prefix_range(OrderSearchTerm.term, term))
+
+
+async def fuzzy_plate_orders(db: AsyncSession, user_id: int, plate: str, max_distance: int = SEARCH_PLATE_MAX_DISTANCE) -> list[int]:
+    """
+    Ids of the user's orders whose plate is at most max_distance edits from plate. An edit changes
+    at most 3 trigrams (4 for swapped characters), so only orders sharing enough of them
+    are compared.
+    """
+    plate = compact_key(plate)
+    if len(plate) < MIN_FUZZY_PLATE_LENGTH or max_distance < 1:
+        return []
+    grams = trigrams(plate)
+    candidates = (
+        select(OrderSearchTerm.order_id)
+        .where(OrderSearchTerm.user_id == user_id, OrderSearchTerm.kind == "plate_gram", OrderSearchTerm.term.in_(grams))
+        .group_by(OrderSearchTerm.order_id)
+        .having(func.count() >= max(1, len(grams) - 4 * max_distance))
+        .limit(SEARCH_FUZZY_CANDIDATES)
+    )
+    rows = (await db.execute(select(Order.id, Order.car_plate).where(Order.id.in_(candidates)))).all()
+    return [order_id for order_id, car_plate in rows if edit_distance(compact_key(car_plate), plate) <= max_distance]
+
+
+async def search_orders(
+    db: AsyncSession, user_id: int, q: str, status: str = None, client_id: int = None, fuzzy: bool = True, cursor: int = 0, limit: int = 50
+) -> list[Order]:
+    """
+    Orders of a user matching a query, by id from cursor, up to limit. Every word of the
+    query has to start a term of the order (plate, frame, car, part or reference); the whole
+    query also matches plates it starts, and with fuzzy, plates a typo away.
+    """
+    terms = query_terms(q)
+    if not terms:
+        return []
+    first, *others = terms
+    matches = [matching_orders(user_id, ORDER_TEXT_KINDS, first).where(
+        *(OrderSearchTerm.order_id.in_(matching_orders(user_id, ORDER_TEXT_KINDS, term)) for term in others)
+    )]
+    plate = compact_key(q)
+    if others:
+        # "1234 ABC" for the plate 1234ABC
+        matches.append(matching_orders(user_id, ("plate",), plate))
+    if fuzzy:
+        fuzzy_ids = await fuzzy_plate_orders(db, user_id, plate)
+        if fuzzy_ids:
+            matches.append(select(Order.id).where(Order.id.in_(fuzzy_ids)))
+    # One set of ids the orders are read from, an OR of conditions would scan the orders table
+    ids = union(*matches) if len(matches) > 1 else matches[0]
+    query = select(Order).where(Order.id.in_(ids), Order.id > cursor).order_by(Order.id).limit(limit)
+    if status:
+        query = query.where(Order.status == status)
+    if client_id is not None:
+        query = query.where(Order.client_id == client_id)
+    return (await db.execute(query)).scalars().all()
+
+
+async def search_messages(db: AsyncSession, user_id: int, q: str, client_id: int = None, cursor: int = 0, limit: int = 50) -> list[Message]:
+    """
+    Messages of a user with a word starting with each word of the query, by id from cursor,
+    up to limit.
+    """
+    terms = query_terms(q)
+    if not terms:
+        return []
+    query = select(Message).where(Message.id > cursor).order_by(Message.id).limit(limit)
+    for term in terms:
+        query = query.where(Message.id.in_(
+            select(MessageSearchTerm.message_id).where(MessageSearchTerm.user_id == user_id, prefix_range(MessageSearchTerm.term, term))
+        ))
+    if client_id is not None:
+        query = query.where(Message.client_id == client_id)
+    return (await db.execute(query)).scalars().all()
+
+
+async def rebuild_search_index(db: AsyncSession, batch_size: int = SEARCH_REINDEX_BATCH_SIZE) -> dict:
+    """
+    Index every order and message again, e.g. for the ones stored before the index existed.
+    One transaction per batch, the webhook and the worker keep writing meanwhile.
+    """
+    counts = {"orders": 0, "messages": 0}
+    last_id = 0
+    while rows := (await db.execute(
+        select(Order, Client.user_id).join(Client, Client.id == Order.client_id).where(Order.id > last_id).order_by(Order.id).limit(batch_size)
+    )).all():
+        by_user = {}
+        for order, user_id in rows:
+            by_user.setdefault(user_id, []).append(order)
+        for user_id, orders in by_user.items():
+            await index_orders(db, user_id, orders)
+        await db.commit()
+        counts["orders"] += len(rows)
+        last_id = rows[-1][0].id
+
+    last_id = 0
+    while rows := (await db.execute(
+        select(Message.id, Message.content, Client.user_id).join(Client, Client.id == Message.client_id).where(Message.id > last_id).order_by(Message.id).limit(batch_size)
+    )).all():
+        await delete_message_terms(db, [message_id for message_id, _, _ in rows])
+        terms = [term for message_id, content, user_id in rows for term in message_term_rows(user_id, message_id, content)]
+        if terms:
+            await db.execute(insert(MessageSearchTerm), terms)
+        await db.commit()
+        counts["messages"] += len(rows)
+        last_id = rows[-1][0]
+    return counts
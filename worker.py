@@ -0,0 +1,156 @@
+import os
+import time
+import asyncio
+import signal
+import socket
+import logging
+import traceback
+from datetime import timedelta
+from prometheus_client import start_http_server
+from src.backend.database import SessionLocal, dispose_engine, pool_stats
+from src.backend.jobs import claim_next_job, keep_lease, mark_done, mark_failed, mark_cancelled, purge_finished_jobs, JobCancelled
+from src.backend.events import purge_old_events
+from src.backend.part_cache import part_reference_cache
+from extraction import fetch_message_media, extract_orders
+from deletion import delete_messages_job, delete_orders_job, delete_all_job
+from language import CATALOG_FILE_ID
+from llm_backends import open_backend, close_backend
+from media import open_http_client, close_http_client, encoded_images
+from observability import configure_logging, trace, trace_summary, gauges, JOB_SECONDS
+
+# Background worker that drains the job queue filled by the webhook.
+# Run it next to the web server with `python worker.py`, after `python manage.py init-db`.
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))  # Concurrent jobs per process
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))  # Seconds to wait when the queue is empty
+JOB_RETENTION_HOURS = int(os.getenv("JOB_RETENTION_HOURS", "24"))  # Finished jobs are purged after this
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))  # Serves /metrics for Prometheus when set
+
+logger = logging.getLogger("worker")
+
+HANDLERS = {
+    "fetch_media": fetch_message_media,
+    "extract_orders": extract_orders,
+    "delete_messages": delete_messages_job,
+    "delete_orders": delete_orders_job,
+    "delete_all": delete_all_job,
+}
+
+
+async def run_next_job(worker_id: str) -> bool:
+    """
+    Claim and run one job. Returns False when there was nothing to do.
+    """
+    async with SessionLocal() as db:
+        job = await claim_next_job(db, worker_id)
+        if job is None:
+            return False
+
+        # Read before running, the attributes are expired if the handler's transaction is rolled back
+        job_id, kind, attempts = job.id, job.kind, job.attempts
+        handler = HANDLERS.get(kind)
+        with trace(f"job-{job_id}"):
+            start = time.perf_counter()
+            # Renews the lease while the handler runs, see jobs.keep_lease
+            heartbeat = asyncio.create_task(keep_lease(job_id, worker_id))
+            try:
+                try:
+                    if handler is None:
+                        raise ValueError(f"Unknown job kind: {kind}")
+                    await handler(db, job)
+                finally:
+                    heartbeat.cancel()
+            except JobCancelled:
+                await db.rollback()
+                outcome = "cancelled"
+                settled = await mark_cancelled(db, job, worker_id)
+            except Exception:
+                await db.rollback()
+                outcome = "failed"
+                error = traceback.format_exc()
+                logger.error("Job %s (%s) failed on attempt %s", job_id, kind, attempts, exc_info=True)
+                settled = await mark_failed(db, job, worker_id, error)
+            else:
+                outcome = "done"
+                settled = await mark_done(db, job, worker_id)
+            if not settled:
+                # The lease expired and another worker took the job over, its outcome is the one kept
+                logger.warning("Job %s (%s) lost its lease, %s outcome dropped", job_id, kind, outcome)
+            elapsed = time.perf_counter() - start
+            JOB_SECONDS.labels(kind, outcome).observe(elapsed)
+            logger.info(
+                "Job %s (%s) %s", job_id, kind, outcome,
+                extra={"worker": worker_id, "job_id": job_id, "kind": kind, "attempt": attempts, "outcome": outcome, "duration_ms": round(elapsed * 1000, 2), **trace_summary()},
+            )
+        return True
+
+
+async def worker_loop(worker_id: str, stop: asyncio.Event):
+    while not stop.is_set():
+        try:
+            ran = await run_next_job(worker_id)
+        except Exception as e:
+            # Database hiccups should not kill the worker
+            logger.warning("[%s] error while polling the queue: %s", worker_id, e)
+            ran = False
+        if not ran:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def purge_loop(stop: asyncio.Event):
+    while not stop.is_set():
+        try:
+            async with SessionLocal() as db:
+                purged = await purge_finished_jobs(db, timedelta(hours=JOB_RETENTION_HOURS))
+                purged_events = await purge_old_events(db)
+            if purged:
+                logger.info("Purged %s finished jobs", purged)
+            if purged_events:
+                logger.info("Purged %s old events", purged_events)
+        except Exception as e:
+            logger.warning("Error while purging finished jobs: %s", e)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=3600)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def main():
+    configure_logging()
+
+    # References searched in a previous catalog file are stale
+    invalidated = await part_reference_cache.invalidate(CATALOG_FILE_ID)
+    if invalidated:
+        logger.info("Dropped %s cached part references from previous catalogs", invalidated)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        # Let running jobs finish before exiting
+        loop.add_signal_handler(sig, stop.set)
+
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    logger.info("Starting %s job workers (%s)", JOB_WORKERS, prefix)
+    gauges.add("part_reference_cache", "Part reference cache", part_reference_cache.stats)
+    gauges.add("encoded_images", "Cache of images encoded for prompts", encoded_images.stats)
+    gauges.add("db_pool", "Database connection pool", pool_stats)
+    if WORKER_METRICS_PORT:
+        start_http_server(WORKER_METRICS_PORT)
+    open_backend()
+    open_http_client()
+    try:
+        await asyncio.gather(
+            purge_loop(stop),
+            *(worker_loop(f"{prefix}-{i}", stop) for i in range(JOB_WORKERS)),
+        )
+    finally:
+        await close_backend()
+        await close_http_client()
+        await dispose_engine()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())